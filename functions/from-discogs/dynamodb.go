@@ -21,6 +21,8 @@ type Track struct {
 	Artists        []discogs.ArtistSource `json:"release_artists"`
 	ExtraArtists   []discogs.ArtistSource `json:"release_extraartists"`
 	ArtistsSort    string                 `json:"release_artistssort"`
+	// Sparse "pending match" index key, removed by to-spotify on match
+	PendingMatch int `json:"pending_match"`
 }
 
 func (client *App) AddTracks(release discogs.Release, masterReleaseID int, label int) error {
@@ -129,6 +131,7 @@ func composeBatchInputs(tracks []discogs.Track, masterReleaseID int, name string
 			release.Artists,
 			release.ExtraArtists,
 			release.ArtistsSort,
+			0,
 		})
 		if err != nil {
 			return nil, errors.Wrap(err, "failed to marshal track as batch inputs")
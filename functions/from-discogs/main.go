@@ -127,11 +127,19 @@ func Handler(ctx context.Context, evt events.SNSEvent) error {
 
 		log.Printf("Skipped %d, kept: %+v\n", skipped, uniqueMasterReleases)
 
-		err = app.persistReleasesTracks(localLabel, uniqueMasterReleases)
+		stored, err := app.persistReleasesTracks(localLabel, uniqueMasterReleases)
 		if err != nil {
 			return errors.Wrap(err, "failed to persist releases tracks")
 		}
 
+		// to-spotify's scheduler favours labels with recent releases
+		if stored > 0 {
+			err = app.UpdateLabelLastRelease(localLabel.LabelID)
+			if err != nil {
+				return err
+			}
+		}
+
 		localLabel.LastPage += 1
 		isLastPage := localLabel.LastPage > localLabel.MaxPages
 
@@ -224,10 +232,11 @@ func (client *App) populateUniqueMasterReleases(releases *discogs.LabelReleases,
 	return uniqueMasterReleases, skipped, nil
 }
 
-func (client *App) persistReleasesTracks(localLabel LocalLabel, uniqueMasterReleases []int) error {
+func (client *App) persistReleasesTracks(localLabel LocalLabel, uniqueMasterReleases []int) (int, error) {
+	stored := 0
 	for _, masterReleaseId := range uniqueMasterReleases {
 		if alreadyStored, err := client.isMasterReleaseAlreadyStored(localLabel.LabelID, masterReleaseId); err != nil {
-			return err
+			return stored, err
 		} else if alreadyStored {
 			fmt.Println("Already stored")
 			continue
@@ -236,14 +245,15 @@ func (client *App) persistReleasesTracks(localLabel LocalLabel, uniqueMasterRele
 		fmt.Printf("tracks in %d %d\n", masterReleaseId, len(localLabel.MasterReleasesCache[masterReleaseId].Tracklist))
 		err := client.AddTracks(localLabel.MasterReleasesCache[masterReleaseId], masterReleaseId, localLabel.LabelID)
 		if err != nil {
-			return err
+			return stored, err
 		}
 
+		stored += 1
 		localLabel.LabelReleases += 1
 		localLabel.LabelTracks += len(localLabel.MasterReleasesCache[masterReleaseId].Tracklist)
 	}
 
-	return nil
+	return stored, nil
 }
 
 func isReleaseAlreadyStored(releaseId int, localLabel LocalLabel) bool {
@@ -77,6 +77,15 @@ func (client *App) UpdateLabelWithStats(localLabel LocalLabel, isLastPage bool)
 	return errors.Wrap(err, "failed to update label stats")
 }
 
+func (client *App) UpdateLabelLastRelease(labelId int) error {
+	_, err := client.SQLDriver.Exec(fmt.Sprintf(`
+		UPDATE dg_labels
+		SET last_release_datetime = NOW()
+		WHERE label_id = ?
+	`), labelId)
+	return errors.Wrap(err, "failed to update label last release")
+}
+
 func (client *App) GetNextLabel(lastSuccessChannel int) (LocalLabel, error) {
 	l := LocalLabel{}
 	selDB := client.SQLDriver.QueryRow(fmt.Sprintf(`
@@ -7,6 +7,8 @@ import sys
 file_path = os.path.dirname(__file__)
 module_path = os.path.join(file_path, "env")
 sys.path.append(module_path)
+# Shared modules are copied next to main.py in images, this finds them in a checkout
+sys.path.append(os.path.join(file_path, "..", "..", "scripts"))
 
 from pprint import pprint
 from googleapiclient import discovery
@@ -18,6 +20,12 @@ from zoneinfo import ZoneInfo
 
 import boto3
 import pymysql
+from mysql_pool import pool_from_env
+from cursors import cursors_from_env
+from leases import leases_from_env
+from track_parsing import title_fields
+from dynamodb_tables import ThreadLocalTables
+import metrics
 
 # Hide warnings https://github.com/googleapis/google-api-python-client/issues/299
 import logging
@@ -26,34 +34,22 @@ logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
 import json
 
 # DB
-dynamodb = boto3.resource("dynamodb", region_name='eu-west-1')
-sqs_client = boto3.client("sqs", region_name='eu-west-1')
+# mirrorfm_cursors is shared with the lease keep-alive thread: one resource per thread
+dynamodb = ThreadLocalTables('eu-west-1', on_client=metrics.instrument_boto3)
+sqs_client = metrics.instrument_boto3(boto3.client("sqs", region_name='eu-west-1'))
 SQS_TO_SPOTIFY_URL = os.getenv('SQS_TO_SPOTIFY_URL', '')
-mirrorfm_cursors = dynamodb.Table('mirrorfm_cursors')
-mirrorfm_yt_tracks = dynamodb.Table('mirrorfm_yt_tracks')
+mirrorfm_cursors = dynamodb.table('mirrorfm_cursors')
+cursors = cursors_from_env(mirrorfm_cursors)
+# With ENTITY_SHARDS set, this replica only walks the channel shards it holds a lease on
+leases = leases_from_env(mirrorfm_cursors, 'from_youtube',
+                         on_acquire=lambda shard: cursors.forget([channel_cursor_name(shard)]),
+                         on_release=lambda shard: cursors.flush())
+mirrorfm_yt_tracks = dynamodb.table('mirrorfm_yt_tracks')
 
 
-name = os.getenv('DB_USERNAME')
-password = os.getenv('DB_PASSWORD')
-db_name = os.getenv('DB_NAME')
-host = os.getenv('DB_HOST')
-
-
-conn = None
-
-
-def get_conn():
-    global conn
-    if conn is None:
-        conn = pymysql.connect(host=host,
-                               user=name,
-                               passwd=password,
-                               db=db_name,
-                               connect_timeout=5,
-                               cursorclass=pymysql.cursors.DictCursor)
-    else:
-        conn.ping(reconnect=True)
-    return conn
+db_pool = pool_from_env(connect_timeout=5,
+                        cursorclass=metrics.timed_cursor_class(pymysql.cursors.DictCursor))
+metrics.register_pool(db_pool)
 
 scopes = ["https://www.googleapis.com/auth/youtube.readonly"]
 
@@ -112,33 +108,72 @@ def _flush(self):
     print("Batch write sent", len(items_to_send), "unprocessed:", len(self._items_buffer))
 
 
+def channel_cursor_name(shard=None):
+    """Cursors are kept per shard when channels are sharded between replicas."""
+    name = 'from_youtube_last_successful_channel'
+    return name if shard is None else '%s_shard%d' % (name, shard)
+
+
 def get_next_channel():
-    from_youtube_last_successful_channel = mirrorfm_cursors.get_item(
-        Key={
-            'name': 'from_youtube_last_successful_channel'
-        },
-        AttributesToGet=[
-            'value'
-        ]
-    )
-
-    if 'Item' in from_youtube_last_successful_channel and from_youtube_last_successful_channel['Item']['value']:
-        last_channel_id = int(from_youtube_last_successful_channel['Item']['value'])
+    if leases is None:
+        shard = None
+    else:
+        shard = leases.next_shard()
+        if shard is None:
+            # Waiting for other replicas to release shards
+            return None
+    from_youtube_last_successful_channel = cursors.get(channel_cursor_name(shard))
+
+    if from_youtube_last_successful_channel:
+        last_channel_id = int(from_youtube_last_successful_channel)
     else:
         last_channel_id = 1
 
-    cursor = get_conn().cursor()
-    cursor.execute("SELECT * FROM yt_channels WHERE (id > %s or id = 1) order by id = 1, id limit 1" % str(last_channel_id))
-    return cursor.fetchone()
+    with db_pool.cursor() as cursor:
+        if shard is None:
+            cursor.execute("SELECT * FROM yt_channels WHERE (id > %s or id = 1) order by id = 1, id limit 1" % str(last_channel_id))
+        else:
+            cursor.execute("SELECT * FROM yt_channels WHERE MOD(id, %s) = %s ORDER BY id <= %s, id LIMIT 1",
+                           [leases.shards, shard, last_channel_id])
+        return cursor.fetchone()
 
 
 def get_channel(channel_id):
-    cursor = get_conn().cursor()
-    cursor.execute("SELECT * FROM yt_channels WHERE channel_id='%s'" % str(channel_id))
-    return cursor.fetchone()
+    with db_pool.cursor() as cursor:
+        cursor.execute("SELECT * FROM yt_channels WHERE channel_id='%s'" % str(channel_id))
+        return cursor.fetchone()
 
 
 def handle(event, context):
+    if leases is not None:
+        leases.start()
+    if 'Records' in event:
+        # A channel_id was added to the `yt_channels` table
+        channel = get_channel(event['Records'][0]['Sns']['Message'])
+    else:
+        # The lambda was triggered by CRON
+        channel = get_next_channel()
+        if not channel:
+            return {"searched": 0, "found": 0}
+    shard = None if leases is None or not channel else channel['id'] % leases.shards
+    # The shard is only handed over to another replica once the channel is done
+    if shard is not None and not leases.start_work(shard):
+        if 'Records' in event:
+            # Back to the queue (see k3s_runner) until the shard's owner receives it
+            print("Channel %s is in a shard of another replica, requeueing" % channel['channel_id'])
+            return {"searched": 0, "found": 0, "requeue": True}
+        return {"searched": 0, "found": 0}
+    try:
+        if 'Records' not in event:
+            cursors.set(channel_cursor_name(shard), channel['id'])
+        return import_channel(event, channel)
+    finally:
+        if shard is not None:
+            leases.finish_work(shard)
+
+
+def import_channel(event, channel=None):
+    """New uploads of the channel added to `yt_channels` (SNS event), or of the next channel (CRON)."""
     upload_playlist_id = None
     last_upload_datetime = None
     old_yt_count_tracks = 0
@@ -146,16 +181,9 @@ def handle(event, context):
     if 'Records' in event:
         # A channel_id was added to the `yt_channels` table
         channel_id = event['Records'][0]['Sns']['Message']
-        channel = get_channel(channel_id)
+        if channel is None:
+            channel = get_channel(channel_id)
     else:
-        # The lambda was triggered by CRON
-        channel = get_next_channel()
-        mirrorfm_cursors.put_item(
-            Item={
-                'name': 'from_youtube_last_successful_channel',
-                'value': channel['id']
-            }
-        )
         channel_id = channel['channel_id']
         print(channel['channel_name'])
         if 'last_upload_datetime' in channel:
@@ -181,17 +209,17 @@ def handle(event, context):
         youtube = discovery.build("youtube", "v3", developerKey=key)
 
         try:
-            response = youtube.channels().list(
-                part="contentDetails,snippet",
-                id=channel_id
-            ).execute()
+            with metrics.timed("youtube", "channels.list"):
+                response = youtube.channels().list(
+                    part="contentDetails,snippet",
+                    id=channel_id
+                ).execute()
             break
         except Exception as e:
             print(i, key, e)
             if i == len(keys) - 1:
                 raise(Exception("Quota exceeded on all developer keys"))
 
-    cur = get_conn().cursor()
     try:
         upload_playlist_id = response['items'][0]['contentDetails']['relatedPlaylists']['uploads']
         channel_name = response['items'][0]['snippet']['title']
@@ -200,9 +228,9 @@ def handle(event, context):
         # Ignore malformatted event / channel_id
         # It's likely the channel has been removed or terminated
         if not channel['terminated_datetime']:
-            cur.execute("UPDATE yt_channels SET terminated_datetime = NOW() WHERE channel_id = %s",
-                        [channel_id])
-            get_conn().commit()
+            with db_pool.transaction() as cur:
+                cur.execute("UPDATE yt_channels SET terminated_datetime = NOW() WHERE channel_id = %s",
+                            [channel_id])
             print("Set channel as terminated")
         else:
             print("Channel already terminated")
@@ -214,9 +242,9 @@ def handle(event, context):
     thumbnail_medium = thumbnails['medium']['url']
     thumbnail_default = thumbnails['default']['url']
 
-    cur.execute("UPDATE yt_channels SET channel_name = %s, upload_playlist_id = %s, thumbnail_high = %s, thumbnail_medium = %s, thumbnail_default = %s, terminated_datetime = NULL WHERE channel_id = %s",
-                [channel_name, upload_playlist_id, thumbnail_high, thumbnail_medium, thumbnail_default, channel_id])
-    get_conn().commit()
+    with db_pool.transaction() as cur:
+        cur.execute("UPDATE yt_channels SET channel_name = %s, upload_playlist_id = %s, thumbnail_high = %s, thumbnail_medium = %s, thumbnail_default = %s, terminated_datetime = NULL WHERE channel_id = %s",
+                    [channel_name, upload_playlist_id, thumbnail_high, thumbnail_medium, thumbnail_default, channel_id])
 
     if not last_upload_datetime or type(last_upload_datetime) == str:
         process_full_list = True
@@ -232,12 +260,13 @@ def handle(event, context):
     if process_full_list:
         while True:
             try:
-                response = youtube.playlistItems().list(
-                    part="snippet,contentDetails",
-                    playlistId=upload_playlist_id,
-                    maxResults=50,
-                    pageToken=page_token
-                ).execute()
+                with metrics.timed("youtube", "playlistItems.list"):
+                    response = youtube.playlistItems().list(
+                        part="snippet,contentDetails",
+                        playlistId=upload_playlist_id,
+                        maxResults=50,
+                        pageToken=page_token
+                    ).execute()
             except Exception as e:
                 print(e)
                 return {"searched": 1, "found": 0}
@@ -253,13 +282,14 @@ def handle(event, context):
     else:
         while True:
             try:
-                response = youtube.activities().list(
-                    part="snippet,contentDetails",
-                    channelId=channel_id,
-                    maxResults=50,
-                    pageToken=page_token,
-                    publishedAfter=datetime_to_zulu(last_upload_datetime)
-                ).execute()
+                with metrics.timed("youtube", "activities.list"):
+                    response = youtube.activities().list(
+                        part="snippet,contentDetails",
+                        channelId=channel_id,
+                        maxResults=50,
+                        pageToken=page_token,
+                        publishedAfter=datetime_to_zulu(last_upload_datetime)
+                    ).execute()
             except Exception as e:
                 print(e)
                 return {"searched": 1, "found": 0}
@@ -275,13 +305,18 @@ def handle(event, context):
         batch._flush = types.MethodType(_flush, batch)
         for item in new_items_desc:
             track_id = get_video_id(process_full_list, item['contentDetails'])
+            track_name = str(item['snippet']['title'])
             batch.put_item(
                 Item={
                     'yt_channel_id': channel_id,
                     'yt_track_composite': '-'.join([str(item['snippet']['publishedAt']), track_id]),
                     'yt_track_id': track_id,
-                    'yt_track_name': str(item['snippet']['title']),
-                    'yt_published_at': item['snippet']['publishedAt']
+                    'yt_track_name': track_name,
+                    'yt_published_at': item['snippet']['publishedAt'],
+                    # Sparse "pending match" index key, removed by to-spotify on match
+                    'pending_match': 0,
+                    # Parsed once here instead of on every to-spotify search
+                    **title_fields(track_name)
                 }
             )
 
@@ -291,11 +326,10 @@ def handle(event, context):
 
     if next_last_upload_datetime and next_last_upload_datetime != last_upload_datetime:
         count_tracks = old_yt_count_tracks + len(new_items_desc)
-        cur = get_conn().cursor()
-        cur.execute('UPDATE yt_channels SET last_upload_datetime = %s, count_tracks = %s WHERE channel_id = %s',
-                    [next_last_upload_datetime.strftime('%Y-%m-%d %H:%M:%S'), count_tracks, channel_id])
-        res = get_conn().commit()
-        print(res)
+        with db_pool.transaction() as cur:
+            cur.execute('UPDATE yt_channels SET last_upload_datetime = %s, count_tracks = %s WHERE channel_id = %s',
+                        [next_last_upload_datetime.strftime('%Y-%m-%d %H:%M:%S'), count_tracks, channel_id])
+        print("MySQL pool", db_pool.metrics())
         # Notify to-spotify to process this channel's tracks
         if SQS_TO_SPOTIFY_URL and len(new_items_desc) > 0:
             sqs_client.send_message(
@@ -308,6 +342,16 @@ def handle(event, context):
         return {"searched": 1, "found": 0}
 
 
+def shutdown():
+    """Called by the k3s runner before the process exits."""
+    cursors.flush()
+    print("Cursors", cursors.stats)
+    if leases is not None:
+        # Other replicas can take over our shards right away
+        leases.release_all()
+        print("Leases", leases.stats)
+
+
 # Quick local tests
 if __name__ == "__main__":
     # Check next item (CRON mode)
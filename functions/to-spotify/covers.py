@@ -0,0 +1,91 @@
+"""
+Playlist cover images.
+
+Thumbnails are downloaded through one pooled HTTP session and the base64
+JPEG uploaded to Spotify is cached by a hash of the thumbnail URL, so the
+rollover playlists of an entity reuse the cover of the first one.
+"""
+
+import base64
+import hashlib
+import os
+from io import BytesIO
+
+from cache import TTLCache
+
+COVER_SIZE = (300, 300)
+DOWNLOAD_TIMEOUT = 10
+
+
+def cover_key(url, resize):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest() + (":%dx%d" % COVER_SIZE if resize else "")
+
+
+def resize_jpeg(content, size=COVER_SIZE):
+    """
+    Square JPEG of `size` from image bytes. JPEG thumbnails are decoded at
+    the smallest power-of-two reduction still larger than `size` (draft mode)
+    rather than at full resolution.
+    """
+    from PIL import Image
+
+    im = Image.open(BytesIO(content))
+    im.draft("RGB", size)
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    im = im.resize(size, reducing_gap=3.0)
+    buffered = BytesIO()
+    im.save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+class HTTPFetcher:
+    """GET through a single requests.Session, keeping connections to image hosts alive."""
+
+    def __init__(self, pool_size=4, timeout=DOWNLOAD_TIMEOUT):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+
+    def session(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+        return self._session
+
+    def __call__(self, url):
+        res = self.session().get(url, timeout=self.timeout)
+        res.raise_for_status()
+        return res.content
+
+
+class CoverCache:
+    def __init__(self, cache, fetch):
+        self.cache = cache
+        self.fetch = fetch
+        self.downloads = 0
+
+    def get(self, url, resize=False):
+        """Base64 cover for a thumbnail URL, downloaded (and resized) on a cache miss."""
+        key = cover_key(url, resize)
+        encoded = self.cache.get(key)
+        if encoded is None:
+            content = self.fetch(url)
+            self.downloads += 1
+            if resize:
+                content = resize_jpeg(content)
+            encoded = base64.b64encode(content).decode("utf-8")
+            self.cache.set(key, encoded)
+        return encoded
+
+
+def cover_cache_from_env():
+    return CoverCache(TTLCache(maxsize=int(os.getenv("COVER_CACHE_SIZE", "256")),
+                               ttl=int(os.getenv("COVER_CACHE_TTL", "86400"))),
+                      HTTPFetcher())
@@ -9,32 +9,46 @@ import sys
 file_path = os.path.dirname(__file__)
 module_path = os.path.join(file_path, "env")
 sys.path.append(module_path)
+# Shared modules are copied next to main.py in images, this finds them in a checkout
+sys.path.append(os.path.join(file_path, "..", "..", "scripts"))
 
-from trackfilter.cli import split_artist_track
 import spotipy.oauth2 as oauth2
+import spotipy.cache_handler
 import spotipy
 from datetime import datetime, timezone
-import requests
-import base64
 import time
 import decimal
 import json
 from boto3.dynamodb.types import TypeDeserializer
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Attr, Key
 import boto3
 import pymysql
 import random
 import re
-
-db_username = os.getenv('DB_USERNAME')
-db_password = os.getenv('DB_PASSWORD')
-db_name = os.getenv('DB_NAME')
-db_host = os.getenv('DB_HOST')
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 deser = TypeDeserializer()
 
 
-from similarity import TRACK_SIMILARITY_THRESHOLD, is_match
+from similarity import TRACK_SIMILARITY_THRESHOLD, is_match, set_engine
+from ratelimit import RateLimitedSpotify, limiter_from_env, spotify_session
+from cache import TTLCache
+from mysql_pool import pool_from_env
+from cursors import cursors_from_env
+from leases import leases_from_env
+from dynamodb_tables import ThreadLocalTables
+from track_parsing import record_title
+from search_cache import search_cache_from_env, search_cache_key
+from covers import cover_cache_from_env
+from write_behind import WriteBehind
+from stats import StatsStatements, add_playlist_tracks, set_playlist_tracks, update_playlist_stats, upsert_genre_counts
+from scheduler import EntityScheduler, parse_host_weights
+import metrics
+
+# difflib (reference), indel (fastest, scores slightly higher) or compat (difflib decisions at indel speed)
+set_engine(os.getenv('SIMILARITY_ENGINE', 'compat'))
 
 
 # custom exceptions
@@ -66,15 +80,84 @@ class Memoize:
 
 
 PLAYLIST_EXPECTED_MAX_LENGTH = 11000
+# The local track count is checked against Spotify once per entity when it gets this close to the limit
+PLAYLIST_RECONCILE_MARGIN = int(os.getenv('PLAYLIST_RECONCILE_MARGIN', '500'))
+# Spotify accepts up to 100 URIs per add request
+PLAYLIST_ADD_BATCH = 100
+# Unmatched tracks wait RESEARCH_BACKOFF_BASE * 2^(misses - 1) seconds before the next search
+RESEARCH_BACKOFF_BASE = int(os.getenv('RESEARCH_BACKOFF_BASE', str(86400)))
+RESEARCH_BACKOFF_MAX = int(os.getenv('RESEARCH_BACKOFF_MAX', str(180 * 86400)))
+
+# Multi-ID endpoint limits
+ALBUMS_PER_REQUEST = 20
+ARTISTS_PER_REQUEST = 50
+
+# Per-entity duplicate indexes, reused by consecutive handle() calls on the same entity
+duplicate_indexes = TTLCache(maxsize=64, ttl=int(os.getenv('DUPLICATE_INDEX_TTL', '600')))
+duplicate_indexes_lock = threading.Lock()
+# One lock per index being loaded: workers on other entities do not wait for a preload
+duplicate_index_locks = {}
+# (host, entity aid) being processed: a second worker on the same entity (SQS event and
+# rediscovery) waits for the first, instead of racing it on duplicates and rollovers
+entities_in_progress = set()
+entities_done = threading.Condition()
+
+# Search results by normalized query, including "no match" results
+search_cache = search_cache_from_env()
+
+# Encoded playlist covers by thumbnail URL, reused by rollover playlists
+cover_cache = cover_cache_from_env()
+
+# Album/artist genres, kept across handle() calls of the k3s runner
+genre_cache = TTLCache(maxsize=int(os.getenv('GENRE_CACHE_SIZE', '50000')),
+                       ttl=int(os.getenv('GENRE_CACHE_TTL', '604800')))
 WEBSITE = "https://mirror.fm"
 
 BATCH_GET_SIZE = 200
 
+# Unmatched tracks carry PENDING_MATCH (the time they are due for a search) until matched.
+# With PENDING_MATCH_INDEX set to its sparse GSI, only those tracks are read.
+PENDING_MATCH = 'pending_match'
+PENDING_MATCH_INDEX = os.getenv('PENDING_MATCH_INDEX', '')
+
+# Results fetched per search request and re-ranked locally with is_match()
+SEARCH_LIMIT = int(os.getenv('SEARCH_LIMIT', '5'))
+# Retry as free text ("artist track") when the strict track:/artist: query returned no result at all
+SEARCH_FREE_TEXT_FALLBACK = os.getenv('SEARCH_FREE_TEXT_FALLBACK', '0') == '1'
+# Records searched in parallel within a page; writes stay sequential
+LOOKUP_CONCURRENCY = int(os.getenv('LOOKUP_CONCURRENCY', '1'))
+# Entities processed at once by one handle() call in rediscovery mode (1: one entity per call)
+ENTITY_WORKERS = int(os.getenv('ENTITY_WORKERS', '1'))
+# Searches spent on one entity per worker batch, the rest waits for its next turn
+ENTITY_MAX_SEARCHES = int(os.getenv('ENTITY_MAX_SEARCHES', '1000'))
+# Track updates written in parallel by the write-behind buffer
+TRACK_WRITE_CONCURRENCY = int(os.getenv('TRACK_WRITE_CONCURRENCY', '8'))
+# Rediscovery order: "priority" (scored entities, fair between hosts) or "round_robin" (entity cursors)
+ENTITY_SCHEDULER = os.getenv('ENTITY_SCHEDULER', 'priority')
+# Share of the rediscovery picks of each host
+SCHEDULER_HOST_WEIGHTS = parse_host_weights(os.getenv('SCHEDULER_HOST_WEIGHTS', 'yt=1,dg=1'))
+# An entity is searched again after this many seconds at the latest, whatever its score
+SCHEDULER_MAX_WAIT = int(os.getenv('SCHEDULER_MAX_WAIT', str(7 * 86400)))
+# Seconds between two reloads of the entity stats
+SCHEDULER_REFRESH = int(os.getenv('SCHEDULER_REFRESH', '300'))
+
 # DB
-client = boto3.client("dynamodb", region_name='eu-west-1')
-dynamodb = boto3.resource("dynamodb", region_name='eu-west-1')
-cursors_table = dynamodb.Table('mirrorfm_cursors')
-events_table = dynamodb.Table('mirrorfm_events')
+db_pool = pool_from_env(connect_timeout=10,
+                        read_timeout=300,
+                        write_timeout=300,
+                        cursorclass=metrics.timed_cursor_class(pymysql.cursors.DictCursor))
+metrics.register_pool(db_pool)
+client = metrics.instrument_boto3(boto3.client("dynamodb", region_name='eu-west-1'))
+# Tables are used from lookup threads, entity workers and write-behind flushes: one resource per thread
+dynamodb = ThreadLocalTables('eu-west-1', on_client=metrics.instrument_boto3)
+cursors_table = dynamodb.table('mirrorfm_cursors')
+# Track and entity cursors, flushed to mirrorfm_cursors on a budget and at shutdown
+cursors = cursors_from_env(cursors_table)
+# With ENTITY_SHARDS set, this replica only walks the entity shards it holds a lease on
+leases = leases_from_env(cursors_table, 'to_spotify',
+                         on_acquire=lambda shard: forget_shard(shard),
+                         on_release=lambda shard: (cursors.flush(), forget_shard_indexes(shard)))
+events_table = dynamodb.table('mirrorfm_events')
 
 YT_HOST = "yt"
 DG_HOST = "dg"
@@ -82,12 +165,15 @@ DG_HOST = "dg"
 cats = {
     YT_HOST: {
         "key": YT_HOST,
-        "tracks_table": dynamodb.Table('mirrorfm_yt_tracks'),
-        "duplicates_table": dynamodb.Table('mirrorfm_yt_duplicates'),
+        "tracks_table": dynamodb.table('mirrorfm_yt_tracks'),
+        "duplicates_table": dynamodb.table('mirrorfm_yt_duplicates'),
         "entity_id": "channel_id",
         "host_entity_id": "yt_channel_id",
         "host_entity_id_type": str,
         "entity_name": "channel_name",
+        "entity_tracks": "count_tracks",
+        # SQL expressions on the entity table (e), for the scheduler
+        "entity_activity": "e.last_upload_datetime",
         "track_id": "yt_track_id",
         "track_name": "yt_track_name",
         "track_composite": "yt_track_composite",
@@ -103,12 +189,15 @@ cats = {
     },
     DG_HOST: {
         "key": DG_HOST,
-        "tracks_table": dynamodb.Table('mirrorfm_dg_tracks'),
-        "duplicates_table": dynamodb.Table('mirrorfm_dg_duplicates'),
+        "tracks_table": dynamodb.table('mirrorfm_dg_tracks'),
+        "duplicates_table": dynamodb.table('mirrorfm_dg_duplicates'),
         "entity_id": "label_id",
         "host_entity_id": "dg_label_id",
         "host_entity_id_type": int,
         "entity_name": "label_name",
+        "entity_tracks": "label_tracks",
+        # Set by from-discogs when it stores new releases, unset for labels not crawled since
+        "entity_activity": "COALESCE(e.last_release_datetime, e.added_datetime)",
         "track_id": "dg_track_id",
         "track_name": "dg_track_name",
         "track_composite": "dg_track_composite",
@@ -124,6 +213,12 @@ cats = {
     }
 }
 
+# Playlist and genre statistics statements, built once per host
+stats_statements = {
+    key: StatsStatements(cat['playlist_table'], cat['genres_table'], cat['host_entity_id'])
+    for key, cat in cats.items()
+}
+
 # Spotify
 SPOTIPY_CLIENT_ID = os.getenv('SPOTIPY_CLIENT_ID')
 SPOTIPY_CLIENT_SECRET = os.getenv('SPOTIPY_CLIENT_SECRET')
@@ -132,25 +227,69 @@ SPOTIPY_USER = os.getenv('SPOTIPY_USER')
 
 scope = 'playlist-read-private playlist-modify-private playlist-modify-public ugc-image-upload'
 
+# Shared by every handle() of the process (and its lookup threads)
+spotify_limiter = limiter_from_env()
+
 
 def get_cursor(name):
-    return cursors_table.get_item(
-        Key={
-            'name': name
-        },
-        AttributesToGet=[
-            'value'
-        ]
-    )
+    return cursors.get(name)
+
+
+def entity_shard(entity_aid):
+    return None if leases is None else int(entity_aid) % leases.shards
+
+
+def shard_cursor_name(name, shard):
+    """Cursors are kept per shard when entities are sharded between replicas."""
+    return name if shard is None else '%s_shard%d' % (name, shard)
+
+
+def forget_shard(shard):
+    """A shard just claimed may have moved on under another replica: read its cursors and indexes again."""
+    cursors.forget([shard_cursor_name(cats[host][cursor], shard)
+                    for host in cats for cursor in ('cursor_last_successful_entity', 'cursor_start_track_key')])
+    forget_shard_indexes(shard)
+
+
+def forget_shard_indexes(shard):
+    """Duplicate indexes of a shard are only kept up to date by its owner."""
+    evicted = duplicate_indexes.evict(lambda key, index: index.shard == shard)
+    if evicted:
+        print("Forgot %d duplicate index(es) of shard %d" % (evicted, shard))
+
+
+def hold_entity(handler, entity_aid):
+    """
+    False when the entity is in a shard leased by another replica. Otherwise
+    waits until no other worker of this process is on the entity; its shard
+    is only handed over after release_entity(handler).
+    """
+    shard = entity_shard(entity_aid)
+    if shard is not None:
+        if not leases.start_work(shard):
+            return False
+        handler.held_shard = shard
+    key = (handler.current_host, str(entity_aid))
+    with entities_done:
+        entities_done.wait_for(lambda: key not in entities_in_progress)
+        entities_in_progress.add(key)
+    handler.held_entity = key
+    return True
+
+
+def release_entity(handler):
+    if handler.held_entity is not None:
+        with entities_done:
+            entities_in_progress.discard(handler.held_entity)
+            entities_done.notify_all()
+        handler.held_entity = None
+    if handler.held_shard is not None:
+        leases.finish_work(handler.held_shard)
+        handler.held_shard = None
 
 
 def set_cursor(name, position):
-    cursors_table.put_item(
-        Item={
-            'name': name,
-            'value': position
-        }
-    )
+    cursors.set(name, position)
 
 
 def restore_spotify_token():
@@ -163,14 +302,10 @@ def restore_spotify_token():
         ]
     )
     if 'Item' not in res:
-        return 0
+        return None
 
-    token = res['Item']['value']
-    with open("/tmp/.cache", "w+") as f:
-        f.write("%s" % json.dumps(token,
-                                  ensure_ascii=False,
-                                  cls=DecimalEncoder))
-    # print("Restored token: %s" % token)
+    # Decimal -> int/float, as spotipy expects
+    return json.loads(json.dumps(res['Item']['value'], cls=DecimalEncoder))
 
 
 def store_spotify_token(token_info):
@@ -183,42 +318,79 @@ def store_spotify_token(token_info):
     # print("Stored token: %s" % token_info)
 
 
+class DynamoDBTokenCache(spotipy.cache_handler.CacheHandler):
+    """
+    Keeps the token in memory for the lifetime of the process.
+    Read from mirrorfm_cursors once, written back only when spotipy
+    refreshed it. Never touches the filesystem.
+    """
+
+    def __init__(self):
+        self.token_info = None
+
+    def get_cached_token(self):
+        if self.token_info is None:
+            self.token_info = restore_spotify_token()
+        return self.token_info
+
+    def save_token_to_cache(self, token_info):
+        self.token_info = token_info
+        store_spotify_token(token_info)
+
+
+spotify_client = None
+
+
 def get_spotify():
-    restore_spotify_token()
+    """One client per process (or warm Lambda container), refreshed by spotipy near expiry."""
+    global spotify_client
+    if spotify_client is not None:
+        return spotify_client
 
     sp_oauth = oauth2.SpotifyOAuth(
         SPOTIPY_CLIENT_ID,
         SPOTIPY_CLIENT_SECRET,
         SPOTIPY_REDIRECT_URI,
         scope=scope,
-        cache_path='/tmp/.cache'
+        cache_handler=DynamoDBTokenCache()
     )
 
     token_info = sp_oauth.get_cached_token()
     if not token_info:
         raise (Exception('null token_info'))
-    store_spotify_token(token_info)
 
-    # Use auth_manager instead of static token so spotipy auto-refreshes on 401
-    return spotipy.Spotify(auth_manager=sp_oauth, retries=3, status_retries=3)
+    # Use auth_manager instead of static token so spotipy auto-refreshes on 401.
+    # The session retries 5xx only: a 429 reaches the rate limiter, which pauses
+    # the bucket (on every replica) for the Retry-After.
+    sp = spotipy.Spotify(auth_manager=sp_oauth, requests_session=spotify_session(retries=3))
+    spotify_client = RateLimitedSpotify(
+        sp, spotify_limiter,
+        observe=lambda method, seconds, error: metrics.observe_call('spotify', method, seconds, error))
+    return spotify_client
+
+
+def search_queries(track, artist):
+    """Query variants for one track, strictest first."""
+    queries = ['track:{0} artist:{1}'.format(track, artist)]
+    if SEARCH_FREE_TEXT_FALLBACK:
+        queries.append('{0} {1}'.format(artist, track))
+    return queries
 
 
-def find_youtube_track_on_spotify(handler, track_name):
-    artist_and_track = split_artist_track(track_name)
-    if artist_and_track is not None and len(artist_and_track) > 1:
-        track = '{0[1]}'.format(artist_and_track).strip()
-        artist = '{0[0][0]}'.format(artist_and_track).strip()
-        query = 'track:{0} artist:{1}'.format(track, artist)
+def find_youtube_track_on_spotify(handler, track_name, parsed, match, is_duplicate):
+    if parsed:
+        artists, track = parsed
+        queries = search_queries(track, artists[0])
     else:
         print("[?]", track_name)
-        query = track_name
-    return find_track_on_spotify(handler, query)
+        queries = [track_name]
+    return find_track_on_spotify(handler, queries, match, is_duplicate)
 
 
-def find_discogs_track_on_spotify(handler, track_name, artist):
+def find_discogs_track_on_spotify(handler, track_name, artist, match, is_duplicate):
     artist = cleanse_artist(artist)
-    query = 'track:{0} artist:{1}'.format(track_name.strip(), artist.strip())
-    return find_track_on_spotify(handler, query)
+    queries = search_queries(track_name.strip(), artist.strip())
+    return find_track_on_spotify(handler, queries, match, is_duplicate)
 
 
 def cleanse_artist(artist):
@@ -227,20 +399,108 @@ def cleanse_artist(artist):
     return re.sub(r"\(.*\)", "", artist).strip()
 
 
-def find_track_on_spotify(handler, query):
-    if len(query) > 100:
-        print("Length was > 100", len(query), query)
-        return
-    try:
-        results = handler.sp.search(query, limit=1, type='track')
-    except Exception as e:
-        print(e)
-        if e.args[0] == 404:
-            # TODO sometimes length > 100 with special characters
-            return
-        raise e
-    for _, spotify_track in enumerate(results['tracks']['items']):
-        return spotify_track
+def find_track_on_spotify(handler, queries, match, is_duplicate):
+    """
+    Search each query variant in turn, score the top SEARCH_LIMIT results
+    locally and return the best passing candidate that is not a duplicate.
+    A looser variant is only searched when the previous ones returned no
+    result at all, so misses on tracks Spotify does return cost one call.
+    Results come from search_cache when the same normalized query was
+    searched recently.
+
+    Returns:
+        (spotify_track, score, calls, cached_until) — spotify_track is None when
+        nothing matched, calls is the number of search requests spent and
+        cached_until, when every result came from search_cache, the time the
+        first of them expires (searching again before that gives the same results)
+    """
+    calls = 0
+    cached_until = None
+    returned = False
+    for query in queries:
+        if returned:
+            break
+        if len(query) > 100:
+            print("Length was > 100", len(query), query)
+            continue
+        cache_key = search_cache_key(query, SEARCH_LIMIT)
+        items = search_cache.get(cache_key)
+        cached = items is not None
+        if cached:
+            # Expired or evicted since the get(): due right away
+            expires_at = search_cache.expires_at(cache_key) or time.time()
+            cached_until = expires_at if cached_until is None else min(cached_until, expires_at)
+        else:
+            calls += 1
+            try:
+                results = handler.sp.search(query, limit=SEARCH_LIMIT, type='track')
+            except Exception as e:
+                print(e)
+                if e.args[0] == 404:
+                    # TODO sometimes length > 100 with special characters
+                    continue
+                raise e
+            items = results['tracks']['items']
+        returned = len(items) > 0
+        scored = []
+        for spotify_track in items:
+            passes, score = match(spotify_track)
+            if passes:
+                scored.append((score, spotify_track))
+        if not cached:
+            search_cache.set(cache_key, items, matched=len(scored) > 0)
+        scored.sort(key=lambda candidate: candidate[0], reverse=True)
+        for score, spotify_track in scored:
+            if not is_duplicate(spotify_track):
+                return spotify_track, score, calls, None
+    return None, None, calls, cached_until if calls == 0 else None
+
+
+class EntityContext(object):
+    """
+    The entity being processed and its current playlist, read from MySQL once
+    per entity and updated in place when a playlist is created, so matched
+    tracks do not re-select the entity or playlist rows.
+    """
+
+    def __init__(self, host, row):
+        self.host = host
+        self.row = row
+        self.aid = row['id']
+        self.entity_id = row[cats[host]['entity_id']]
+        self.name = row[cats[host]['entity_name']]
+        self.playlist = None
+        self.playlist_num = None
+        self.track_count = 0
+        self.track_count_checked = False
+        self.playlist_loaded = False
+
+    def set_playlist(self, item, num, track_count=0, checked=False):
+        self.playlist = item
+        self.playlist_num = num
+        self.track_count = track_count
+        self.track_count_checked = checked
+        self.playlist_loaded = True
+
+
+def load_entity(handler, entity_id):
+    cursor = handler.conn.cursor()
+    cursor.execute(
+        "SELECT * FROM " + cats[handler.current_host]['entity_table'] + " WHERE "
+        + cats[handler.current_host]['entity_id'] + "=%s", entity_id)
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return EntityContext(handler.current_host, row)
+
+
+def current_playlist(handler):
+    """Last playlist of the entity, selected on first use only. (None, None) if it has none yet."""
+    entity = handler.entity
+    if not entity.playlist_loaded:
+        item, num = get_last_playlist(handler, entity.entity_id)
+        entity.set_playlist(item, num, (item['found_tracks'] or 0) if item else 0)
+    return entity.playlist, entity.playlist_num
 
 
 def get_last_playlist(handler, entity_id):
@@ -253,41 +513,15 @@ def get_last_playlist(handler, entity_id):
     return [playlist, playlist['num']]  # full item, num
 
 
-def get_as_base64(url):
-    return base64.b64encode(requests.get(url).content).decode("utf-8")
-
-
-def resize_as_base64(url):
-    from PIL import Image
-    from io import BytesIO
-    from urllib.request import urlopen
-
-    im = Image.open(urlopen(url))
-    new_image = im.resize((300, 300))
-    buffered = BytesIO()
-    new_image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue())
-
-
-def add_channel_cover_to_playlist(handler, entity_id, playlist_id):
-    cursor = handler.conn.cursor()
-    cursor.execute('SELECT * FROM ' + cats[handler.current_host]['entity_table'] + ' WHERE '
-                   + cats[handler.current_host]['entity_id'] + '="%s"' % entity_id)
-    row = cursor.fetchone()
-    if row:
-        thumbnail = row['thumbnail_medium']
-        b64 = (resize_as_base64(thumbnail) if cats[handler.current_host]['thumbnail_needs_resize']
-               else get_as_base64(thumbnail))
+def add_channel_cover_to_playlist(handler, playlist_id):
+    row = handler.entity.row
+    if row.get('thumbnail_medium'):
+        b64 = cover_cache.get(row['thumbnail_medium'], resize=cats[handler.current_host]['thumbnail_needs_resize'])
         return handler.sp.playlist_upload_cover_image(playlist_id, b64)
 
 
 def create_playlist(handler, entity_id, num=1):
-    cursor = handler.conn.cursor()
-    cursor.execute("SELECT * FROM " + cats[handler.current_host]['entity_table'] + " WHERE "
-                   + cats[handler.current_host]['entity_id'] + "='%s'" % entity_id)
-    row = cursor.fetchone()
-
-    playlist_name = row[cats[handler.current_host]['entity_name']]
+    playlist_name = handler.entity.name
     if num > 1:
         playlist_name += ' (%d)' % num
     res = handler.sp.user_playlist_create(SPOTIPY_USER, playlist_name, public=True)
@@ -299,79 +533,202 @@ def create_playlist(handler, entity_id, num=1):
     }
     cur = handler.conn.cursor()
     cur.execute('insert into ' + cats[handler.current_host]['playlist_table']
-                + ' (' + cats[handler.current_host]['entity_id'] + ', num, spotify_playlist) values(%s, %s, %s)',
+                + ' (' + cats[handler.current_host]['entity_id'] + ', num, spotify_playlist, found_tracks)'
+                + ' values(%s, %s, %s, 0)',
                 [entity_id, num, playlist_id])
-    handler.conn.commit()
+    handler.entity.set_playlist(item, num, checked=True)
     try:
-        add_channel_cover_to_playlist(handler, entity_id, playlist_id)
-        add_channel_cover_to_playlist(handler, entity_id, playlist_id)
+        add_channel_cover_to_playlist(handler, playlist_id)
     except Exception as e:
         print(e)
     return [item, num]
 
 
 def get_playlist(handler, entity_id):
-    pl, num = get_last_playlist(handler, entity_id)
+    pl, num = current_playlist(handler)
     if pl:
         return pl, num
     return create_playlist(handler, entity_id)
 
 
+def uri_hash(track_spotify_uri):
+    return int.from_bytes(hashlib.blake2b(str(track_spotify_uri).encode(), digest_size=8).digest(), 'big')
+
+
+class DuplicateIndex:
+    """
+    Duplicate-index keys of one entity, loaded with one paginated Query and
+    kept as 64-bit hashes. A miss is final, a hit is confirmed with get_item
+    since two URIs can share a hash.
+    """
+
+    def __init__(self, host, entity_id, shard=None):
+        self.host = host
+        self.entity_id = entity_id
+        self.shard = shard
+        self.hashes = set()
+        self._load()
+
+    def _load(self):
+        cat = cats[self.host]
+        kwargs = {
+            'KeyConditionExpression': Key(cat['host_entity_id']).eq(self.entity_id),
+            'ProjectionExpression': '#uri',
+            'ExpressionAttributeNames': {'#uri': cat['duplicate_spotify_id']},
+        }
+        while True:
+            res = cat['duplicates_table'].query(**kwargs)
+            self.hashes.update(uri_hash(item[cat['duplicate_spotify_id']]) for item in res['Items'])
+            if 'LastEvaluatedKey' not in res:
+                break
+            kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+    def contains(self, track_spotify_uri):
+        if uri_hash(track_spotify_uri) not in self.hashes:
+            return False
+        table = cats[self.host]['duplicates_table']
+        return 'Item' in table.get_item(
+            Key={
+                cats[self.host]['host_entity_id']: self.entity_id,
+                cats[self.host]['duplicate_spotify_id']: track_spotify_uri
+            }
+        )
+
+    def add(self, track_spotify_uris):
+        self.hashes.update(uri_hash(uri) for uri in track_spotify_uris)
+
+    def discard(self, track_spotify_uris):
+        self.hashes.difference_update(uri_hash(uri) for uri in track_spotify_uris)
+
+
+def get_duplicate_index(host, entity_id, shard=None):
+    key = (host, str(entity_id))
+    index = duplicate_indexes.get(key)
+    if index is not None:
+        return index
+    with duplicate_indexes_lock:
+        key_lock = duplicate_index_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        # Loaded by another worker while we waited
+        index = duplicate_indexes.get(key)
+        if index is None:
+            index = DuplicateIndex(host, entity_id, shard)
+            duplicate_indexes.set(key, index)
+    with duplicate_indexes_lock:
+        duplicate_index_locks.pop(key, None)
+    return index
+
+
 def is_track_duplicate(handler, entity_id, track_spotify_uri):
+    return get_duplicate_index(handler.current_host, entity_id,
+                               entity_shard(handler.entity.aid)).contains(track_spotify_uri)
+
+
+def add_tracks_to_duplicate_index(handler, entity_id, track_spotify_uris, spotify_playlist):
     table = cats[handler.current_host]['duplicates_table']
-    return 'Item' in table.get_item(
-        Key={
-            cats[handler.current_host]['host_entity_id']: entity_id,
-            cats[handler.current_host]['duplicate_spotify_id']: track_spotify_uri
-        }
-    )
+    with table.batch_writer() as batch:
+        for track_spotify_uri in track_spotify_uris:
+            batch.put_item(
+                Item={
+                    cats[handler.current_host]['host_entity_id']: entity_id,
+                    cats[handler.current_host]['duplicate_spotify_id']: track_spotify_uri,
+                    'spotify_playlist': spotify_playlist
+                }
+            )
+    get_duplicate_index(handler.current_host, entity_id, entity_shard(handler.entity.aid)).add(track_spotify_uris)
 
 
-def add_track_to_duplicate_index(handler, entity_id, track_spotify_uri, spotify_playlist):
+def remove_tracks_from_duplicate_index(handler, entity_id, track_spotify_uris):
     table = cats[handler.current_host]['duplicates_table']
-    table.put_item(
-        Item={
-            cats[handler.current_host]['host_entity_id']: entity_id,
-            cats[handler.current_host]['duplicate_spotify_id']: track_spotify_uri,
-            'spotify_playlist': spotify_playlist
-        }
-    )
+    with table.batch_writer() as batch:
+        for track_spotify_uri in track_spotify_uris:
+            batch.delete_item(
+                Key={
+                    cats[handler.current_host]['host_entity_id']: entity_id,
+                    cats[handler.current_host]['duplicate_spotify_id']: track_spotify_uri
+                }
+            )
+    get_duplicate_index(handler.current_host, entity_id,
+                        entity_shard(handler.entity.aid)).discard(track_spotify_uris)
 
 
-def playlist_seems_full(e, handler, spotify_playlist):
-    if hasattr(e, 'http_status') and e.http_status in [403, 500]:
-        return False
-    # only query Spotify total as a last resort
+def reconcile_track_count(handler, spotify_playlist):
+    """Replace the local track count of the current playlist with Spotify's total."""
     # https://github.com/spotify/web-api/issues/1179
     playlist = handler.sp.user_playlist(SPOTIPY_USER, spotify_playlist, "tracks")
     total = playlist["tracks"]["total"]
-    return total == PLAYLIST_EXPECTED_MAX_LENGTH
+    handler.entity.track_count = total
+    handler.entity.track_count_checked = True
+    set_playlist_tracks(handler.conn.cursor(), stats_statements[handler.current_host], spotify_playlist, total)
+    return total
 
 
-def add_track_to_spotify_playlist(handler, track_spotify_uri, entity_id):
-    item, playlist_num = get_playlist(handler, entity_id)
-    spotify_playlist = item['spotify_playlist']
+def playlist_room(handler, spotify_playlist, count):
+    """
+    Slots left in the current playlist according to its local track count,
+    checked against Spotify once per entity when `count` more tracks bring it close to full.
+    """
+    entity = handler.entity
+    if not entity.track_count_checked \
+            and entity.track_count + count > PLAYLIST_EXPECTED_MAX_LENGTH - PLAYLIST_RECONCILE_MARGIN:
+        reconcile_track_count(handler, spotify_playlist)
+    return max(0, PLAYLIST_EXPECTED_MAX_LENGTH - entity.track_count)
+
+
+def write_playlist_tracks(handler, entity_id, spotify_playlist, track_spotify_uris):
     # Write duplicate index BEFORE adding to playlist.
     # If we crash after this but before the add, the track is skipped next time
     # (missed is better than duplicated).
-    add_track_to_duplicate_index(handler,
-                                 entity_id,
-                                 track_spotify_uri,
-                                 spotify_playlist)
+    add_tracks_to_duplicate_index(handler,
+                                  entity_id,
+                                  track_spotify_uris,
+                                  spotify_playlist)
     try:
+        # Reversed at position 0: same order as adding them one by one
         handler.sp.user_playlist_add_tracks(SPOTIPY_USER,
                                             spotify_playlist,
-                                            [track_spotify_uri],
+                                            list(reversed(track_spotify_uris)),
                                             position=0)
+    except spotipy.SpotifyException:
+        # Refused by the API (429, 5xx, 403...): nothing was added, so the
+        # tracks must be matched again on the next run
+        remove_tracks_from_duplicate_index(handler, entity_id, track_spotify_uris)
+        handler.added_uris.difference_update(track_spotify_uris)
+        raise
+    handler.entity.track_count += len(track_spotify_uris)
+    add_playlist_tracks(handler.conn.cursor(), stats_statements[handler.current_host],
+                        spotify_playlist, len(track_spotify_uris))
+
+
+def add_tracks_to_spotify_playlist(handler, track_spotify_uris, entity_id):
+    """
+    Add up to PLAYLIST_ADD_BATCH tracks in one request, oldest match first.
+    The next playlist is created as soon as the current one's track count
+    reaches PLAYLIST_EXPECTED_MAX_LENGTH, before Spotify refuses an add.
+    Returns the playlist each track went to, in the same order.
+    """
+    item, playlist_num = get_playlist(handler, entity_id)
+    spotify_playlist = item['spotify_playlist']
+    room = playlist_room(handler, spotify_playlist, len(track_spotify_uris))
+    if room < len(track_spotify_uris):
+        # Fill the current playlist, the rest of the chunk goes to the next one
+        head, tail = track_spotify_uris[:room], track_spotify_uris[room:]
+        if head:
+            write_playlist_tracks(handler, entity_id, spotify_playlist, head)
+        create_playlist(handler, entity_id, playlist_num + 1)
+        return [spotify_playlist] * len(head) + add_tracks_to_spotify_playlist(handler, tail, entity_id)
+    try:
+        write_playlist_tracks(handler, entity_id, spotify_playlist, track_spotify_uris)
     except Exception as e:
-        if playlist_seems_full(e, handler, spotify_playlist):
-            spotify_playlist, _ = create_playlist(handler, entity_id, playlist_num + 1)
-            # retry same function to use API limit logic
-            add_track_to_spotify_playlist(handler, track_spotify_uri, entity_id)
-        else:
+        if getattr(e, 'http_status', None) in [403, 500] or handler.entity.track_count_checked:
             # Reached API limit?
             raise e
-    return spotify_playlist
+        # The local count may be behind (tracks added elsewhere): Spotify's total decides
+        reconcile_track_count(handler, spotify_playlist)
+        if playlist_room(handler, spotify_playlist, len(track_spotify_uris)) >= len(track_spotify_uris):
+            raise e
+        return add_tracks_to_spotify_playlist(handler, track_spotify_uris, entity_id)
+    return [spotify_playlist] * len(track_spotify_uris)
 
 
 def count_frequency(items):
@@ -384,16 +741,48 @@ def count_frequency(items):
     return freq
 
 
-def find_genres(handler, info, new_track_genres):
-    album = handler.sp.album(info['album']['id'])
-    song_genres = album['genres']
+def chunks(l, n):
+    """Yield successive n-sized chunks from l."""
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
 
-    for artist in info['artists']:
-        info = handler.sp.artist(artist['id'])
-        song_genres = song_genres + info['genres']
 
-    new_track_genres += song_genres
-    return song_genres
+def fetch_genres(fetch, key, ids, size):
+    """
+    Genres by ID for albums or artists, from genre_cache or from the
+    multi-ID endpoint `fetch` (sp.albums / sp.artists), `size` IDs per request.
+    """
+    genres = {}
+    missing = []
+    for spotify_id in dict.fromkeys(i for i in ids if i):
+        cached = genre_cache.get((key, spotify_id))
+        if cached is None:
+            missing.append(spotify_id)
+        else:
+            genres[spotify_id] = cached
+    for chunk in chunks(missing, size):
+        for obj in fetch(chunk)[key]:
+            # Unknown IDs come back as null
+            if obj:
+                genres[obj['id']] = obj['genres']
+                genre_cache.set((key, obj['id']), obj['genres'])
+    return genres
+
+
+def find_genres(handler, infos):
+    """Album + artist genres of each track, in the same order."""
+    album_genres = fetch_genres(handler.sp.albums, 'albums',
+                                [info['album']['id'] for info in infos], ALBUMS_PER_REQUEST)
+    artist_genres = fetch_genres(handler.sp.artists, 'artists',
+                                 [artist['id'] for info in infos for artist in info['artists']],
+                                 ARTISTS_PER_REQUEST)
+    tracks_genres = []
+    for info in infos:
+        song_genres = list(album_genres.get(info['album']['id'], []))
+        for artist in info['artists']:
+            song_genres = song_genres + artist_genres.get(artist['id'], [])
+        tracks_genres.append(song_genres)
+    return tracks_genres
 
 
 def get_first_artist(record):
@@ -408,71 +797,134 @@ def get_first_artist(record):
     return record["release_artistssort"]
 
 
-def spotify_lookup(handler, record, new_track_genres):
+def search_record(handler, record):
+    """
+    Read-only half of a lookup: search and verify.
+    Safe to run concurrently for records of the same entity.
+
+    Returns:
+        dict with the search "calls" spent and, on a match, "track",
+        "similarity" and "track_name", on a miss served from search_cache,
+        "cached_until"
+    """
+    entity_id = record[cats[handler.current_host]['host_entity_id']]
     if cats[handler.current_host]['track_parsing_needed']:
         raw_track_name = record[cats[handler.current_host]['track_name']]
-        spotify_track_info = find_youtube_track_on_spotify(handler, raw_track_name)
-        # Use trackfilter-parsed name for similarity comparison (strips years, video tags, etc.)
-        parsed = split_artist_track(raw_track_name)
-        if parsed and len(parsed) > 1:
-            artists = " ".join(parsed[0]) if isinstance(parsed[0], list) else parsed[0]
-            track_name = artists + " - " + parsed[1]
+        # Use trackfilter-parsed name for similarity comparison (strips years, video tags, etc.),
+        # as stored by from-youtube unless it was parsed by another trackfilter version
+        parsed = record_title(record, cats[handler.current_host]['track_name'])
+        if parsed:
+            track_name = " ".join(parsed[0]) + " - " + parsed[1]
+            # YouTube: use trackfilter-parsed parts
+            first_yt_artist = parsed[0][0]
         else:
             track_name = raw_track_name
+            first_yt_artist = None
     else:
         if 'title' in record and record['title'] is None or 'title' not in record:
             # Discogs can have None title
-            return False
+            return {"calls": 0}
         artist = get_first_artist(record)
-        # TODO remove number in `Artist (number)`
-        spotify_track_info = find_discogs_track_on_spotify(handler, record['title'], artist)
         track_name = artist + " - " + record['title']
-    tracks_table = cats[handler.current_host]['tracks_table']
+        # Discogs: structured data, no multi-artist fallback needed
+        first_yt_artist = None
 
-    # Safety duplicate check needed because
-    # some duplicates were found in some playlists for unknown reasons.
-    if spotify_track_info and not is_track_duplicate(handler,
-                                                     record[cats[handler.current_host]['host_entity_id']],
-                                                     spotify_track_info['uri']):
-        # Extract artist/track parts for similarity check
-        sp_artists = [a['name'] for a in spotify_track_info['artists']]
+    # Extract artist/track parts for similarity check
+    yt_artists_joined = track_name.split(" - ", 1)[0] if " - " in track_name else track_name
+    yt_track_part = track_name.split(" - ", 1)[1] if " - " in track_name else ""
 
-        if cats[handler.current_host]['track_parsing_needed']:
-            # YouTube: use trackfilter-parsed parts
-            yt_artists_joined = track_name.split(" - ", 1)[0] if " - " in track_name else track_name
-            yt_track_part = track_name.split(" - ", 1)[1] if " - " in track_name else ""
-            first_yt_artist = (parsed[0][0] if isinstance(parsed[0], list) else parsed[0]) if parsed and len(parsed) > 1 else None
-        else:
-            # Discogs: structured data, no multi-artist fallback needed
-            yt_artists_joined = track_name.split(" - ", 1)[0] if " - " in track_name else track_name
-            yt_track_part = track_name.split(" - ", 1)[1] if " - " in track_name else ""
-            first_yt_artist = None
-
-        passes, similarity = is_match(
+    def match(spotify_track):
+        sp_artists = [a['name'] for a in spotify_track['artists']]
+        # Most results fail: the threshold-bounded check rejects them early
+        passes, score = is_match(
             yt_artists_joined, yt_track_part,
-            sp_artists, spotify_track_info['name'],
+            sp_artists, spotify_track['name'],
             first_yt_artist=first_yt_artist,
+            exact=False,
         )
-
         if not passes:
-            return
+            return passes, score
+        # Passing results are ranked (and the score stored) on their best score
+        return is_match(
+            yt_artists_joined, yt_track_part,
+            sp_artists, spotify_track['name'],
+            first_yt_artist=first_yt_artist,
+        )
 
-        print(
-            "[√]",
-            spotify_track_info['uri'],
-            spotify_track_info['artists'][0]['name'],
-            "-",
-            spotify_track_info['name'],
-            "\n\t\t\t\t\t",
-            track_name,
-            "\n\t\t\t\t\t",
-            similarity)
-        genres = find_genres(handler, spotify_track_info, new_track_genres)
-        spotify_playlist = add_track_to_spotify_playlist(
-            handler, spotify_track_info['uri'], record[cats[handler.current_host]['host_entity_id']])
-        tracks_table.update_item(
+    # Safety duplicate check needed because
+    # some duplicates were found in some playlists for unknown reasons.
+    def is_duplicate(spotify_track):
+        return is_track_duplicate(handler, entity_id, spotify_track['uri'])
+
+    if cats[handler.current_host]['track_parsing_needed']:
+        spotify_track_info, similarity, calls, cached_until = find_youtube_track_on_spotify(
+            handler, raw_track_name, parsed, match, is_duplicate)
+    else:
+        # TODO remove number in `Artist (number)`
+        spotify_track_info, similarity, calls, cached_until = find_discogs_track_on_spotify(
+            handler, record['title'], artist, match, is_duplicate)
+    if not spotify_track_info:
+        return {"calls": calls, "cached_until": cached_until}
+
+    return {
+        "calls": calls,
+        "track": spotify_track_info,
+        "similarity": similarity,
+        "track_name": track_name,
+    }
+
+
+def apply_match(handler, record, found, new_track_genres):
+    """
+    Queue a match for the next playlist flush.
+    Must run in record order, one record at a time per entity.
+    """
+    spotify_track_info = found['track']
+    if spotify_track_info['uri'] in handler.added_uris:
+        # Another record of this run already matched the same track
+        return False
+
+    print(
+        "[√]",
+        spotify_track_info['uri'],
+        spotify_track_info['artists'][0]['name'],
+        "-",
+        spotify_track_info['name'],
+        "\n\t\t\t\t\t",
+        found['track_name'],
+        "\n\t\t\t\t\t",
+        found['similarity'],
+        "(%d search call(s))" % found['calls'])
+    handler.added_uris.add(spotify_track_info['uri'])
+    handler.pending_adds.append((record, found))
+    if len(handler.pending_adds) >= PLAYLIST_ADD_BATCH:
+        flush_playlist_adds(handler, new_track_genres)
+    return True
+
+
+def flush_playlist_adds(handler, new_track_genres):
+    """
+    Write queued matches: genres for the whole chunk, duplicate index,
+    one playlist add per chunk, then queue the track updates.
+    """
+    pending, handler.pending_adds = handler.pending_adds, []
+    if not pending:
+        return
+    entity_id = pending[0][0][cats[handler.current_host]['host_entity_id']]
+    tracks_table = cats[handler.current_host]['tracks_table']
+    infos = [found['track'] for _, found in pending]
+    for (_, found), genres in zip(pending, find_genres(handler, infos)):
+        found['genres'] = genres
+        new_track_genres += genres
+    spotify_playlists = add_tracks_to_spotify_playlist(
+        handler, [found['track']['uri'] for _, found in pending], entity_id)
+
+    for (record, found), spotify_playlist in zip(pending, spotify_playlists):
+        spotify_track_info = found['track']
+        handler.track_writes.add(
+            tracks_table,
             Key={
-                cats[handler.current_host]['host_entity_id']: record[cats[handler.current_host]['host_entity_id']],
+                cats[handler.current_host]['host_entity_id']: entity_id,
                 cats[handler.current_host]['track_composite']: record[cats[handler.current_host]['track_composite']]
             },
             UpdateExpression="set spotify_uri = :spotify_uri,\
@@ -480,79 +932,252 @@ def spotify_lookup(handler, record, new_track_genres):
                 spotify_found_time = :spotify_found_time,\
                 %s = :%s,\
                 spotify_track_info = :spotify_track_info,\
-                genres = :genres" % (cats[handler.current_host]['track_name'],
-                                     cats[handler.current_host]['track_name']),
+                genres = :genres\
+                remove %s" % (cats[handler.current_host]['track_name'],
+                              cats[handler.current_host]['track_name'],
+                              PENDING_MATCH),
             ExpressionAttributeValues={
                 ':spotify_uri': spotify_track_info['uri'],
                 ':spotify_playlist': spotify_playlist,
-                ':genres': genres,
+                ':genres': found['genres'],
                 ':spotify_found_time': datetime.now(timezone.utc).isoformat(),
-                ':%s' % cats[handler.current_host]['track_name']: track_name,
+                ':%s' % cats[handler.current_host]['track_name']: found['track_name'],
                 ':spotify_track_info': spotify_track_info
             }
         )
-        return True
+
+
+def lookup_records(handler, records, new_track_genres):
+    """
+    Search up to LOOKUP_CONCURRENCY records at once, then queue the matches
+    in record order and flush them in chunks, so playlist writes keep their
+    order and the duplicate index is still written before each add.
+
+    Returns:
+        (searched, added)
+    """
+    records = [record for record in records if 'spotify_uri' not in record]
+    # New uploads first, then re-searches by number of past misses
+    records.sort(key=lambda record: (int(record.get('search_attempts', 0)), int(record.get('next_search_time', 0))))
+    searched = added = 0
+    pool = ThreadPoolExecutor(max_workers=LOOKUP_CONCURRENCY)
+    try:
+        results = pool.map(lambda record: search_record(handler, record), records)
+        for record, found in zip(records, results):
+            searched += 1
+            handler.search_calls += found['calls']
+            if 'track' not in found:
+                schedule_research(handler, record, found.get('cached_until'))
+            elif apply_match(handler, record, found, new_track_genres):
+                added += 1
+    finally:
+        # Stop pending searches if a write failed (e.g. API limit reached)
+        pool.shutdown(wait=True, cancel_futures=True)
+    # Before the caller saves its cursor past these records
+    flush_playlist_adds(handler, new_track_genres)
+    return searched, added
+
+
+def research_delay(attempts):
+    """Seconds before an unmatched track is searched again after `attempts` misses."""
+    return min(RESEARCH_BACKOFF_BASE * 2 ** (attempts - 1), RESEARCH_BACKOFF_MAX)
+
+
+def schedule_research(handler, record, cached_until=None):
+    """
+    Record a search without match and when the track is due again.
+    A miss served from search_cache (`cached_until` set) is no new attempt:
+    the track is due once the cached results expire, its backoff unchanged.
+    """
+    if cached_until is None:
+        attempts = int(record.get('search_attempts', 0)) + 1
+        next_search_time = int(time.time()) + research_delay(attempts)
+    else:
+        attempts = int(record.get('search_attempts', 0))
+        next_search_time = int(cached_until) + 1
+    if handler.next_due is None or next_search_time < handler.next_due:
+        handler.next_due = next_search_time
+    handler.track_writes.add(
+        cats[handler.current_host]['tracks_table'],
+        Key={
+            cats[handler.current_host]['host_entity_id']: record[cats[handler.current_host]['host_entity_id']],
+            cats[handler.current_host]['track_composite']: record[cats[handler.current_host]['track_composite']]
+        },
+        UpdateExpression="set search_attempts = :search_attempts, next_search_time = :next_search_time, "
+                         "%s = :next_search_time" % PENDING_MATCH,
+        ExpressionAttributeValues={
+            ':search_attempts': attempts,
+            ':next_search_time': next_search_time
+        }
+    )
+
+
+def epoch(value):
+    """MySQL DATETIME (UTC) as epoch seconds, None when unset."""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc).timestamp()
+    return None
+
+
+def load_entity_stats(host):
+    """What the scheduler scores entities on: track counts, matches, last search and last upload."""
+    cat = cats[host]
+    with db_pool.cursor() as cur:
+        cur.execute("SELECT e.id, e." + cat['entity_name'] + " AS name, e." + cat['entity_tracks'] + " AS tracks, "
+                    + cat['entity_activity'] + " AS last_activity, e.last_pick_datetime AS last_pick, "
+                    + "COALESCE(SUM(p.found_tracks), 0) AS found, MAX(p.last_search_time) AS last_search "
+                    + "FROM " + cat['entity_table'] + " e LEFT JOIN " + cat['playlist_table'] + " p "
+                    + "ON p." + cat['entity_id'] + " = e." + cat['entity_id'] + " GROUP BY e.id")
+        rows = cur.fetchall()
+    for row in rows:
+        row['last_activity'] = epoch(row['last_activity'])
+        # Entities without playlist, or with nothing due, only have their last pick
+        searches = [t for t in (epoch(row['last_search']), epoch(row.pop('last_pick'))) if t is not None]
+        row['last_search'] = max(searches) if searches else None
+    return rows
+
+
+def save_pick(decision):
+    """Persist a scheduler pick, so it still counts as a search after a restart."""
+    with db_pool.cursor() as cur:
+        cur.execute("UPDATE " + cats[decision['host']]['entity_table'] + " SET last_pick_datetime = NOW() WHERE id = %s",
+                    [decision['id']])
+
+
+def next_due_time(handler, entity_id):
+    """When the entity's next unmatched track is due for a search, None when unknown."""
+    due = handler.next_due
+    if PENDING_MATCH_INDEX:
+        host_entity_id = cats[handler.current_host]['host_entity_id']
+        if cats[handler.current_host]['host_entity_id_type'] == int:
+            entity_id = int(entity_id)
+        # The index sorts on PENDING_MATCH: the first one after now is the next due
+        res = cats[handler.current_host]['tracks_table'].query(
+            IndexName=PENDING_MATCH_INDEX, Limit=1,
+            KeyConditionExpression=Key(host_entity_id).eq(entity_id) & Key(PENDING_MATCH).gt(int(time.time())))
+        if res['Items']:
+            pending = int(res['Items'][0][PENDING_MATCH])
+            due = pending if due is None else min(due, pending)
+    return due
+
+
+scheduler = None
+if ENTITY_SCHEDULER == 'priority':
+    scheduler = EntityScheduler(load_entity_stats, SCHEDULER_HOST_WEIGHTS,
+                                max_wait=SCHEDULER_MAX_WAIT, refresh_interval=SCHEDULER_REFRESH, on_pick=save_pick)
+    # Pending work, read from the scheduler snapshot at scrape time
+    metrics.gauge('mirrorfm_pending_entities', 'Entities with unmatched tracks.', ('host',),
+                  fn=lambda: {(host,): n for host, (n, _) in scheduler.pending().items()})
+    metrics.gauge('mirrorfm_pending_tracks', 'Unmatched tracks (track count minus found tracks).', ('host',),
+                  fn=lambda: {(host,): n for host, (_, n) in scheduler.pending().items()})
+
+
+def in_leased_shards():
+    """Scheduler filter keeping the entities of the shards leased by this replica, None when not sharded."""
+    if leases is None:
+        return None
+    owned = set(leases.owned())
+    return lambda candidate: int(candidate.id) % leases.shards in owned
+
+
+def next_rediscovery_entity(handler):
+    """Sets the host and returns the next entity row to rediscover, None when there is none."""
+    if scheduler is None:
+        handler.current_host = random_host()
+        return get_next_entity(handler)
+    decision = scheduler.pick(allowed=in_leased_shards())
+    if decision is None:
+        return None
+    handler.current_host = decision['host']
+    cursor = handler.conn.cursor()
+    cursor.execute("SELECT * FROM " + cats[handler.current_host]['entity_table'] + " WHERE id = %s",
+                   [decision['id']])
+    return cursor.fetchone()
 
 
 def get_next_entity(handler):
-    cursor = get_cursor(cats[handler.current_host]['cursor_last_successful_entity'])
-    if 'Item' in cursor and cursor['Item']['value']:
-        last_entity_id = int(cursor['Item']['value'])
+    """Entity after the cursor, in one of the shards leased by this replica when sharded."""
+    if leases is None:
+        shard = None
+    else:
+        shard = leases.next_shard()
+        if shard is None:
+            # Waiting for other replicas to release shards
+            return None
+    cursor = get_cursor(shard_cursor_name(cats[handler.current_host]['cursor_last_successful_entity'], shard))
+    if cursor:
+        last_entity_id = int(cursor)
     else:
         last_entity_id = 0
     cursor = handler.conn.cursor()
-    cursor.execute("SELECT * FROM " + cats[handler.current_host]['entity_table']
-                   + " WHERE (id > %s or id = 1) order by id = 1, id limit 1" % str(last_entity_id))
+    if shard is None:
+        cursor.execute("SELECT * FROM " + cats[handler.current_host]['entity_table']
+                       + " WHERE (id > %s or id = 1) order by id = 1, id limit 1" % str(last_entity_id))
+    else:
+        cursor.execute("SELECT * FROM " + cats[handler.current_host]['entity_table']
+                       + " WHERE MOD(id, %s) = %s ORDER BY id <= %s, id LIMIT 1",
+                       [leases.shards, shard, last_entity_id])
     return cursor.fetchone()
 
 
 def save_cursors(handler, just_processed_tracks, to_spotify_last_successful_entity):
+    # Never move a cursor past tracks whose updates are not written yet
+    handler.track_writes.flush()
+    shard = entity_shard(to_spotify_last_successful_entity)
+    track_cursor = shard_cursor_name(cats[handler.current_host]['cursor_start_track_key'], shard)
+    entity_cursor = shard_cursor_name(cats[handler.current_host]['cursor_last_successful_entity'], shard)
     if 'LastEvaluatedKey' in just_processed_tracks:
         print('LastEvaluatedKey in just_processed_tracks')
-        set_cursor(cats[handler.current_host]['cursor_start_track_key'],
-                   just_processed_tracks['LastEvaluatedKey'])
-        print('set cursor %s with' % cats[handler.current_host]['cursor_start_track_key'],
-              just_processed_tracks['LastEvaluatedKey'])
+        set_cursor(track_cursor, just_processed_tracks['LastEvaluatedKey'])
+        print('set cursor %s with' % track_cursor, just_processed_tracks['LastEvaluatedKey'])
     else:
         print('no LastEvaluatedKey in just_processed_tracks')
-        cursors_table.delete_item(
-            Key={
-                'name': cats[handler.current_host]['cursor_start_track_key']
-            }
-        )
-        print('deleted %s' % cats[handler.current_host]['cursor_start_track_key'])
-        set_cursor(cats[handler.current_host]['cursor_last_successful_entity'], to_spotify_last_successful_entity)
-        print('set cursor %s with' % cats[handler.current_host]['cursor_last_successful_entity'],
-              to_spotify_last_successful_entity)
+        cursors.delete(track_cursor)
+        print('deleted %s' % track_cursor)
+        set_cursor(entity_cursor, to_spotify_last_successful_entity)
+        print('set cursor %s with' % entity_cursor, to_spotify_last_successful_entity)
 
 
 def get_next_tracks(handler, entity_id):
-    tracks_table = cats[handler.current_host]['tracks_table']
-    cursor = get_cursor(cats[handler.current_host]['cursor_start_track_key'])
+    cursor = get_cursor(shard_cursor_name(cats[handler.current_host]['cursor_start_track_key'],
+                                          entity_shard(handler.entity.aid)))
     host_entity_id = cats[handler.current_host]['host_entity_id']
     host_entity_id_type = cats[handler.current_host]['host_entity_id_type']
 
     if host_entity_id_type == int:
         entity_id = int(entity_id)
 
-    condition_expression = Key(host_entity_id).eq(entity_id)
-
-    if 'Item' in cursor and entity_id == cursor['Item']['value'][host_entity_id]:
+    if cursor and entity_id == cursor[host_entity_id] \
+            and (PENDING_MATCH in cursor) == bool(PENDING_MATCH_INDEX):
+        # A cursor saved from the other access path has the wrong key shape and is ignored
         print(
             "Starting from track",
-            cursor['Item']['value'][cats[handler.current_host]['track_composite']])
+            cursor[cats[handler.current_host]['track_composite']])
+        return query_tracks(handler, entity_id, cursor)
+    print("Starting from first track")
+    return query_tracks(handler, entity_id)
+
 
-        return tracks_table.query(
-            Limit=BATCH_GET_SIZE,
-            FilterExpression="attribute_not_exists(spotify_found_time)",
-            ExclusiveStartKey=cursor['Item']['value'],
-            KeyConditionExpression=condition_expression)
+def query_tracks(handler, entity_id, start_key=None):
+    """One page of the entity's unmatched tracks that are due for a search."""
+    tracks_table = cats[handler.current_host]['tracks_table']
+    host_entity_id = cats[handler.current_host]['host_entity_id']
+    if cats[handler.current_host]['host_entity_id_type'] == int:
+        entity_id = int(entity_id)
+
+    query = {'Limit': BATCH_GET_SIZE}
+    if PENDING_MATCH_INDEX:
+        # Sparse index: matched tracks are not in it, due ones sort first
+        query['IndexName'] = PENDING_MATCH_INDEX
+        query['KeyConditionExpression'] = Key(host_entity_id).eq(entity_id) & Key(PENDING_MATCH).lte(int(time.time()))
     else:
-        print("Starting from first track")
-        return tracks_table.query(
-            Limit=BATCH_GET_SIZE,
-            FilterExpression="attribute_not_exists(spotify_found_time)",
-            KeyConditionExpression=condition_expression)
+        query['KeyConditionExpression'] = Key(host_entity_id).eq(entity_id)
+        # Unmatched tracks that are due for a (re-)search
+        query['FilterExpression'] = Attr('spotify_found_time').not_exists() & (
+            Attr('next_search_time').not_exists() | Attr('next_search_time').lte(int(time.time())))
+    if start_key:
+        query['ExclusiveStartKey'] = start_key
+    return tracks_table.query(**query)
 
 
 def deserialize_record(record):
@@ -605,29 +1230,56 @@ def random_host():
 
 
 class Handler(object):
-    sp = None
-    current_host = None
-    conn = None
+    """
+    State of one entity being processed. Worker threads each get their own;
+    clients, caches and rate limiters are module-level and shared.
+    """
+
+    def __init__(self, sp=None, current_host=None, conn=None):
+        self.sp = sp
+        self.current_host = current_host
+        self.conn = conn
+        self.entity = None
+        self.search_calls = 0
+        self.added_uris = set()
+        self.pending_adds = []
+        # Earliest re-search scheduled by this run
+        self.next_due = None
+        # Entity and lease shard held while the entity is processed (hold_entity)
+        self.held_entity = None
+        self.held_shard = None
+        self.track_writes = WriteBehind(max_pending=PLAYLIST_ADD_BATCH, concurrency=TRACK_WRITE_CONCURRENCY)
 
 
 def handle(event, c):
-    handler = Handler()
-    handler.sp = get_spotify()
+    if leases is not None:
+        leases.start()
+    if not event and ENTITY_WORKERS > 1:
+        return process_entities(ENTITY_WORKERS)
 
-    try:
-        handler.conn = pymysql.connect(host=db_host,
-                                       user=db_username,
-                                       passwd=db_password,
-                                       db=db_name,
-                                       connect_timeout=10,
-                                       read_timeout=300,
-                                       write_timeout=300,
-                                       cursorclass=pymysql.cursors.DictCursor)
-    except pymysql.MySQLError as e:
-        print("ERROR: Unexpected error: Could not connect to MySQL instance.")
-        print(e)
-        sys.exit()
+    handler = Handler(sp=get_spotify())
 
+    try:
+        with db_pool.connection() as conn:
+            handler.conn = conn
+            return process_event(handler, event)
+    finally:
+        # Matches already added to playlists are recorded even if the run failed
+        handler.track_writes.flush()
+        release_entity(handler)
+
+
+def shutdown():
+    """Called by the k3s runner before the process exits."""
+    cursors.flush()
+    print("Cursors", cursors.stats)
+    if leases is not None:
+        # Other replicas can take over our shards right away
+        leases.release_all()
+        print("Leases", leases.stats)
+
+
+def process_event(handler, event):
     new_track_genres = []
 
     total_added = total_searched = 0
@@ -638,24 +1290,23 @@ def handle(event, c):
         entity_id = event['sqs_entity']['entity_id']
         print("Processing entity from SQS: %s %s" % (handler.current_host, entity_id))
 
-        cursor = handler.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM " + cats[handler.current_host]['entity_table'] + " WHERE "
-            + cats[handler.current_host]['entity_id'] + "=%s", entity_id)
-        entity = cursor.fetchone()
-        if not entity:
+        handler.entity = load_entity(handler, entity_id)
+        if not handler.entity:
             print("Entity not found: %s" % entity_id)
             return {"searched": 0, "added": 0}
-        entity_aid = entity['id']
-        entity_name = entity[cats[handler.current_host]['entity_name']]
+        if not hold_entity(handler, handler.entity.aid):
+            # Processing it here would race with the owner's workers: the message
+            # goes back to the queue (see k3s_runner) until the owner receives it
+            print("Entity %s is in a shard of another replica, requeueing" % entity_id)
+            return {"searched": 0, "added": 0, "requeue": True}
+        entity_aid = handler.entity.aid
+        entity_name = handler.entity.name
 
         while True:
             tracks_to_process = get_next_tracks(handler, entity_id)
-            for record in tracks_to_process['Items']:
-                if 'spotify_uri' not in record:
-                    total_searched += 1
-                    if spotify_lookup(handler, record, new_track_genres):
-                        total_added += 1
+            searched, added = lookup_records(handler, tracks_to_process['Items'], new_track_genres)
+            total_searched += searched
+            total_added += added
             save_cursors(handler, tracks_to_process, entity_aid)
             if 'LastEvaluatedKey' not in tracks_to_process:
                 break
@@ -665,61 +1316,71 @@ def handle(event, c):
 
         # New tracks from DynamoDB Streams (legacy)
         print("Process %d tracks just added to DynamoDB" % len(event['Records']))
-        for record in event['Records']:
-            record = record['dynamodb']
-            if 'NewImage' in record and 'spotify_uri' not in record['NewImage']:
-                total_searched += 1
-                if spotify_lookup(handler, deserialize_record(record), new_track_genres):
-                    total_added += 1
+        new_records = [deserialize_record(record['dynamodb']) for record in event['Records']
+                       if 'NewImage' in record['dynamodb']]
         if cats[handler.current_host]['host_entity_id_type'] == str:
             entity_id_type = "S"
         else:
             entity_id_type = "N"
         entity_id = event['Records'][0]['dynamodb']['NewImage'][cats[handler.current_host]['host_entity_id']][
             entity_id_type]
-        cursor = handler.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM " + cats[handler.current_host]['entity_table'] + " WHERE " + cats[handler.current_host][
-                'entity_id'] + "=%s", entity_id)
-        entity = cursor.fetchone()
-        entity_aid = entity['id']
-        entity_name = entity[cats[handler.current_host]['entity_name']]
+        handler.entity = load_entity(handler, entity_id)
+        entity_aid = handler.entity.aid
+        entity_name = handler.entity.name
+        total_searched, total_added = lookup_records(handler, new_records, new_track_genres)
     else:
-        handler.current_host = random_host()
-
         # Rediscover tracks
-        channel_to_process = get_next_entity(handler)
-        entity_aid = channel_to_process['id']
-        entity_id = channel_to_process[cats[handler.current_host]['entity_id']]
+        row = next_rediscovery_entity(handler)
+        if not row or not hold_entity(handler, row['id']):
+            return {"searched": 0, "added": 0}
+        handler.entity = EntityContext(handler.current_host, row)
+        entity_aid = handler.entity.aid
+        entity_id = handler.entity.entity_id
 
         # Channel might not have a name yet if it has just been added
-        entity_name = channel_to_process[cats[handler.current_host]['entity_name']]
+        entity_name = handler.entity.name
         print("Rediscovering entity", entity_name or entity_id)
 
         tracks_to_process = get_next_tracks(handler, entity_id)
-
-        for record in tracks_to_process['Items']:
-            if 'spotify_uri' not in record:
-                total_searched += 1
-                if spotify_lookup(handler, record, new_track_genres):
-                    total_added += 1
+        total_searched, total_added = lookup_records(handler, tracks_to_process['Items'], new_track_genres)
 
         save_cursors(handler, tracks_to_process, entity_aid)
 
+    return finish_entity(handler, total_searched, total_added, new_track_genres)
+
+
+def finish_entity(handler, total_searched, total_added, new_track_genres, drained=False):
+    """
+    Write the entity's pending track updates, then its playlist and genre statistics.
+    drained: no due track is left, the scheduler leaves the rest of the backlog out until the next is due.
+    """
+    entity_aid = handler.entity.aid
+    entity_id = handler.entity.entity_id
+    entity_name = handler.entity.name
+
+    # Entity done: its track updates are written before the stats below
+    handler.track_writes.flush()
+    if scheduler is not None:
+        scheduler.record(handler.current_host, entity_aid, total_searched, total_added, drained=drained,
+                         next_due=next_due_time(handler, entity_id) if drained else None)
+
     if total_searched > 0:
         print(
-            "Searched %s, found %s track(s), updating entity info for %s" %
-            (total_searched, total_added, entity_id))
+            "Searched %s, found %s track(s) with %s search call(s), updating entity info for %s" %
+            (total_searched, total_added, handler.search_calls, entity_id))
+        print("Search cache", search_cache.stats())
 
         # TODO What if the code above updated 2 playlists?
-        pl_item, num = get_last_playlist(handler, entity_id)
+        pl_item, num = current_playlist(handler)
         if not pl_item:
-            return {"searched": total_searched, "added": total_added}
+            return {"searched": total_searched, "added": total_added, "search_calls": handler.search_calls}
 
         pl_id = pl_item['spotify_playlist']
         update_playlist_description(handler, pl_id, entity_aid)
         pl = handler.sp.playlist(pl_id)
 
+        statements = stats_statements[handler.current_host]
+        handler.conn.begin()
         cursor = handler.conn.cursor()
 
         if total_added > 0:
@@ -735,24 +1396,166 @@ def handle(event, c):
                     'entity_name': entity_name
                 }
             )
-            cursor.execute('UPDATE ' + cats[handler.current_host]['playlist_table']
-                           + ' SET count_followers=%s, last_search_time=now(), found_tracks=%s, last_found_time=now() WHERE spotify_playlist=%s AND num=%s',
-                           [pl["followers"]["total"], pl["tracks"]["total"], pl_id, num])
-            for genre in playlist_genres:
-                cursor.execute(
-                    'INSERT INTO ' + cats[handler.current_host]['genres_table']
-                    + ' (' + cats[handler.current_host]['host_entity_id']
-                    + ', genre_name, count, last_updated) VALUES ("%s", %s, 1, NOW()) ON DUPLICATE KEY UPDATE count = count + 1, last_updated=NOW()',
-                    [entity_aid, genre])
+            # Spotify's total reconciles the count kept up to date by the adds
+            update_playlist_stats(cursor, statements, pl_id, num, pl["followers"]["total"],
+                                  found_tracks=pl["tracks"]["total"])
+            upsert_genre_counts(cursor, statements, entity_aid, playlist_genres)
         else:
-            cursor.execute('UPDATE ' + cats[handler.current_host]['playlist_table']
-                           + ' SET count_followers=%s, last_search_time=now() WHERE spotify_playlist=%s AND num=%s',
-                           [pl["followers"]["total"], pl_id, num])
+            update_playlist_stats(cursor, statements, pl_id, num, pl["followers"]["total"])
 
         handler.conn.commit()
-        handler.conn.close()
+        print("MySQL pool", db_pool.metrics())
+
+    return {"searched": total_searched, "added": total_added, "search_calls": handler.search_calls}
+
 
-    return {"searched": total_searched, "added": total_added}
+def get_next_entities(host, count):
+    """
+    Up to `count` entities of a host after its entity cursor (one per leased
+    shard in turn when sharded), wrapping around to the first ones.
+    Returns (row, cursor name) pairs.
+    """
+    if leases is None:
+        shards = {None: count}
+    else:
+        shards = {}
+        for _ in range(count):
+            shard = leases.next_shard()
+            if shard is None:
+                break
+            shards[shard] = shards.get(shard, 0) + 1
+    entity_table = cats[host]['entity_table']
+    picked = []
+    with db_pool.cursor() as cur:
+        for shard, n in shards.items():
+            name = shard_cursor_name(cats[host]['cursor_last_successful_entity'], shard)
+            cursor = get_cursor(name)
+            last_entity_id = int(cursor) if cursor else 0
+            if shard is None:
+                cur.execute("SELECT * FROM " + entity_table + " ORDER BY id <= %s, id LIMIT %s",
+                            [last_entity_id, n])
+            else:
+                cur.execute("SELECT * FROM " + entity_table + " WHERE MOD(id, %s) = %s ORDER BY id <= %s, id LIMIT %s",
+                            [leases.shards, shard, last_entity_id, n])
+            picked += [(row, name) for row in cur.fetchall()]
+    return picked
+
+
+def get_scheduled_entities(count):
+    """Up to `count` distinct entities picked by the scheduler, as (host, row) pairs."""
+    leased = in_leased_shards()
+    picked = set()
+
+    def allowed(candidate):
+        return (candidate.host, candidate.id) not in picked and (leased is None or leased(candidate))
+
+    for _ in range(count):
+        decision = scheduler.pick(allowed=allowed)
+        if decision is None:
+            break
+        picked.add((decision['host'], decision['id']))
+    batch = []
+    with db_pool.cursor() as cur:
+        for host in cats:
+            ids = [aid for h, aid in picked if h == host]
+            if ids:
+                cur.execute("SELECT * FROM " + cats[host]['entity_table'] + " WHERE id IN ("
+                            + ", ".join(["%s"] * len(ids)) + ")", ids)
+                batch += [(host, row) for row in cur.fetchall()]
+    return batch
+
+
+def process_entity(sp, host, row):
+    """
+    Worker: search the due tracks of one entity, page after page, up to
+    ENTITY_MAX_SEARCHES. Playlist writes stay in order within the entity.
+    The per-host track cursor is not used: matched and re-scheduled tracks
+    drop out of the query, so the next turn starts from the first page.
+    Returns None when the entity's shard was handed over since it was picked.
+    Another worker on the same entity is waited for.
+    """
+    handler = Handler(sp=sp, current_host=host)
+    if not hold_entity(handler, row['id']):
+        print("[%s] Entity %s is in a shard of another replica now, skipping" % (host, row['id']))
+        return None
+    try:
+        with db_pool.connection() as conn:
+            handler.conn = conn
+            handler.entity = EntityContext(host, row)
+            print("[%s] Rediscovering entity" % host, handler.entity.name or handler.entity.entity_id)
+            new_track_genres = []
+            total_searched = total_added = 0
+            start_key = None
+            while total_searched < ENTITY_MAX_SEARCHES:
+                page = query_tracks(handler, handler.entity.entity_id, start_key)
+                searched, added = lookup_records(handler, page['Items'], new_track_genres)
+                total_searched += searched
+                total_added += added
+                start_key = page.get('LastEvaluatedKey')
+                if not start_key:
+                    break
+            return finish_entity(handler, total_searched, total_added, new_track_genres, drained=start_key is None)
+    finally:
+        handler.track_writes.flush()
+        release_entity(handler)
+
+
+def process_entities(count):
+    """
+    Rediscovery worker mode: process `count` entities at once, YouTube channels
+    and Discogs labels mixed, one thread and Handler per entity. While one
+    entity waits on Spotify or the rate limiter, the others keep going.
+    Entities come from the scheduler, or with round_robin from the entity
+    cursors (per host, and per shard when sharded), which only move past
+    entities that completed.
+    """
+    sp = get_spotify()
+    batch = []
+    cursor_names = {}
+    if scheduler is None:
+        hosts = [random_host() for _ in range(count)]
+        for host in cats:
+            for row, name in get_next_entities(host, hosts.count(host)):
+                batch.append((host, row))
+                cursor_names[(host, row['id'])] = name
+    else:
+        batch = get_scheduled_entities(count)
+
+    totals = {"searched": 0, "added": 0, "search_calls": 0, "entities": len(batch)}
+    errors = []
+    done = set()
+    with ThreadPoolExecutor(max_workers=len(batch) or 1) as pool:
+        futures = [pool.submit(process_entity, sp, host, row) for host, row in batch]
+        for (host, row), future in zip(batch, futures):
+            try:
+                result = future.result()
+                if result is None:
+                    continue
+                for key in ("searched", "added", "search_calls"):
+                    totals[key] += result.get(key, 0)
+                done.add((host, row['id']))
+            except Exception as e:
+                print("[%s] Entity %s failed: %s" % (host, row['id'], e))
+                errors.append(e)
+
+    completed = {}
+    stopped = set()
+    for host, row in batch:
+        name = cursor_names.get((host, row['id']))
+        if name is None:
+            continue
+        if (host, row['id']) not in done:
+            stopped.add(name)
+        elif name not in stopped:
+            completed[name] = row['id']
+    for name, entity_aid in completed.items():
+        set_cursor(name, entity_aid)
+
+    print("Worker batch", totals, "Search cache", search_cache.stats())
+    if errors:
+        # e.g. rate limit: let the runner back off
+        raise errors[0]
+    return totals
 
 
 if __name__ == "__main__":
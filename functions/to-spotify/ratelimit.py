@@ -0,0 +1,284 @@
+"""
+Client-side rate limiting for Spotify Web API calls.
+
+Every call made through RateLimitedSpotify takes a token from the read or
+write bucket first, and a 429 pauses that bucket for the Retry-After the API
+asked for. Buckets can optionally draw their budget from a shared backend so
+that several replicas split one rate instead of each using all of it.
+
+The spotipy client must use spotify_session(), so that urllib3 does not sleep
+the Retry-After itself before the 429 reaches the proxy.
+"""
+
+import os
+import threading
+import time
+
+# spotipy methods that modify playlists, everything else is budgeted as a read
+WRITE_METHODS = {
+    "user_playlist_create",
+    "user_playlist_add_tracks",
+    "playlist_add_items",
+    "playlist_replace_items",
+    "playlist_remove_all_occurrences_of_items",
+    "playlist_change_details",
+    "playlist_upload_cover_image",
+}
+
+# Retry-After values above this are re-raised to the runner instead of slept inline
+MAX_INLINE_WAIT = int(os.getenv("SPOTIFY_MAX_INLINE_WAIT", "60"))
+MAX_RETRIES = int(os.getenv("SPOTIFY_RATE_RETRIES", "3"))
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at `rate` tokens per second, up to `burst`.
+
+    With a backend, tokens must also be reserved from a budget shared with
+    other replicas, `reserve_chunk` at a time per `window` seconds.
+    """
+
+    def __init__(self, name, rate, burst, backend=None, window=30, reserve_chunk=10,
+                 clock=time.time, sleep=time.sleep):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.backend = backend
+        self.window = window
+        self.reserve_chunk = reserve_chunk
+        self.tokens = self.burst
+        self.allowance = 0
+        self.blocked_until = 0.0
+        self.waited = 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _next_window(self, now):
+        return (now // self.window + 1) * self.window
+
+    def _wait_time(self, now):
+        """Seconds to wait before a token can be taken, 0 when one was taken."""
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        if self.backend is not None and self.allowance < 1:
+            granted, blocked_until = self.backend.reserve(
+                self.name, self.reserve_chunk, int(self.rate * self.window), self.window)
+            self.allowance += granted
+            if blocked_until > now:
+                self.blocked_until = blocked_until
+                return blocked_until - now
+            if self.allowance < 1:
+                # Shared budget spent for this window
+                return self._next_window(now) - now
+            self.allowance -= 1
+        self.tokens -= 1
+        return 0
+
+    def acquire(self):
+        """Block until a token is available. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                wait = self._wait_time(self._clock())
+                if wait <= 0:
+                    self.waited += waited
+                    return waited
+            self._sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` (Retry-After), on every replica when shared."""
+        with self._lock:
+            until = self._clock() + seconds
+            if until > self.blocked_until:
+                self.blocked_until = until
+                self.tokens = 0
+        if self.backend is not None:
+            self.backend.block(self.name, until)
+
+
+class LocalBackend:
+    """In-process shared budget: the stand-in for DynamoDBBackend in tests and local runs."""
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._windows = {}
+        self._blocked = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, bucket, count, limit, window):
+        with self._lock:
+            start = self._clock() // window * window
+            window_start, used = self._windows.get(bucket, (start, 0))
+            if window_start != start:
+                used = 0
+            granted = max(0, min(count, limit - used))
+            self._windows[bucket] = (start, used + granted)
+            return granted, self._blocked.get(bucket, 0.0)
+
+    def block(self, bucket, until):
+        with self._lock:
+            self._blocked[bucket] = max(until, self._blocked.get(bucket, 0.0))
+
+
+class DynamoDBBackend:
+    """
+    Budget shared between replicas through one item per bucket in `mirrorfm_cursors`.
+    Set DYNAMODB_ENDPOINT_URL to run against DynamoDB Local.
+    """
+
+    def __init__(self, table_name="mirrorfm_cursors", endpoint_url=None, clock=time.time):
+        # Used from several threads: one boto3 resource per thread
+        from dynamodb_tables import ThreadLocalTables
+
+        self.table = ThreadLocalTables('eu-west-1', endpoint_url=endpoint_url).table(table_name)
+        self._conditional_failed = self.table.meta.client.exceptions.ConditionalCheckFailedException
+        self._clock = clock
+
+    def _key(self, bucket):
+        return {'name': 'spotify_rate_%s' % bucket}
+
+    def reserve(self, bucket, count, limit, window):
+        start = int(self._clock() // window * window)
+        try:
+            # Same window: add to the counter while it stays under the limit
+            res = self.table.update_item(
+                Key=self._key(bucket),
+                UpdateExpression="ADD used :n",
+                ConditionExpression="window_start = :w AND used <= :max",
+                ExpressionAttributeValues={':n': count, ':w': start, ':max': limit - count},
+                ReturnValues="ALL_NEW")
+        except self._conditional_failed:
+            try:
+                # First reservation of a new window
+                res = self.table.update_item(
+                    Key=self._key(bucket),
+                    UpdateExpression="SET window_start = :w, used = :n",
+                    ConditionExpression="attribute_not_exists(window_start) OR window_start < :w",
+                    ExpressionAttributeValues={':n': count, ':w': start},
+                    ReturnValues="ALL_NEW")
+            except self._conditional_failed:
+                return 0, 0.0
+        return count, float(res['Attributes'].get('blocked_until', 0))
+
+    def block(self, bucket, until):
+        try:
+            self.table.update_item(
+                Key=self._key(bucket),
+                UpdateExpression="SET blocked_until = :u",
+                ConditionExpression="attribute_not_exists(blocked_until) OR blocked_until < :u",
+                ExpressionAttributeValues={':u': int(until) + 1})
+        except self._conditional_failed:
+            pass
+
+
+class SpotifyLimiter:
+    def __init__(self, read, write):
+        self.read = read
+        self.write = write
+
+    def bucket_for(self, method_name):
+        return self.write if method_name in WRITE_METHODS else self.read
+
+
+def limiter_from_env():
+    """Build read/write buckets from SPOTIFY_* env vars (rates in requests per second)."""
+    backend = None
+    if os.getenv("SPOTIFY_RATE_BACKEND") == "dynamodb":
+        backend = DynamoDBBackend(endpoint_url=os.getenv("DYNAMODB_ENDPOINT_URL") or None)
+    window = int(os.getenv("SPOTIFY_RATE_WINDOW", "30"))
+    read = TokenBucket("read",
+                       float(os.getenv("SPOTIFY_READ_RATE", "3")),
+                       float(os.getenv("SPOTIFY_READ_BURST", "10")),
+                       backend=backend, window=window)
+    write = TokenBucket("write",
+                        float(os.getenv("SPOTIFY_WRITE_RATE", "1")),
+                        float(os.getenv("SPOTIFY_WRITE_BURST", "5")),
+                        backend=backend, window=window)
+    return SpotifyLimiter(read, write)
+
+
+def spotify_session(retries=3, status_forcelist=(500, 502, 503, 504), backoff_factor=0.3):
+    """
+    requests session for spotipy.Spotify(requests_session=...): retries 5xx,
+    but returns a 429 as is (urllib3 would otherwise wait out its Retry-After
+    inline, out of the limiter's sight).
+    """
+    import requests
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=retries,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=[code for code in status_forcelist if code != 429],
+        respect_retry_after_header=False)
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def retry_after(e):
+    """Seconds to wait from a 429 SpotifyException, 1 when the header is missing."""
+    headers = getattr(e, "headers", None) or {}
+    try:
+        return max(1, int(headers.get("Retry-After", headers.get("retry-after", 1))))
+    except (TypeError, ValueError):
+        return 1
+
+
+class RateLimitedSpotify:
+    """
+    Proxy around spotipy.Spotify: every public method call goes through the limiter.
+    observe(method, seconds, error) is told about every API call, retries included.
+    """
+
+    def __init__(self, sp, limiter, observe=None):
+        self._sp = sp
+        self._limiter = limiter
+        self._observe = observe
+
+    def __getattr__(self, name):
+        attr = getattr(self._sp, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        bucket = self._limiter.bucket_for(name)
+
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                bucket.acquire()
+                start = time.monotonic()
+                try:
+                    result = attr(*args, **kwargs)
+                    if self._observe:
+                        self._observe(name, time.monotonic() - start, False)
+                    return result
+                except Exception as e:
+                    if self._observe:
+                        self._observe(name, time.monotonic() - start, True)
+                    if getattr(e, "http_status", None) != 429:
+                        raise
+                    wait = retry_after(e)
+                    bucket.pause(wait)
+                    attempt += 1
+                    if attempt > MAX_RETRIES or wait > MAX_INLINE_WAIT:
+                        # Let the runner back off, the bucket stays paused meanwhile
+                        raise
+                    print("[ratelimit] %s: 429, retrying after %ss" % (name, wait))
+
+        return call
@@ -0,0 +1,237 @@
+"""
+Priority scheduler choosing which entity to rediscover next.
+
+Entities are scored from a periodic snapshot of their stats:
+
+    backlog   tracks not matched yet and due for a search, worth more where
+              matching works (log1p(backlog) * (MATCH_FLOOR + match rate))
+    activity  recent uploads / releases, decaying over ACTIVITY_DECAY
+    readiness 0 right after a search, back to 1 after revisit_interval
+    aging     time since the last search over max_wait, unbounded
+
+    score = (w_backlog * backlog + w_activity * activity) * readiness + w_aging * aging
+
+Hosts share the work through a weighted fair queue: each pick advances the
+host's virtual time by 1 / weight and the host with the lowest virtual time
+goes next. An entity not searched for max_wait seconds is picked before
+any score (starvation protection). The last decisions are kept, with the
+score components, for inspection.
+
+Tracks searched without match are re-searched later (research backoff), so
+when a run drains an entity's due tracks, its remaining backlog is not due:
+it is left out of the score until the next track is due again.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+
+ACTIVITY_DECAY = 30 * 86400
+MATCH_FLOOR = 0.2
+# Match rate assumed for entities without tracks yet
+DEFAULT_MATCH_RATE = 0.5
+
+
+class Candidate:
+    __slots__ = ("host", "id", "name", "tracks", "found", "last_search", "last_activity", "empty_until",
+                 "not_due", "due_at")
+
+    def __init__(self, host, id, name=None, tracks=0, found=0, last_search=None, last_activity=None):
+        self.host = host
+        self.id = id
+        self.name = name
+        self.tracks = int(tracks or 0)
+        self.found = int(found or 0)
+        self.last_search = last_search
+        self.last_activity = last_activity
+        self.empty_until = 0
+        # Unmatched tracks not due for a search before due_at
+        self.not_due = 0
+        self.due_at = 0
+
+    def backlog(self, now):
+        backlog = max(0, self.tracks - self.found)
+        if self.due_at > now:
+            backlog = max(0, backlog - self.not_due)
+        return backlog
+
+
+class EntityScheduler:
+    def __init__(self, load, host_weights, w_backlog=1.0, w_activity=2.0, w_aging=1.0,
+                 revisit_interval=3600, max_wait=7 * 86400, empty_cooldown=3600,
+                 refresh_interval=300, history=100, clock=time.time, on_pick=None):
+        """
+        load(host) returns the host's entities as dicts with id, name, tracks,
+        found, and last_search / last_activity as epoch seconds or None.
+        on_pick(decision) persists picks, so they count as searches after a restart.
+        """
+        self.load = load
+        self.on_pick = on_pick
+        self.host_weights = dict(host_weights)
+        self.w_backlog = w_backlog
+        self.w_activity = w_activity
+        self.w_aging = w_aging
+        self.revisit_interval = revisit_interval
+        self.max_wait = max_wait
+        self.empty_cooldown = empty_cooldown
+        self.refresh_interval = refresh_interval
+        self.virtual_time = {host: 0.0 for host in self.host_weights}
+        self.history = deque(maxlen=history)
+        self._clock = clock
+        self._candidates = {}
+        self._picked_at = {}
+        self._empty_until = {}
+        self._not_due = {}
+        self._loaded_at = None
+        self._lock = threading.RLock()
+
+    def refresh(self):
+        candidates = {}
+        for host in self.host_weights:
+            for row in self.load(host):
+                candidate = Candidate(host, row['id'], row.get('name'), row.get('tracks'), row.get('found'),
+                                      row.get('last_search'), row.get('last_activity'))
+                key = (host, candidate.id)
+                # Picks since the snapshot was taken are newer than what MySQL says
+                picked = self._picked_at.get(key)
+                if picked and (candidate.last_search is None or picked > candidate.last_search):
+                    candidate.last_search = picked
+                candidate.empty_until = self._empty_until.get(key, 0)
+                candidate.not_due, candidate.due_at = self._not_due.get(key, (0, 0))
+                candidates.setdefault(host, []).append(candidate)
+        self._candidates = candidates
+        self._loaded_at = self._clock()
+        for host in self.host_weights:
+            print("[scheduler] %s: %d entities, top" % (host, len(candidates.get(host, []))), self.queue(host, 3))
+
+    def score(self, candidate, now):
+        """(score, components) of a candidate."""
+        backlog = candidate.backlog(now)
+        match_rate = min(1.0, candidate.found / float(candidate.tracks)) if candidate.tracks else DEFAULT_MATCH_RATE
+        backlog_term = math.log1p(backlog) * (MATCH_FLOOR + match_rate)
+        activity = 0.0
+        if candidate.last_activity:
+            activity = math.exp(-max(0.0, now - candidate.last_activity) / ACTIVITY_DECAY)
+        since_search = self.max_wait if candidate.last_search is None else max(0.0, now - candidate.last_search)
+        readiness = min(1.0, since_search / float(self.revisit_interval))
+        aging = since_search / float(self.max_wait)
+        score = (self.w_backlog * backlog_term + self.w_activity * activity) * readiness + self.w_aging * aging
+        return score, {
+            "backlog": backlog,
+            "match_rate": round(match_rate, 3),
+            "activity": round(activity, 3),
+            "readiness": round(readiness, 3),
+            "aging": round(aging, 3),
+        }
+
+    def _eligible(self, host, now, allowed):
+        return [c for c in self._candidates.get(host, [])
+                if c.empty_until <= now and (allowed is None or allowed(c))]
+
+    def pick(self, allowed=None):
+        """
+        Next entity to rediscover as a decision dict, None when no entity is eligible.
+        allowed(candidate) can restrict the choice (leased shards, entities already in progress).
+        """
+        with self._lock:
+            now = self._clock()
+            if self._loaded_at is None or now - self._loaded_at >= self.refresh_interval:
+                self.refresh()
+            eligible = {host: self._eligible(host, now, allowed) for host in self.host_weights}
+            hosts = [host for host in self.host_weights if eligible[host]]
+            if not hosts:
+                return None
+
+            starved = [c for host in hosts for c in eligible[host]
+                       if c.last_search is None or now - c.last_search >= self.max_wait]
+            if starved:
+                chosen = min(starved, key=lambda c: c.last_search or 0)
+                reason = "starved"
+            else:
+                host = min(hosts, key=lambda h: (self.virtual_time[h], h))
+                chosen = max(eligible[host], key=lambda c: self.score(c, now)[0])
+                reason = "score"
+            score, components = self.score(chosen, now)
+            self.virtual_time[chosen.host] += 1.0 / self.host_weights[chosen.host]
+
+            chosen.last_search = now
+            self._picked_at[(chosen.host, chosen.id)] = now
+            decision = {
+                "time": int(now),
+                "host": chosen.host,
+                "id": chosen.id,
+                "name": chosen.name,
+                "reason": reason,
+                "score": round(score, 4),
+                "components": components,
+                "virtual_time": dict(self.virtual_time),
+            }
+            self.history.append(decision)
+        print("[scheduler] %(host)s %(id)s %(name)r %(reason)s score=%(score)s" % decision, components)
+        if self.on_pick is not None:
+            try:
+                self.on_pick(decision)
+            except Exception as e:
+                print("[scheduler] Could not persist the pick: %s" % e)
+        return decision
+
+    def record(self, host, entity_aid, searched, added, drained=False, next_due=None):
+        """
+        Feed back a run: matches shrink the backlog, nothing due puts the entity on cooldown.
+        drained: no due track was left, the rest of the backlog waits for next_due
+        (epoch seconds of the next due track, None when unknown: empty_cooldown).
+        """
+        with self._lock:
+            now = self._clock()
+            key = (host, entity_aid)
+            for candidate in self._candidates.get(host, []):
+                if candidate.id == entity_aid:
+                    candidate.found += added
+                    if not searched:
+                        candidate.empty_until = now + self.empty_cooldown
+                        self._empty_until[key] = candidate.empty_until
+                    if drained:
+                        candidate.due_at = now + self.empty_cooldown if next_due is None else next_due
+                        candidate.not_due = max(0, candidate.tracks - candidate.found)
+                        self._not_due[key] = (candidate.not_due, candidate.due_at)
+                    break
+            # Forget cooldowns and backoffs that are over
+            for key in [k for k, until in self._empty_until.items() if until <= now]:
+                del self._empty_until[key]
+            for key in [k for k, (_, due_at) in self._not_due.items() if due_at <= now]:
+                del self._not_due[key]
+
+    def pending(self):
+        """{host: (entities with unmatched tracks due, unmatched tracks due)} in the current snapshot."""
+        with self._lock:
+            now = self._clock()
+            pending = {}
+            for host in self.host_weights:
+                backlogs = [b for b in (c.backlog(now) for c in self._candidates.get(host, [])) if b]
+                pending[host] = (len(backlogs), sum(backlogs))
+            return pending
+
+    def decisions(self):
+        """Recent decisions, oldest first."""
+        with self._lock:
+            return list(self.history)
+
+    def queue(self, host, limit=10):
+        """Current top candidates of a host with their score components."""
+        with self._lock:
+            now = self._clock()
+            scored = [(self.score(c, now), c) for c in self._eligible(host, now, None)]
+        scored.sort(key=lambda sc: -sc[0][0])
+        return [{"id": c.id, "name": c.name, "score": round(s, 4), "components": comp}
+                for (s, comp), c in scored[:limit]]
+
+
+def parse_host_weights(value):
+    """"yt=2,dg=1" -> {"yt": 2.0, "dg": 1.0}"""
+    weights = {}
+    for part in value.split(","):
+        if part.strip():
+            host, weight = part.split("=")
+            weights[host.strip()] = float(weight)
+    return weights
@@ -0,0 +1,126 @@
+"""
+Spotify search results cached by normalized query.
+
+Results that produced a match and results that did not ("no match") are
+cached with separate TTLs, so unreleased tracks are searched again sooner.
+Lookups go through an in-process LRU tier first, then an optional durable
+tier shared by every process and replica.
+"""
+
+import json
+import os
+import time
+
+from cache import TTLCache
+
+
+def search_cache_key(query, limit):
+    """
+    Only case and whitespace are folded: sanitize() drops "feat." up to the
+    end of the string, which would take the artist: part of the query with it.
+    """
+    return "%d:%s" % (limit, " ".join(query.lower().split()))
+
+
+def compact_items(items):
+    """Drop market lists, by far the largest part of a search result."""
+    compacted = []
+    for item in items:
+        item = {k: v for k, v in item.items() if k != 'available_markets'}
+        if isinstance(item.get('album'), dict):
+            item['album'] = {k: v for k, v in item['album'].items() if k != 'available_markets'}
+        compacted.append(item)
+    return compacted
+
+
+class DynamoDBSearchStore:
+    """
+    Durable tier: one item per query in `mirrorfm_search_cache`, removed by
+    the table's TTL on `expires_at`. Set DYNAMODB_ENDPOINT_URL to run against
+    DynamoDB Local.
+    """
+
+    def __init__(self, table_name, endpoint_url=None):
+        # Used from several threads: one boto3 resource per thread
+        from dynamodb_tables import ThreadLocalTables
+
+        self.table = ThreadLocalTables('eu-west-1', endpoint_url=endpoint_url).table(table_name)
+
+    def get(self, key):
+        res = self.table.get_item(Key={'query': key})
+        if 'Item' not in res:
+            return None
+        item = res['Item']
+        return json.loads(item['items']), bool(item['matched']), int(item['expires_at'])
+
+    def put(self, key, items, matched, expires_at):
+        self.table.put_item(
+            Item={
+                'query': key,
+                'items': json.dumps(compact_items(items)),
+                'matched': matched,
+                'expires_at': int(expires_at)
+            }
+        )
+
+
+class SearchCache:
+    def __init__(self, local, durable=None, hit_ttl=30 * 86400, miss_ttl=3 * 86400, clock=time.time):
+        self.local = local
+        self.durable = durable
+        self.hit_ttl = hit_ttl
+        self.miss_ttl = miss_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.durable_hits = 0
+        self.misses = 0
+        self._clock = clock
+
+    def get(self, key):
+        """Cached search items for key, or None when the search has to run."""
+        entry = self.local.get(key)
+        if entry is None and self.durable is not None:
+            stored = self.durable.get(key)
+            if stored is not None and stored[2] > self._clock():
+                items, matched, expires_at = stored
+                entry = (items, matched)
+                self.local.set(key, entry, ttl=expires_at - self._clock())
+                self.durable_hits += 1
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if not entry[1]:
+            self.negative_hits += 1
+        return entry[0]
+
+    def expires_at(self, key):
+        """When the cached search for key runs again, None when it is not cached (locally)."""
+        return self.local.expires_at(key)
+
+    def set(self, key, items, matched):
+        """Cache search items; matched tells whether any of them passed is_match()."""
+        ttl = self.hit_ttl if matched else self.miss_ttl
+        self.local.set(key, (items, matched), ttl=ttl)
+        if self.durable is not None:
+            self.durable.put(key, items, matched, self._clock() + ttl)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "durable_hits": self.durable_hits,
+            "misses": self.misses,
+        }
+
+
+def search_cache_from_env():
+    """In-process tier always, durable tier unless SEARCH_CACHE_TABLE is set to empty."""
+    table_name = os.getenv('SEARCH_CACHE_TABLE', 'mirrorfm_search_cache')
+    durable = None
+    if table_name:
+        durable = DynamoDBSearchStore(table_name, endpoint_url=os.getenv('DYNAMODB_ENDPOINT_URL') or None)
+    return SearchCache(TTLCache(maxsize=int(os.getenv('SEARCH_CACHE_SIZE', '20000')), ttl=0),
+                       durable=durable,
+                       hit_ttl=int(os.getenv('SEARCH_CACHE_HIT_TTL', str(30 * 86400))),
+                       miss_ttl=int(os.getenv('SEARCH_CACHE_MISS_TTL', str(3 * 86400))))
@@ -8,7 +8,15 @@ Long-term target: move to trackfilter library.
 """
 
 import re
+from collections import Counter
 from difflib import SequenceMatcher
+from functools import lru_cache
+
+try:
+    # C-accelerated Indel similarity; the pure-Python bit-parallel path below is the fallback
+    from rapidfuzz.distance import Indel as _rf_indel
+except ImportError:
+    _rf_indel = None
 
 TRACK_SIMILARITY_THRESHOLD = 0.8
 TRACK_SIMILARITY_EXCLUDES = [
@@ -27,10 +35,174 @@ TRACK_SIMILARITY_EXCLUDES = [
     "filtered version",
 ]
 
+# Upper bound on distinct strings kept by the sanitize/artist_combinations caches
+SANITIZE_CACHE_SIZE = 8192
+
+# One pass to detect whether any exclude is present at all (the common case is none)
+_EXCLUDES_RE = re.compile("|".join(re.escape(sub) for sub in TRACK_SIMILARITY_EXCLUDES))
+_FEAT_RE = re.compile(r"\(?\b(feat\.?|ft\.?|featuring)\b[^)]*\)?")
+_AND_RE = re.compile(r"\band\b")
+_ARCHIVED_RE = re.compile(r'\s+archived$', flags=re.IGNORECASE)
+_AKA_RE = re.compile(r'\s+\b(aka|a\.k\.a\.?)\b.*$', flags=re.IGNORECASE)
+
+
+class _KeepTable(dict):
+    """
+    str.translate table: keeps alphanumerics and spaces, drops everything else,
+    and turns "&" into a space. Filled lazily per code point so it stays
+    exact for the whole unicode range.
+    """
+
+    def __missing__(self, codepoint):
+        ch = chr(codepoint)
+        value = codepoint if ch.isalnum() or ch == " " else None
+        self[codepoint] = value
+        return value
+
+
+_KEEP_TABLE = _KeepTable({ord("&"): " "})
+
+
+def lcs_length(a, b):
+    """
+    Length of the longest common subsequence of two strings.
+    Bit-parallel (Hyyrö) over Python ints: one pass over the longer string,
+    no quadratic table.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return 0
+    masks = {}
+    for i, ch in enumerate(b):
+        masks[ch] = masks.get(ch, 0) | (1 << i)
+    full = (1 << len(b)) - 1
+    v = full
+    for ch in a:
+        u = v & masks.get(ch, 0)
+        v = ((v + u) | (v - u)) & full
+    return len(b) - v.bit_count()
+
+
+def indel_ratio(a, b):
+    """Normalized Indel similarity: 2 * LCS / (len(a) + len(b))."""
+    total = len(a) + len(b)
+    if total == 0:
+        return 1.0
+    if _rf_indel is not None:
+        return _rf_indel.normalized_similarity(a, b)
+    return 2.0 * lcs_length(a, b) / total
+
+
+class SimilarityEngine:
+    """Scores two sanitized strings between 0 and 1."""
+    name = None
+
+    def ratio(self, a, b):
+        raise NotImplementedError
+
+
+class DifflibEngine(SimilarityEngine):
+    """Reference scores: difflib.SequenceMatcher, pure Python."""
+    name = "difflib"
+
+    def ratio(self, a, b):
+        return SequenceMatcher(None, a, b).ratio()
+
+
+class IndelEngine(SimilarityEngine):
+    """
+    LCS-based ratio. Never lower than the difflib ratio (SequenceMatcher's
+    matching blocks are themselves a common subsequence), usually equal.
+    """
+    name = "indel"
+
+    def ratio(self, a, b):
+        return indel_ratio(a, b)
+
+
+class CompatEngine(SimilarityEngine):
+    """
+    difflib-compatible scores at Indel speed.
+
+    The Indel ratio is an upper bound of the difflib ratio, so when it is
+    below the threshold the pair cannot match and the bound is returned.
+    Otherwise the exact difflib ratio is computed: every pass/fail decision
+    and every passing score is identical to DifflibEngine.
+    """
+    name = "compat"
+
+    def __init__(self, threshold=TRACK_SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self._exact = DifflibEngine()
+
+    def ratio(self, a, b):
+        bound = indel_ratio(a, b)
+        if bound < self.threshold:
+            return bound
+        return self._exact.ratio(a, b)
+
+
+ENGINES = {engine.name: engine for engine in (DifflibEngine, IndelEngine, CompatEngine)}
+
+_engine = CompatEngine()
+
+
+def get_engine():
+    return _engine
+
+
+def set_engine(name):
+    """Select the engine used by similar() and is_match(): difflib, indel or compat."""
+    global _engine
+    if name not in ENGINES:
+        raise ValueError("Unknown similarity engine %r, expected one of %s" % (name, sorted(ENGINES)))
+    _engine = ENGINES[name]()
+    return _engine
+
 
 def similar(a, b):
-    """SequenceMatcher ratio between two strings."""
-    return SequenceMatcher(None, a, b).ratio()
+    """Similarity ratio between two strings, using the selected engine."""
+    return _engine.ratio(a, b)
+
+
+def length_bound(a, b):
+    """Upper bound of any ratio from lengths alone (difflib's real_quick_ratio)."""
+    total = len(a) + len(b)
+    if total == 0:
+        return 1.0
+    return 2.0 * min(len(a), len(b)) / total
+
+
+@lru_cache(maxsize=SANITIZE_CACHE_SIZE)
+def _char_counts(text):
+    return Counter(text)
+
+
+def char_bound(a, b):
+    """Upper bound of any ratio from shared characters (difflib's quick_ratio)."""
+    total = len(a) + len(b)
+    if total == 0:
+        return 1.0
+    counts_a, counts_b = _char_counts(a), _char_counts(b)
+    if len(counts_a) > len(counts_b):
+        counts_a, counts_b = counts_b, counts_a
+    shared = sum(min(n, counts_b[ch]) for ch, n in counts_a.items() if ch in counts_b)
+    return 2.0 * shared / total
+
+
+def similar_bounded(a, b, cutoff):
+    """
+    similar(a, b), or None when cheap upper bounds already prove the
+    ratio is below cutoff. Bounds hold for every engine.
+    """
+    if length_bound(a, b) < cutoff or char_bound(a, b) < cutoff:
+        return None
+    return similar(a, b)
+
+
+def _token_overlap(a, b):
+    return len(set(a.split()) & set(b.split()))
 
 
 def clean_artist(artist_name):
@@ -38,29 +210,38 @@ def clean_artist(artist_name):
     Clean an artist name for comparison.
     Strips 'archived' suffix and 'aka' aliases.
     """
-    artist_name = re.sub(r'\s+archived$', '', artist_name, flags=re.IGNORECASE)
-    artist_name = re.sub(r'\s+\b(aka|a\.k\.a\.?)\b.*$', '', artist_name, flags=re.IGNORECASE)
+    artist_name = _ARCHIVED_RE.sub('', artist_name)
+    artist_name = _AKA_RE.sub('', artist_name)
     return artist_name
 
 
+@lru_cache(maxsize=SANITIZE_CACHE_SIZE)
 def sanitize(track):
     """
     Clean a track string for similarity comparison.
     Applied identically to both sides of the comparison.
     """
     track = track.lower()
-    # Remove generic suffixes that don't change the track identity
-    for sub in TRACK_SIMILARITY_EXCLUDES:
-        track = track.replace(sub, "")
+    # Remove generic suffixes that don't change the track identity.
+    # Removal stays sequential (in list order) so overlapping excludes behave
+    # exactly as before; the combined pattern only skips it when none occur.
+    if _EXCLUDES_RE.search(track):
+        for sub in TRACK_SIMILARITY_EXCLUDES:
+            track = track.replace(sub, "")
     # Strip featured artist credits
-    track = re.sub(r"\(?\b(feat\.?|ft\.?|featuring)\b[^)]*\)?", "", track)
-    # Normalize artist connectors: &, "and" are interchangeable in music
-    track = track.replace("&", " ")
-    track = re.sub(r"\band\b", " ", track)
+    track = _FEAT_RE.sub("", track)
+    # Normalize artist connectors: &, "and" are interchangeable in music.
+    # "&" is turned into a space by the translate table below; both are
+    # non-word characters so the \band\b boundaries are unaffected.
+    track = _AND_RE.sub(" ", track)
     # Keep alphanumeric + spaces, normalize whitespace
-    track = "".join(ch for ch in track if ch.isalnum() or ch == " ")
-    track = " ".join(track.split())
-    return track
+    track = track.translate(_KEEP_TABLE)
+    return " ".join(track.split())
+
+
+def sanitize_many(tracks):
+    """Sanitize a batch of strings, sharing the sanitize() cache."""
+    return [sanitize(track) for track in tracks]
 
 
 def artist_combinations(artist_names):
@@ -76,39 +257,49 @@ def artist_combinations(artist_names):
     Returns:
         set of name combinations
     """
+    return set(_artist_combinations(tuple(artist_names)))
+
+
+@lru_cache(maxsize=SANITIZE_CACHE_SIZE)
+def _artist_combinations(artist_names):
     combos = set()
     for i in range(len(artist_names)):
         combos.add(artist_names[i])
         combos.add(" ".join(artist_names[:i + 1]))
     combos.add(" ".join(artist_names))
-    return combos
+    return frozenset(combos)
 
 
-def is_match(yt_artists, yt_track, sp_artists, sp_track, first_yt_artist=None):
+def is_match(yt_artists, yt_track, sp_artists, sp_track, first_yt_artist=None, exact=True):
     """
     Check if a YouTube track matches a candidate track.
 
+    Candidates sharing the most words are scored first, and any candidate
+    whose upper bound (length, shared characters) cannot beat the current
+    best score, or the threshold when exact=False, is skipped.
+
     Args:
         yt_artists: joined artist string from YouTube (e.g. "Black Loops James Pepper")
         yt_track: track name from YouTube (e.g. "Three Drops")
         sp_artists: list of artist name strings from the candidate (e.g. ["Black Loops", "James Pepper"])
         sp_track: track name from the candidate (e.g. "Three Drops")
         first_yt_artist: first YouTube artist only, for multi-artist fallback (e.g. "Black Loops")
+        exact: when False, stop at the first passing candidate; the score is then
+            that candidate's score, or a lower bound of the best score on failure
 
     Returns:
         (passes, score) — whether it passes the threshold, and the similarity score
     """
     # Clean candidate artists and build combinations
     sp_artists_clean = [clean_artist(a) for a in sp_artists]
-    sp_combos = artist_combinations(sp_artists_clean)
+    sp_combos = _artist_combinations(tuple(sp_artists_clean))
 
     # Build all "Artist - Track" candidates
-    candidates = [f"{combo} - {sp_track}" for combo in sp_combos]
+    candidates = sanitize_many(f"{combo} - {sp_track}" for combo in sp_combos)
 
     # Compare full YT string against all candidates
     yt_full = f"{yt_artists} - {yt_track}"
-    s1 = sanitize(yt_full)
-    best_score = max(similar(s1, sanitize(c)) for c in candidates)
+    best_score = _best_score(sanitize(yt_full), candidates, 0.0, exact)
 
     if best_score >= TRACK_SIMILARITY_THRESHOLD:
         return True, best_score
@@ -116,9 +307,29 @@ def is_match(yt_artists, yt_track, sp_artists, sp_track, first_yt_artist=None):
     # First-artist fallback for multi-artist YouTube titles
     if first_yt_artist and first_yt_artist != yt_artists:
         yt_first = f"{first_yt_artist} - {yt_track}"
-        s1_first = sanitize(yt_first)
-        score = max(similar(s1_first, sanitize(c)) for c in candidates)
-        if score > best_score:
-            best_score = score
+        best_score = _best_score(sanitize(yt_first), candidates, best_score, exact)
 
     return best_score >= TRACK_SIMILARITY_THRESHOLD, best_score
+
+
+def _best_score(s1, candidates, best_score, exact):
+    """
+    Highest similar(s1, c) above best_score. With exact=False, returns as soon
+    as a candidate reaches the threshold and skips anything that cannot.
+    """
+    ordered = sorted(candidates, key=lambda c: _token_overlap(s1, c), reverse=True)
+    for c in ordered:
+        if exact:
+            # Strictly above the current best, otherwise it cannot change the result
+            if length_bound(s1, c) <= best_score or char_bound(s1, c) <= best_score:
+                continue
+            score = similar(s1, c)
+        else:
+            score = similar_bounded(s1, c, TRACK_SIMILARITY_THRESHOLD)
+            if score is None:
+                continue
+            if score >= TRACK_SIMILARITY_THRESHOLD:
+                return score
+        if score > best_score:
+            best_score = score
+    return best_score
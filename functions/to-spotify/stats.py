@@ -0,0 +1,70 @@
+"""
+SQL for the per-entity statistics written at the end of a run.
+
+Statements are built once per host config with table names filled in and
+every value left as a parameter. Genre counts go out as multi-row upserts
+that add the counts accumulated during the run.
+"""
+
+# Rows per INSERT, well under max_allowed_packet with 64-char genre names
+GENRE_ROWS_PER_STATEMENT = 500
+
+
+class StatsStatements:
+    def __init__(self, playlist_table, genres_table, genres_entity_column):
+        self.playlist_found = (
+            'UPDATE ' + playlist_table
+            + ' SET count_followers=%s, found_tracks=%s, last_search_time=NOW(), last_found_time=NOW()'
+            + ' WHERE spotify_playlist=%s AND num=%s')
+        self.playlist_searched = (
+            'UPDATE ' + playlist_table
+            + ' SET count_followers=%s, last_search_time=NOW()'
+            + ' WHERE spotify_playlist=%s AND num=%s')
+        self.playlist_tracks_added = (
+            'UPDATE ' + playlist_table + ' SET found_tracks = found_tracks + %s WHERE spotify_playlist=%s')
+        self.playlist_tracks = (
+            'UPDATE ' + playlist_table + ' SET found_tracks=%s WHERE spotify_playlist=%s')
+        self.genres_insert = (
+            'INSERT INTO ' + genres_table
+            + ' (' + genres_entity_column + ', genre_name, count, last_updated) VALUES ')
+        self.genres_row = '(%s, %s, %s, NOW())'
+        self.genres_update = ' ON DUPLICATE KEY UPDATE count = count + VALUES(count), last_updated = VALUES(last_updated)'
+
+    def genres_upsert(self, rows):
+        return self.genres_insert + ', '.join([self.genres_row] * rows) + self.genres_update
+
+
+def update_playlist_stats(cursor, statements, pl_id, num, followers, found_tracks=None):
+    """found_tracks is the playlist's track total when tracks were added in this run."""
+    if found_tracks is None:
+        cursor.execute(statements.playlist_searched, [followers, pl_id, num])
+    else:
+        cursor.execute(statements.playlist_found, [followers, found_tracks, pl_id, num])
+
+
+def add_playlist_tracks(cursor, statements, pl_id, count):
+    """Count `count` tracks just added to the playlist."""
+    cursor.execute(statements.playlist_tracks_added, [count, pl_id])
+
+
+def set_playlist_tracks(cursor, statements, pl_id, total):
+    """Replace the playlist's track count with the total reported by Spotify."""
+    cursor.execute(statements.playlist_tracks, [total, pl_id])
+
+
+def upsert_genre_counts(cursor, statements, entity_aid, counts, rows_per_statement=GENRE_ROWS_PER_STATEMENT):
+    """
+    Add `counts` ({genre: tracks}) to the entity's genre rows.
+    Returns the number of statements sent.
+    """
+    # Same row order on every replica, so concurrent upserts lock rows in the same order
+    genres = sorted(counts)
+    sent = 0
+    for start in range(0, len(genres), rows_per_statement):
+        chunk = genres[start:start + rows_per_statement]
+        params = []
+        for genre in chunk:
+            params += [entity_aid, genre, counts[genre]]
+        cursor.execute(statements.genres_upsert(len(chunk)), params)
+        sent += 1
+    return sent
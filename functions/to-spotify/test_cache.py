@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Unit tests for cache.py — TTL/LRU cache."""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_expiry():
+    clock = FakeClock()
+    cache = TTLCache(maxsize=10, ttl=60, clock=clock)
+    cache.set("artist", ["house"])
+    cache.set("album", [], ttl=5)
+    assert cache.get("artist") == ["house"]
+    # Falsy values are cached too
+    assert cache.get("album") == []
+    clock.now = 10
+    assert cache.get("album") is None
+    clock.now = 61
+    assert cache.get("artist") is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    print("  ttl expiry: PASS")
+
+
+def test_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=60, clock=FakeClock())
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
+
+    print("  lru eviction: PASS")
+
+
+def test_evict():
+    cache = TTLCache(maxsize=10, ttl=60, clock=FakeClock())
+    for i in range(5):
+        cache.set(("yt", i), i)
+    assert cache.evict(lambda key, value: value % 2 == 0) == 3
+    assert [cache.get(("yt", i)) for i in range(5)] == [None, 1, None, 3, None]
+
+    print("  evict: PASS")
+
+
+if __name__ == "__main__":
+    print("Running cache tests...")
+    test_ttl_expiry()
+    test_lru_eviction()
+    test_evict()
+    print("\nALL TESTS PASSED")
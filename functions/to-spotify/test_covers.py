@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Unit tests for covers.py — cover download cache."""
+
+import base64
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from cache import TTLCache
+from covers import CoverCache, cover_key
+
+
+class FakeFetch:
+    def __init__(self, content=b"jpeg-bytes"):
+        self.content = content
+        self.urls = []
+
+    def __call__(self, url):
+        self.urls.append(url)
+        return self.content
+
+
+def test_cover_downloaded_once():
+    fetch = FakeFetch()
+    covers = CoverCache(TTLCache(maxsize=4, ttl=60), fetch)
+    url = "https://i.ytimg.com/vi/x/mqdefault.jpg"
+    first = covers.get(url)
+    # Rollover playlist of the same entity
+    assert covers.get(url) == first
+    assert fetch.urls == [url]
+    assert covers.downloads == 1
+    assert base64.b64decode(first) == b"jpeg-bytes"
+
+    print("  cover cached: PASS")
+
+
+def test_cover_key_separates_resized():
+    url = "https://img.discogs.com/label.jpg"
+    assert cover_key(url, True) != cover_key(url, False)
+    assert cover_key(url, False) == cover_key(url, False)
+
+    print("  cover key: PASS")
+
+
+def test_resized_cover():
+    try:
+        from PIL import Image
+    except ImportError:
+        print("  resized cover: SKIP (Pillow not installed)")
+        return
+    from io import BytesIO
+
+    buffered = BytesIO()
+    Image.new("RGB", (1200, 1200), "red").save(buffered, format="JPEG")
+    covers = CoverCache(TTLCache(maxsize=4, ttl=60), FakeFetch(buffered.getvalue()))
+    encoded = covers.get("https://img.discogs.com/label.jpg", resize=True)
+    assert Image.open(BytesIO(base64.b64decode(encoded))).size == (300, 300)
+
+    print("  resized cover: PASS")
+
+
+if __name__ == "__main__":
+    print("Running covers tests...")
+    test_cover_downloaded_once()
+    test_cover_key_separates_resized()
+    test_resized_cover()
+    print("\nALL TESTS PASSED")
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Tests for main.py — entity workers against fake Spotify, DynamoDB and MySQL.
+Needs the function's requirements (spotipy, boto3, pymysql...) installed.
+"""
+
+import sys
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'scripts'))
+
+# In-process search cache only, entities not sharded
+os.environ['SEARCH_CACHE_TABLE'] = ''
+os.environ.pop('ENTITY_SHARDS', None)
+
+import main
+import spotipy
+
+LABEL_ID = 1234
+LABEL_AID = 7
+
+
+class FakeSpotify:
+    """
+    Search finds every "track:<title> artist:<artist>" query but the `missing` titles;
+    playlists hold at most `max_length` tracks.
+    """
+
+    def __init__(self, max_length, add_errors=(), missing=()):
+        self.max_length = max_length
+        self.missing = set(missing)
+        self.searches = 0
+        # Raised by the next adds, one per call
+        self.add_errors = list(add_errors)
+        self.playlists = {}
+        self.created = []
+        self.added = []
+        self._lock = threading.Lock()
+
+    def search(self, query, limit, type):
+        # Lets the other worker run meanwhile
+        time.sleep(0.01)
+        title, artist = re.match(r'track:(.*) artist:(.*)', query).groups()
+        with self._lock:
+            self.searches += 1
+        if title in self.missing:
+            return {'tracks': {'items': []}}
+        return {'tracks': {'items': [{
+            'uri': 'spotify:track:%s' % title.replace(' ', '-'),
+            'name': title,
+            'artists': [{'id': 'artist-' + artist, 'name': artist}],
+            'album': {'id': 'album-' + title},
+        }]}}
+
+    def albums(self, ids):
+        return {'albums': [{'id': i, 'genres': ['house']} for i in ids]}
+
+    def artists(self, ids):
+        return {'artists': [{'id': i, 'genres': ['techno']} for i in ids]}
+
+    def user_playlist_create(self, user, name, public=True):
+        with self._lock:
+            playlist_id = 'pl%d' % (len(self.playlists) + 1)
+            self.playlists[playlist_id] = []
+            self.created.append(name)
+        return {'id': playlist_id}
+
+    def user_playlist_add_tracks(self, user, playlist_id, uris, position=None):
+        with self._lock:
+            if self.add_errors:
+                raise self.add_errors.pop(0)
+            tracks = self.playlists[playlist_id]
+            if len(tracks) + len(uris) > self.max_length:
+                raise Exception("Playlist is full")
+            tracks[0:0] = uris
+            self.added += uris
+
+    def user_playlist(self, user, playlist_id, fields=None):
+        return {'tracks': {'total': len(self.playlists[playlist_id])}}
+
+    def playlist(self, playlist_id):
+        return {'followers': {'total': 0}, 'tracks': {'total': len(self.playlists[playlist_id])}}
+
+    def playlist_change_details(self, playlist_id, description=None):
+        pass
+
+
+class FakeTracksTable:
+    """The label's tracks; query() returns the unmatched ones that are due, in one page."""
+
+    def __init__(self, records):
+        self.records = {r['dg_track_composite']: r for r in records}
+        self._lock = threading.Lock()
+
+    def query(self, **kwargs):
+        now = int(time.time())
+        with self._lock:
+            return {'Items': [dict(r) for r in self.records.values()
+                              if 'spotify_uri' not in r and int(r.get('next_search_time', 0)) <= now]}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues):
+        with self._lock:
+            record = self.records[Key['dg_track_composite']]
+            for name, value in ExpressionAttributeValues.items():
+                record[name[1:]] = value
+
+
+class FakeDuplicatesTable:
+    def __init__(self):
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def query(self, **kwargs):
+        with self._lock:
+            return {'Items': [{'spotify_uri': uri} for uri in self.items]}
+
+    def get_item(self, Key):
+        with self._lock:
+            return {'Item': self.items[Key['spotify_uri']]} if Key['spotify_uri'] in self.items else {}
+
+    @contextmanager
+    def batch_writer(self):
+        yield self
+
+    def put_item(self, Item):
+        with self._lock:
+            self.items[Item['spotify_uri']] = Item
+
+    def delete_item(self, Key):
+        with self._lock:
+            self.items.pop(Key['spotify_uri'], None)
+
+
+class FakeEventsTable:
+    def put_item(self, Item):
+        pass
+
+
+class FakeMySQL:
+    """dg_playlists rows, for the statements the entity workers send."""
+
+    def __init__(self):
+        self.playlists = []
+        self._lock = threading.Lock()
+
+    def execute(self, query, args=None):
+        with self._lock:
+            if query.startswith('SELECT * FROM dg_playlists'):
+                rows = sorted(self.playlists, key=lambda p: -p['num'])[:1]
+                return [dict(row) for row in rows]
+            if query.startswith('insert into dg_playlists'):
+                label_id, num, playlist_id = args
+                if any(p['num'] == num for p in self.playlists):
+                    raise Exception("Duplicate entry for key 'PRIMARY'")
+                self.playlists.append({'label_id': label_id, 'num': num, 'spotify_playlist': playlist_id,
+                                       'found_tracks': 0})
+            elif 'found_tracks = found_tracks + %s' in query:
+                self.playlist(args[1])['found_tracks'] += args[0]
+            elif 'SET found_tracks=%s WHERE' in query:
+                self.playlist(args[1])['found_tracks'] = args[0]
+            elif 'found_tracks=%s, last_search_time' in query:
+                self.playlist(args[2])['found_tracks'] = args[1]
+            return []
+
+    def playlist(self, playlist_id):
+        return next(p for p in self.playlists if p['spotify_playlist'] == playlist_id)
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+
+    def execute(self, query, args=None):
+        self.rows = self.db.execute(query, args)
+        return len(self.rows)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+class FakePool:
+    def __init__(self, db):
+        self.db = db
+
+    @contextmanager
+    def connection(self):
+        yield FakeConnection(self.db)
+
+    def metrics(self):
+        return {}
+
+
+def label_records(count):
+    return [{'dg_label_id': LABEL_ID, 'dg_track_composite': 'release-%d' % i,
+             'title': 'Track %d' % i, 'artistssort': 'Artist %d' % i} for i in range(count)]
+
+
+LABEL_ROW = {'id': LABEL_AID, 'label_id': LABEL_ID, 'label_name': 'Label'}
+
+
+@contextmanager
+def fake_label(tracks, duplicates, db, max_length):
+    """main's Discogs tables, MySQL pool and playlist size swapped for the fakes."""
+    cat = main.cats[main.DG_HOST]
+    saved = (main.db_pool, main.events_table, cat['tracks_table'], cat['duplicates_table'],
+             main.PLAYLIST_EXPECTED_MAX_LENGTH, main.PLAYLIST_RECONCILE_MARGIN)
+    main.db_pool = FakePool(db)
+    main.events_table = FakeEventsTable()
+    cat['tracks_table'], cat['duplicates_table'] = tracks, duplicates
+    main.PLAYLIST_EXPECTED_MAX_LENGTH, main.PLAYLIST_RECONCILE_MARGIN = max_length, 1
+    # Loaded from another test's table otherwise
+    main.duplicate_indexes.evict(lambda key, index: True)
+    try:
+        yield
+    finally:
+        (main.db_pool, main.events_table, cat['tracks_table'], cat['duplicates_table'],
+         main.PLAYLIST_EXPECTED_MAX_LENGTH, main.PLAYLIST_RECONCILE_MARGIN) = saved
+
+
+def test_two_workers_on_one_entity():
+    sp = FakeSpotify(max_length=5)
+    tracks = FakeTracksTable(label_records(6))
+    duplicates = FakeDuplicatesTable()
+    db = FakeMySQL()
+    # The label's playlist has room for 2 more tracks
+    first = sp.user_playlist_create(None, 'Label')['id']
+    sp.playlists[first] += ['spotify:track:older-%d' % i for i in range(3)]
+    db.playlists.append({'label_id': LABEL_ID, 'num': 1, 'spotify_playlist': first, 'found_tracks': 3})
+
+    with fake_label(tracks, duplicates, db, max_length=5):
+        # e.g. an SQS event and the rediscovery of the same label
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(lambda _: main.process_entity(sp, main.DG_HOST, LABEL_ROW), range(2)))
+
+    # No track added twice, one rollover
+    assert len(sp.added) == len(set(sp.added)) == 6
+    assert sp.created == ['Label', 'Label (2)']
+    assert [len(sp.playlists[p]) for p in ('pl1', 'pl2')] == [5, 4]
+    assert [p['found_tracks'] for p in db.playlists] == [5, 4]
+    assert sorted(r['added'] for r in results) == [0, 6]
+    assert all('spotify_uri' in r for r in tracks.records.values())
+    assert len(duplicates.items) == 6
+    assert not main.entities_in_progress
+
+    print("  two workers on one entity: PASS")
+
+
+def test_failed_add_leaves_tracks_matchable():
+    sp = FakeSpotify(max_length=100, add_errors=[spotipy.SpotifyException(500, -1, "Server error")])
+    tracks = FakeTracksTable(label_records(3))
+    duplicates = FakeDuplicatesTable()
+    db = FakeMySQL()
+    first = sp.user_playlist_create(None, 'Label')['id']
+    db.playlists.append({'label_id': LABEL_ID, 'num': 1, 'spotify_playlist': first, 'found_tracks': 0})
+
+    with fake_label(tracks, duplicates, db, max_length=100):
+        try:
+            main.process_entity(sp, main.DG_HOST, LABEL_ROW)
+            assert False, "expected the add to fail"
+        except spotipy.SpotifyException:
+            pass
+        # Not in the playlist, so not in the duplicate index either
+        assert sp.added == []
+        assert duplicates.items == {}
+        assert not any('spotify_uri' in r for r in tracks.records.values())
+
+        result = main.process_entity(sp, main.DG_HOST, LABEL_ROW)
+
+    assert result['added'] == 3
+    assert sorted(sp.added) == ['spotify:track:Track-%d' % i for i in range(3)]
+    assert len(duplicates.items) == 3
+    assert all('spotify_uri' in r for r in tracks.records.values())
+
+    print("  failed add leaves tracks matchable: PASS")
+
+
+def test_cached_miss_keeps_backoff():
+    sp = FakeSpotify(max_length=100, missing=['Unreleased'])
+    key = 'release-unreleased'
+    tracks = FakeTracksTable([{'dg_label_id': LABEL_ID, 'dg_track_composite': key,
+                               'title': 'Unreleased', 'artistssort': 'Artist'}])
+    db = FakeMySQL()
+    first = sp.user_playlist_create(None, 'Label')['id']
+    db.playlists.append({'label_id': LABEL_ID, 'num': 1, 'spotify_playlist': first, 'found_tracks': 0})
+
+    with fake_label(tracks, FakeDuplicatesTable(), db, max_length=100):
+        now = int(time.time())
+        main.process_entity(sp, main.DG_HOST, LABEL_ROW)
+        record = tracks.records[key]
+        assert record['search_attempts'] == 1
+        assert now <= record['next_search_time'] - main.RESEARCH_BACKOFF_BASE <= now + 2
+        searches = sp.searches
+        assert searches > 0
+
+        # Due again while its searches are still cached as "no match"
+        # (RESEARCH_BACKOFF_BASE < SEARCH_CACHE_MISS_TTL)
+        record['next_search_time'] = 0
+        main.process_entity(sp, main.DG_HOST, LABEL_ROW)
+
+    # No search spent, so no attempt: due when the cached misses expire
+    assert sp.searches == searches
+    assert record['search_attempts'] == 1
+    assert now <= record['next_search_time'] - main.search_cache.miss_ttl <= now + 2
+
+    print("  cached miss keeps backoff: PASS")
+
+
+if __name__ == "__main__":
+    print("Running main tests...")
+    test_two_workers_on_one_entity()
+    test_failed_add_leaves_tracks_matchable()
+    test_cached_miss_keeps_backoff()
+    print("\nALL TESTS PASSED")
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""Unit tests for ratelimit.py — token buckets and the Spotify proxy."""
+
+import sys
+import os
+import http.server
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from ratelimit import (
+    LocalBackend,
+    RateLimitedSpotify,
+    SpotifyLimiter,
+    TokenBucket,
+    spotify_session,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__("http status: 429")
+        self.http_status = 429
+        self.headers = {"Retry-After": str(retry_after)}
+
+
+class FakeSpotify:
+    def __init__(self, failures=0, retry_after=2):
+        self.calls = []
+        self.failures = failures
+        self.retry_after = retry_after
+
+    def search(self, q, limit=1, type="track"):
+        self.calls.append(("search", q))
+        if self.failures:
+            self.failures -= 1
+            raise RateLimited(self.retry_after)
+        return {"tracks": {"items": []}}
+
+    def playlist_add_items(self, playlist_id, items):
+        self.calls.append(("playlist_add_items", playlist_id))
+
+
+def make_bucket(clock, name="read", rate=2, burst=2, backend=None, window=30):
+    return TokenBucket(name, rate, burst, backend=backend, window=window,
+                       reserve_chunk=1, clock=clock, sleep=clock.sleep)
+
+
+def test_bucket_paces_after_burst():
+    clock = FakeClock()
+    bucket = make_bucket(clock)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    # Burst spent: the next token comes after 1 / rate seconds
+    assert abs(bucket.acquire() - 0.5) < 1e-9
+    assert abs(bucket.waited - 0.5) < 1e-9
+
+    print("  bucket pacing: PASS")
+
+
+def test_bucket_pause():
+    clock = FakeClock()
+    bucket = make_bucket(clock)
+    bucket.pause(10)
+    waited = bucket.acquire()
+    assert waited >= 10
+
+    print("  bucket pause: PASS")
+
+
+def test_shared_backend_splits_budget():
+    clock = FakeClock()
+    backend = LocalBackend(clock=clock)
+    # 1 token/s over a 4s window: 4 tokens per window for both replicas together
+    replicas = [make_bucket(clock, rate=1, burst=10, backend=backend, window=4) for _ in range(2)]
+    start = clock.now
+    for _ in range(4):
+        for bucket in replicas:
+            bucket.acquire()
+    # 8 tokens at 4 per window need a second window
+    assert clock.now - start >= 4
+
+    # A pause seen by one replica applies to the other
+    replicas[0].pause(30)
+    before = clock.now
+    replicas[1].allowance = 0
+    replicas[1].acquire()
+    assert clock.now - before >= 30
+
+    print("  shared backend: PASS")
+
+
+class ThrottlingHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the first request with a 429, the next ones with an empty search."""
+
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if len(self.requests) == 1:
+            self.send_response(429)
+            self.send_header("Retry-After", "3")
+            body = b'{"error": {"status": 429, "message": "API rate limit exceeded"}}'
+        else:
+            self.send_response(200)
+            body = b'{"tracks": {"items": []}}'
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_proxy_retries_after_429():
+    import spotipy
+
+    ThrottlingHandler.requests = []
+    server = http.server.HTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        # A real spotipy client and session: the 429 must not be waited out by urllib3
+        sp = spotipy.Spotify(auth="token", requests_session=spotify_session())
+        sp.prefix = "http://127.0.0.1:%d/v1/" % server.server_address[1]
+        clock = FakeClock()
+        limiter = SpotifyLimiter(make_bucket(clock, "read"), make_bucket(clock, "write"))
+        observed = []
+        proxy = RateLimitedSpotify(sp, limiter, observe=lambda method, seconds, error: observed.append((method, error)))
+
+        started = time.monotonic()
+        before = clock.now
+        assert proxy.search("track:x artist:y", limit=5, type="track") == {"tracks": {"items": []}}
+        assert time.monotonic() - started < 3
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert len(ThrottlingHandler.requests) == 2
+    # The read bucket was paused for the Retry-After
+    assert limiter.read.blocked_until >= before + 3
+    assert clock.now - before >= 3
+    # Every API call is observed, the 429 included
+    assert observed == [("search", True), ("search", False)]
+    assert limiter.write.tokens == limiter.write.burst
+
+    print("  proxy 429 retry: PASS")
+
+
+def test_proxy_gives_up_on_long_retry_after():
+    clock = FakeClock()
+    limiter = SpotifyLimiter(make_bucket(clock, "read"), make_bucket(clock, "write"))
+    sp = FakeSpotify(failures=1, retry_after=3600)
+    proxy = RateLimitedSpotify(sp, limiter)
+    try:
+        proxy.search("q")
+        assert False, "expected the 429 to be raised"
+    except RateLimited:
+        pass
+    assert limiter.read.blocked_until >= clock.now + 3600 - 1
+
+    print("  proxy long Retry-After: PASS")
+
+
+if __name__ == "__main__":
+    print("Running ratelimit tests...")
+    test_bucket_paces_after_burst()
+    test_bucket_pause()
+    test_shared_backend_splits_budget()
+    test_proxy_retries_after_429()
+    test_proxy_gives_up_on_long_retry_after()
+    print("\nALL TESTS PASSED")
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Unit tests for scheduler.py — priority entity scheduler."""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from scheduler import EntityScheduler, parse_host_weights
+
+DAY = 86400
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100 * DAY
+
+    def __call__(self):
+        return self.now
+
+
+def entity(id, tracks=100, found=50, last_search=None, last_activity=None):
+    return {'id': id, 'name': 'e%d' % id, 'tracks': tracks, 'found': found,
+            'last_search': last_search, 'last_activity': last_activity}
+
+
+def scheduler(entities, clock, weights=None, **kwargs):
+    return EntityScheduler(lambda host: entities.get(host, []), weights or {'yt': 1, 'dg': 1},
+                           clock=clock, **kwargs)
+
+
+def test_scores_backlog_activity_and_match_rate():
+    clock = FakeClock()
+    now = clock.now
+    s = scheduler({'yt': [
+        entity(1, tracks=1000, found=10, last_search=now - DAY),
+        entity(2, tracks=1000, found=500, last_search=now - DAY),
+        entity(3, tracks=10, found=5, last_search=now - DAY, last_activity=now - 3600),
+        entity(4, tracks=10, found=5, last_search=now - DAY),
+    ]}, clock)
+    s.refresh()
+    scores = {q['id']: q['score'] for q in s.queue('yt')}
+    # Bigger backlog, but most of it never matches
+    assert scores[2] > scores[1]
+    # Recent uploads
+    assert scores[3] > scores[4]
+    # Just searched: only the aging term is left
+    assert entity_score(s, 1000, 500, now) < scores[4]
+
+    print("  scoring: PASS")
+
+
+def entity_score(s, tracks, found, last_search):
+    from scheduler import Candidate
+    return s.score(Candidate('yt', 0, tracks=tracks, found=found, last_search=last_search), s._clock())[0]
+
+
+def test_weighted_fair_queue_between_hosts():
+    clock = FakeClock()
+    now = clock.now
+    entities = {
+        'yt': [entity(i, last_search=now - DAY) for i in range(1, 50)],
+        'dg': [entity(i, last_search=now - DAY) for i in range(1, 50)],
+    }
+    s = scheduler(entities, clock, weights={'yt': 2, 'dg': 1})
+    hosts = [s.pick()['host'] for _ in range(30)]
+    assert hosts.count('yt') == 20 and hosts.count('dg') == 10
+    # Decisions are kept with their score components
+    decisions = s.decisions()
+    assert len(decisions) == 30
+    assert set(decisions[0]['components']) == {'backlog', 'match_rate', 'activity', 'readiness', 'aging'}
+    assert decisions[0]['reason'] == 'score'
+
+    print("  weighted fair queue: PASS")
+
+
+def test_starved_entity_goes_first():
+    clock = FakeClock()
+    now = clock.now
+    s = scheduler({'yt': [
+        entity(1, tracks=100000, found=90000, last_search=now - DAY, last_activity=now),
+        entity(2, tracks=0, found=0, last_search=now - 8 * DAY),
+    ]}, clock)
+    decision = s.pick()
+    assert (decision['id'], decision['reason']) == (2, 'starved')
+    # Its pick counts as a search: it is not starved anymore after the next reload
+    clock.now += 301
+    assert s.pick()['id'] == 1
+
+    print("  starvation: PASS")
+
+
+def test_empty_entity_cools_down_and_filter():
+    clock = FakeClock()
+    now = clock.now
+    s = scheduler({'yt': [entity(1, last_search=now - DAY), entity(2, last_search=now - DAY)]}, clock,
+                  revisit_interval=60)
+    first = s.pick()['id']
+    s.record('yt', first, searched=0, added=0)
+    clock.now += 120
+    # The other one, then nothing: the first one has nothing due for an hour
+    assert s.pick()['id'] != first
+    assert s.pick(allowed=lambda c: c.id == first) is None
+    clock.now += 3600
+    assert s.pick(allowed=lambda c: c.id == first)['id'] == first
+
+    print("  cooldown and filter: PASS")
+
+
+def test_pending():
+    s = scheduler({'yt': [entity(1, tracks=100, found=40), entity(2, tracks=10, found=10)],
+                   'dg': [entity(1, tracks=5, found=0)]}, FakeClock())
+    s.refresh()
+    assert s.pending() == {'yt': (1, 60), 'dg': (1, 5)}
+
+    print("  pending: PASS")
+
+
+def test_backlog_not_due_is_left_out():
+    clock = FakeClock()
+    now = clock.now
+    s = scheduler({'yt': [entity(1, tracks=100, found=40, last_search=now - DAY),
+                          entity(2, tracks=100, found=40, last_search=now - DAY)]}, clock)
+    s.refresh()
+    # Run drained: the 60 tracks searched without match are due in two days
+    s.record('yt', 1, searched=60, added=0, drained=True, next_due=now + 2 * DAY)
+    assert s.pending() == {'yt': (1, 60), 'dg': (0, 0)}
+    backlogs = {q['id']: q['components']['backlog'] for q in s.queue('yt')}
+    assert backlogs == {1: 0, 2: 60}
+    # Kept across reloads, and due again after next_due
+    s.refresh()
+    assert s.pending()['yt'] == (1, 60)
+    clock.now += 2 * DAY
+    assert s.pending()['yt'] == (2, 120)
+
+    print("  backlog not due: PASS")
+
+
+def test_picks_are_persisted():
+    clock = FakeClock()
+    picks = []
+    s = scheduler({'yt': [entity(1)]}, clock, on_pick=picks.append)
+    decision = s.pick()
+    assert picks == [decision]
+
+    def fail(decision):
+        raise RuntimeError("MySQL down")
+
+    s.on_pick = fail
+    clock.now += 3600
+    assert s.pick()['id'] == 1
+
+    print("  persisted picks: PASS")
+
+
+def test_parse_host_weights():
+    assert parse_host_weights('yt=2, dg=1') == {'yt': 2.0, 'dg': 1.0}
+
+    print("  host weights: PASS")
+
+
+if __name__ == "__main__":
+    print("Running scheduler tests...")
+    test_scores_backlog_activity_and_match_rate()
+    test_weighted_fair_queue_between_hosts()
+    test_starved_entity_goes_first()
+    test_empty_entity_cools_down_and_filter()
+    test_pending()
+    test_backlog_not_due_is_left_out()
+    test_picks_are_persisted()
+    test_parse_host_weights()
+    print("\nALL TESTS PASSED")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Unit tests for search_cache.py — tiered search result cache."""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from cache import TTLCache
+from search_cache import SearchCache, compact_items, search_cache_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class MemoryStore:
+    """Stand-in for DynamoDBSearchStore."""
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def put(self, key, items, matched, expires_at):
+        self.items[key] = (compact_items(items), matched, expires_at)
+
+
+TRACK = {"uri": "spotify:track:1", "name": "One More Time", "available_markets": ["FR"],
+         "album": {"id": "a1", "available_markets": ["FR"]}}
+
+
+def make_cache(clock, durable=None):
+    return SearchCache(TTLCache(maxsize=100, ttl=0, clock=clock), durable=durable,
+                       hit_ttl=100, miss_ttl=10, clock=clock)
+
+
+def test_key_is_normalized():
+    assert search_cache_key("track:One More Time artist:Daft Punk", 5) == \
+        search_cache_key("track:one more time  artist:daft punk", 5)
+    assert search_cache_key("q", 5) != search_cache_key("q", 1)
+    # "feat." in the title must not swallow the artist
+    assert search_cache_key("track:Song feat. X artist:Y", 5) != \
+        search_cache_key("track:Song ft. Someone artist:Other Artist", 5)
+    assert search_cache_key("track:Song feat. X artist:Y", 5) != \
+        search_cache_key("track:Song feat. X artist:Z", 5)
+
+    print("  key normalization: PASS")
+
+
+def test_negative_results_expire_sooner():
+    clock = FakeClock()
+    cache = make_cache(clock)
+    cache.set("hit", [TRACK], matched=True)
+    cache.set("miss", [], matched=False)
+    assert cache.get("hit") == [TRACK]
+    assert cache.get("miss") == []
+    assert cache.expires_at("miss") == clock.now + 10
+    clock.now += 11
+    assert cache.get("miss") is None
+    assert cache.expires_at("miss") is None
+    assert cache.get("hit") == [TRACK]
+    assert cache.stats() == {"hits": 3, "negative_hits": 1, "durable_hits": 0, "misses": 1}
+
+    print("  negative TTL: PASS")
+
+
+def test_durable_tier():
+    clock = FakeClock()
+    store = MemoryStore()
+    make_cache(clock, durable=store).set("hit", [TRACK], matched=True)
+
+    # Another process only has the durable tier
+    other = make_cache(clock, durable=store)
+    items = other.get("hit")
+    assert items[0]["uri"] == TRACK["uri"]
+    assert "available_markets" not in items[0] and "available_markets" not in items[0]["album"]
+    assert other.durable_hits == 1
+    # Promoted to the local tier
+    other.get("hit")
+    assert other.durable_hits == 1 and other.hits == 2
+
+    clock.now += 101
+    assert make_cache(clock, durable=store).get("hit") is None
+
+    print("  durable tier: PASS")
+
+
+if __name__ == "__main__":
+    print("Running search cache tests...")
+    test_key_is_normalized()
+    test_negative_results_expire_sooner()
+    test_durable_tier()
+    print("\nALL TESTS PASSED")
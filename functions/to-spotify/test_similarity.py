@@ -1,20 +1,104 @@
 #!/usr/bin/env python3
 """Unit tests for similarity.py — track matching logic."""
 
+import re
 import sys
 import os
+import time
+from difflib import SequenceMatcher
+from itertools import product
 
 sys.path.insert(0, os.path.dirname(__file__))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "trackfilter"))
 
 from similarity import (
     TRACK_SIMILARITY_THRESHOLD,
+    TRACK_SIMILARITY_EXCLUDES,
+    ENGINES,
+    get_engine,
+    set_engine,
+    lcs_length,
+    length_bound,
+    char_bound,
+    similar,
     clean_artist,
     sanitize,
+    sanitize_many,
     artist_combinations,
     is_match,
 )
 
+# Real-world titles (YouTube uploads and Spotify candidates) used for parity checks
+TITLES = [
+    "Daft Punk - One More Time",
+    "Black Loops & James Pepper - Three Drops (Original Mix)",
+    "Harley&Muscle - With Me [Extended Version]",
+    "Yoha and the Dragon Tribe - 25 Years Old",
+    "Agent Orange aka Cari Lekebusch - Give A Little More Love",
+    "Aaliyah - Rock The Boat (Kaytranada Edit)",
+    "Cosmonection, Tour-Maubourg - Cocktail",
+    "Dawn Again - Me 4 U - Original Mix",
+    "Kerri Chandler feat. Arnold Jarvis - Inspiration (Radio Edit) 1998",
+    "DJ Koze ft. Róisín Murphy - Illumination (Remastered 2020)",
+    "Népal archived - 444 Nuits",
+    "Larry Heard Presents Mr. White - The Sun Can't Compare (Instrumental)",
+    "ОТРАЖЕНИЕ - Ночной Город (Shorter Edit)",
+    "坂本龍一 - Energy Flow [Remaster]",
+    "Moodymann - Shades Of Jae (Filtered Version) 【HD】",
+    "Omar S & L'Renee - Take Me Away (Radio Version)",
+    "Ricardo Villalobos – Dexter (Short Version) ½",
+    "The Blessed Madonna featuring Kylie - Marea (We've Lost Dancing)",
+    "A Tribe Called Quest - Can I Kick It? (Extended Mix) [Official Video]",
+    "remasteradio edit",
+    "rem instrumentalix & and andand",
+]
+
+# (YouTube "Artist - Track", Spotify "Artist - Track") pairs around the threshold
+PAIRS = [
+    ("Daft Punk - One More Time", "Daft Punk - One More Time - Radio Edit"),
+    ("Black Loops James Pepper - Three Drops", "Black Loops - Three Drops"),
+    ("Harley Muscle - With Me", "Harley&Muscle - With Me"),
+    ("Yoha The Dragon Tribe - 25 Years", "Yoha and the Dragon Tribe - 25 Years Old"),
+    ("Aaliyah - Rock The Boat (Kaytranada Edit)", "Aaliyah - Rock The Boat"),
+    ("Childish Gambino - 3005", "Childish Gambino - Redbone"),
+    ("Kerri Chandler - Inspiration", "Kerri Chandler, Arnold Jarvis - Inspiration"),
+    ("Moodymann - Shades Of Jae", "Moodymann - Shades of Jae - 2019 Remaster"),
+    ("Omar S - Take Me Away", "Omar-S - Take Me Away (Radio Version)"),
+    ("DJ Koze - Illumination", "DJ Koze, Róisín Murphy - Illumination"),
+    ("Gucci Mane - Party animal", "Unnikrishnan - Innisai Paadivarum"),
+    ("Larry Heard - The Sun Can't Compare", "Mr. White - The Sun Can't Compare"),
+]
+
+
+def _corpus_pairs():
+    sanitized = [sanitize(t) for t in TITLES]
+    pairs = [(sanitize(a), sanitize(b)) for a, b in PAIRS]
+    return pairs + list(product(sanitized, sanitized))
+
+
+def _lcs_reference(a, b):
+    row = [0] * (len(b) + 1)
+    for ch in a:
+        prev = 0
+        for j, other in enumerate(b):
+            cur = row[j + 1]
+            row[j + 1] = prev + 1 if ch == other else max(row[j + 1], row[j])
+            prev = cur
+    return row[-1]
+
+
+def _legacy_sanitize(track):
+    """Reference implementation sanitize() must stay identical to."""
+    track = track.lower()
+    for sub in TRACK_SIMILARITY_EXCLUDES:
+        track = track.replace(sub, "")
+    track = re.sub(r"\(?\b(feat\.?|ft\.?|featuring)\b[^)]*\)?", "", track)
+    track = track.replace("&", " ")
+    track = re.sub(r"\band\b", " ", track)
+    track = "".join(ch for ch in track if ch.isalnum() or ch == " ")
+    track = " ".join(track.split())
+    return track
+
 
 def test_sanitize():
     # Basic lowercasing
@@ -42,6 +126,108 @@ def test_sanitize():
     print("  sanitize: PASS")
 
 
+def test_sanitize_parity():
+    for title in TITLES:
+        assert sanitize(title) == _legacy_sanitize(title), title
+    assert sanitize_many(TITLES) == [_legacy_sanitize(t) for t in TITLES]
+
+    print("  sanitize parity: PASS")
+
+
+def test_lcs_length():
+    for a, b in _corpus_pairs():
+        assert lcs_length(a, b) == _lcs_reference(a, b), (a, b)
+    assert lcs_length("", "abc") == 0
+
+    print("  lcs_length: PASS")
+
+
+def test_engine_parity():
+    difflib_engine = ENGINES["difflib"]()
+    indel_engine = ENGINES["indel"]()
+    compat_engine = ENGINES["compat"]()
+    for a, b in _corpus_pairs():
+        expected = SequenceMatcher(None, a, b).ratio()
+        assert difflib_engine.ratio(a, b) == expected
+        # Indel is an upper bound of the difflib ratio
+        assert indel_engine.ratio(a, b) >= expected - 1e-9, (a, b)
+        # Compat never changes a decision, nor a passing score
+        score = compat_engine.ratio(a, b)
+        assert (score >= TRACK_SIMILARITY_THRESHOLD) == (expected >= TRACK_SIMILARITY_THRESHOLD), (a, b)
+        if expected >= TRACK_SIMILARITY_THRESHOLD:
+            assert score == expected, (a, b)
+
+    print("  engine parity: PASS")
+
+
+def test_set_engine():
+    previous = get_engine().name
+    try:
+        for name in ENGINES:
+            set_engine(name)
+            passes, score = is_match("Daft Punk", "One More Time", ["Daft Punk"], "One More Time")
+            assert passes and score >= 0.99
+            passes, _ = is_match("Childish Gambino", "3005", ["Childish Gambino"], "Redbone")
+            assert not passes
+        try:
+            set_engine("levenshtein")
+            assert False, "expected ValueError"
+        except ValueError:
+            pass
+    finally:
+        set_engine(previous)
+
+    print("  set_engine: PASS")
+
+
+def _reference_is_match(yt_artists, yt_track, sp_artists, sp_track, first_yt_artist=None):
+    """is_match() without bounds or early exit."""
+    combos = artist_combinations([clean_artist(a) for a in sp_artists])
+    candidates = [sanitize(f"{combo} - {sp_track}") for combo in combos]
+    best = max(similar(sanitize(f"{yt_artists} - {yt_track}"), c) for c in candidates)
+    if best >= TRACK_SIMILARITY_THRESHOLD:
+        return True, best
+    if first_yt_artist and first_yt_artist != yt_artists:
+        best = max(best, max(similar(sanitize(f"{first_yt_artist} - {yt_track}"), c) for c in candidates))
+    return best >= TRACK_SIMILARITY_THRESHOLD, best
+
+
+def test_bounds():
+    for a, b in _corpus_pairs():
+        expected = SequenceMatcher(None, a, b).ratio()
+        assert length_bound(a, b) >= expected - 1e-9
+        assert char_bound(a, b) >= expected - 1e-9
+        assert abs(char_bound(a, b) - SequenceMatcher(None, a, b).quick_ratio()) < 1e-9
+
+    print("  bounds: PASS")
+
+
+def test_is_match_bounded():
+    for yt, sp in PAIRS:
+        yt_artists, yt_track = yt.split(" - ", 1)
+        sp_artist, sp_track = sp.split(" - ", 1)
+        sp_artists = sp_artist.split(", ")
+        first = yt_artists.split()[0]
+        expected = _reference_is_match(yt_artists, yt_track, sp_artists, sp_track, first_yt_artist=first)
+        assert is_match(yt_artists, yt_track, sp_artists, sp_track, first_yt_artist=first) == expected, yt
+        passes, score = is_match(yt_artists, yt_track, sp_artists, sp_track, first_yt_artist=first, exact=False)
+        assert passes == expected[0], yt
+        assert score <= expected[1] + 1e-9, yt
+
+    print("  is_match bounded: PASS")
+
+
+def benchmark_engines(rounds=20):
+    pairs = _corpus_pairs()
+    for name, engine_class in ENGINES.items():
+        engine = engine_class()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for a, b in pairs:
+                engine.ratio(a, b)
+        print("  %-8s %.1f ms" % (name, (time.perf_counter() - start) * 1000))
+
+
 def test_clean_artist():
     assert clean_artist("Népal archived") == "Népal"
     assert clean_artist("Agent Orange aka Cari Lekebusch") == "Agent Orange"
@@ -60,6 +246,10 @@ def test_artist_combinations():
     assert "James Pepper" in combos
     assert "Black Loops James Pepper" in combos
 
+    # Cached results are not shared with callers
+    combos.add("Someone Else")
+    assert "Someone Else" not in artist_combinations(["Black Loops", "James Pepper"])
+
     print("  artist_combinations: PASS")
 
 
@@ -154,6 +344,11 @@ def test_is_match_aka():
 if __name__ == "__main__":
     print("Running similarity tests...")
     test_sanitize()
+    test_sanitize_parity()
+    test_lcs_length()
+    test_engine_parity()
+    test_set_engine()
+    test_bounds()
     test_clean_artist()
     test_artist_combinations()
     test_is_match_basic()
@@ -163,4 +358,7 @@ if __name__ == "__main__":
     test_is_match_and_normalization()
     test_is_match_creative_works_rejected()
     test_is_match_aka()
+    test_is_match_bounded()
     print("\nALL TESTS PASSED")
+    print("\nEngine timings over the title corpus:")
+    benchmark_engines()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Unit tests for stats.py — bulk statistics statements."""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from stats import StatsStatements, add_playlist_tracks, set_playlist_tracks, update_playlist_stats, upsert_genre_counts
+
+
+class FakeCursor:
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, sql, params):
+        # Same placeholder count as parameters, like pymysql requires
+        assert sql.count('%s') == len(params), (sql, params)
+        self.executed.append((sql, params))
+
+
+def statements():
+    return StatsStatements('yt_playlists', 'yt_genres', 'yt_channel_id')
+
+
+def test_genre_counts_in_one_statement():
+    cursor = FakeCursor()
+    counts = {'house': 3, 'techno': 1, 'deep house': 2}
+    assert upsert_genre_counts(cursor, statements(), 42, counts) == 1
+    sql, params = cursor.executed[0]
+    assert sql.startswith('INSERT INTO yt_genres (yt_channel_id, genre_name, count, last_updated) VALUES ')
+    assert 'count = count + VALUES(count)' in sql
+    assert params == [42, 'deep house', 2, 42, 'house', 3, 42, 'techno', 1]
+
+    print("  genre upsert: PASS")
+
+
+def test_genre_counts_chunked():
+    cursor = FakeCursor()
+    counts = {'genre %d' % i: 1 for i in range(7)}
+    assert upsert_genre_counts(cursor, statements(), 1, counts, rows_per_statement=3) == 3
+    assert [len(params) // 3 for _, params in cursor.executed] == [3, 3, 1]
+    assert upsert_genre_counts(cursor, statements(), 1, {}) == 0
+
+    print("  genre upsert chunks: PASS")
+
+
+def test_playlist_stats():
+    cursor = FakeCursor()
+    update_playlist_stats(cursor, statements(), 'pl', 2, 10, found_tracks=120)
+    update_playlist_stats(cursor, statements(), 'pl', 2, 10)
+    assert cursor.executed[0][1] == [10, 120, 'pl', 2]
+    assert 'found_tracks' in cursor.executed[0][0]
+    assert cursor.executed[1][1] == [10, 'pl', 2]
+    assert 'found_tracks' not in cursor.executed[1][0]
+
+    print("  playlist stats: PASS")
+
+
+def test_playlist_track_count():
+    cursor = FakeCursor()
+    add_playlist_tracks(cursor, statements(), 'pl', 100)
+    set_playlist_tracks(cursor, statements(), 'pl', 10950)
+    assert cursor.executed[0] == ('UPDATE yt_playlists SET found_tracks = found_tracks + %s WHERE spotify_playlist=%s',
+                                  [100, 'pl'])
+    assert cursor.executed[1] == ('UPDATE yt_playlists SET found_tracks=%s WHERE spotify_playlist=%s', [10950, 'pl'])
+
+    print("  playlist track count: PASS")
+
+
+if __name__ == "__main__":
+    print("Running stats tests...")
+    test_genre_counts_in_one_statement()
+    test_genre_counts_chunked()
+    test_playlist_stats()
+    test_playlist_track_count()
+    print("\nALL TESTS PASSED")
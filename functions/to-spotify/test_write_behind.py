@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Unit tests for write_behind.py — buffered DynamoDB updates."""
+
+import sys
+import os
+import threading
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from write_behind import WriteBehind
+
+
+class Throttled(Exception):
+    def __init__(self):
+        super().__init__("throttled")
+        self.response = {"Error": {"Code": "ProvisionedThroughputExceededException"}}
+
+
+class FakeTable:
+    def __init__(self, throttle=0, fail_keys=()):
+        self.items = {}
+        self.throttle = throttle
+        self.fail_keys = set(fail_keys)
+        self._lock = threading.Lock()
+
+    def update_item(self, Key, **kwargs):
+        with self._lock:
+            if self.throttle:
+                self.throttle -= 1
+                raise Throttled()
+        if Key["id"] in self.fail_keys:
+            raise ValueError("bad item %s" % Key["id"])
+        with self._lock:
+            self.items[Key["id"]] = kwargs
+
+
+def test_buffer_writes_on_flush():
+    table = FakeTable()
+    buffer = WriteBehind(max_pending=10, sleep=lambda s: None)
+    for i in range(3):
+        buffer.add(table, Key={"id": i}, UpdateExpression="set x = :x")
+    assert table.items == {}
+    assert buffer.flush() == 3
+    assert sorted(table.items) == [0, 1, 2]
+    assert buffer.flush() == 0
+
+    print("  flush: PASS")
+
+
+def test_buffer_flushes_when_full():
+    table = FakeTable()
+    buffer = WriteBehind(max_pending=2, sleep=lambda s: None)
+    buffer.add(table, Key={"id": 1})
+    buffer.add(table, Key={"id": 2})
+    assert sorted(table.items) == [1, 2]
+    assert buffer.pending == []
+
+    print("  full buffer: PASS")
+
+
+def test_throttled_writes_are_retried():
+    table = FakeTable(throttle=3)
+    slept = []
+    buffer = WriteBehind(concurrency=1, sleep=slept.append)
+    buffer.add(table, Key={"id": 1})
+    buffer.flush()
+    assert 1 in table.items
+    assert buffer.throttled == 3
+    assert len(slept) == 3
+
+    print("  throttle retry: PASS")
+
+
+def test_failure_does_not_drop_other_writes():
+    table = FakeTable(fail_keys=[2])
+    buffer = WriteBehind(sleep=lambda s: None)
+    for i in range(4):
+        buffer.add(table, Key={"id": i})
+    try:
+        buffer.flush()
+        assert False, "expected the failed write to be raised"
+    except ValueError:
+        pass
+    assert sorted(table.items) == [0, 1, 3]
+    assert buffer.written == 3
+
+    print("  partial failure: PASS")
+
+
+if __name__ == "__main__":
+    print("Running write-behind tests...")
+    test_buffer_writes_on_flush()
+    test_buffer_flushes_when_full()
+    test_throttled_writes_are_retried()
+    test_failure_does_not_drop_other_writes()
+    print("\nALL TESTS PASSED")
@@ -0,0 +1,75 @@
+"""
+Write-behind buffer for DynamoDB item updates.
+
+Updates are queued with add() and written concurrently by flush(). Throttled
+writes are retried with exponential backoff; any other error is raised once
+every queued write has been attempted, so one failure does not drop the rest.
+Callers flush before saving a cursor past the records the updates belong to.
+"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+THROTTLE_CODES = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+}
+
+
+def is_throttled(e):
+    response = getattr(e, "response", None) or {}
+    return response.get("Error", {}).get("Code") in THROTTLE_CODES
+
+
+class WriteBehind:
+    def __init__(self, max_pending=100, concurrency=8, retries=6, base_delay=0.05, max_delay=5,
+                 sleep=time.sleep):
+        self.max_pending = max_pending
+        self.concurrency = concurrency
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.pending = []
+        self.written = 0
+        self.throttled = 0
+        self._sleep = sleep
+
+    def add(self, table, **update_kwargs):
+        """Queue table.update_item(**update_kwargs), flushing when the buffer is full."""
+        self.pending.append((table, update_kwargs))
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+
+    def _write(self, table, update_kwargs):
+        attempt = 0
+        while True:
+            try:
+                return table.update_item(**update_kwargs)
+            except Exception as e:
+                if not is_throttled(e) or attempt >= self.retries:
+                    raise
+                self.throttled += 1
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                # Full jitter: concurrent writers do not retry in lockstep
+                self._sleep(random.uniform(0, delay))
+                attempt += 1
+
+    def flush(self):
+        """Write every queued update. Returns the number written."""
+        pending, self.pending = self.pending, []
+        if not pending:
+            return 0
+        errors = []
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(pending))) as pool:
+            futures = [pool.submit(self._write, table, kwargs) for table, kwargs in pending]
+            for future in futures:
+                e = future.exception()
+                if e is not None:
+                    errors.append(e)
+        self.written += len(pending) - len(errors)
+        if errors:
+            print("[write-behind] %d of %d update(s) failed" % (len(errors), len(pending)))
+            raise errors[0]
+        return len(pending)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Backfill the sparse "pending match" attribute on existing track items.
+
+Tracks stored before pending_match existed get it set to their
+next_search_time (0 when never searched) if they are still unmatched, so
+they show up in the pending_match GSI. Run once per tracks table after the
+index is created and before setting PENDING_MATCH_INDEX on to-spotify:
+
+    python3 backfill_pending_match.py mirrorfm_yt_tracks yt_channel_id yt_track_composite
+    python3 backfill_pending_match.py mirrorfm_dg_tracks dg_label_id dg_track_composite
+
+Safe to re-run: items that already have the attribute are skipped, and an
+item matched meanwhile is left alone by the update condition.
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+PENDING_MATCH = "pending_match"
+
+
+def get_table(name):
+    dynamodb = boto3.resource("dynamodb", region_name="eu-west-1",
+                              endpoint_url=os.getenv("DYNAMODB_ENDPOINT_URL") or None)
+    return dynamodb.Table(name)
+
+
+def backfill_segment(table_name, entity_key, track_key, segment, segments, dry_run):
+    # boto3 resources are not thread-safe: one per scan segment
+    table = get_table(table_name)
+    conditional_failed = table.meta.client.exceptions.ConditionalCheckFailedException
+    scan = {
+        "Segment": segment,
+        "TotalSegments": segments,
+        "ProjectionExpression": "#e, #t, next_search_time",
+        "FilterExpression": "attribute_not_exists(spotify_found_time) AND attribute_not_exists(%s)" % PENDING_MATCH,
+        "ExpressionAttributeNames": {"#e": entity_key, "#t": track_key},
+    }
+    updated = 0
+    while True:
+        page = table.scan(**scan)
+        for item in page["Items"]:
+            if dry_run:
+                updated += 1
+                continue
+            try:
+                table.update_item(
+                    Key={entity_key: item[entity_key], track_key: item[track_key]},
+                    UpdateExpression="SET %s = :due" % PENDING_MATCH,
+                    ConditionExpression="attribute_not_exists(spotify_found_time)",
+                    ExpressionAttributeValues={":due": int(item.get("next_search_time", 0))})
+                updated += 1
+            except conditional_failed:
+                pass
+        if "LastEvaluatedKey" not in page:
+            return updated
+        scan["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("table")
+    parser.add_argument("entity_key", help="partition key, e.g. yt_channel_id")
+    parser.add_argument("track_key", help="sort key, e.g. yt_track_composite")
+    parser.add_argument("--segments", type=int, default=4, help="parallel scan segments")
+    parser.add_argument("--dry-run", action="store_true", help="count items without updating them")
+    args = parser.parse_args()
+
+    with ThreadPoolExecutor(max_workers=args.segments) as pool:
+        counts = list(pool.map(
+            lambda segment: backfill_segment(args.table, args.entity_key, args.track_key,
+                                             segment, args.segments, args.dry_run),
+            range(args.segments)))
+    print("%s: %d unmatched track(s) %s" % (args.table, sum(counts), "to backfill" if args.dry_run else "backfilled"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Cursor state of the Python functions, kept in memory between iterations.
+
+Cursors are read from `mirrorfm_cursors` once per process and written back
+after `flush_interval` seconds or `flush_ops` changes, and at shutdown.
+Every item carries a version: writes are conditional on the version last
+seen, so a replica never overwrites progress saved by another one. On a
+conflict the stored cursor wins and is adopted.
+
+Copied next to main.py in the function images, like mysql_pool.py.
+"""
+
+import os
+import threading
+import time
+
+# Marks a cursor deleted in memory but not yet in DynamoDB
+_DELETED = object()
+
+
+class _Cursor:
+    def __init__(self, value, version):
+        self.value = value
+        self.version = version
+        self.dirty = False
+
+
+class CursorManager:
+    def __init__(self, table, flush_interval=30, flush_ops=20, clock=time.monotonic):
+        self.table = table
+        self.flush_interval = flush_interval
+        self.flush_ops = flush_ops
+        self.stats = {"reads": 0, "writes": 0, "conflicts": 0}
+        self._conditional_failed = table.meta.client.exceptions.ConditionalCheckFailedException
+        self._clock = clock
+        self._cursors = {}
+        self._ops = 0
+        self._last_flush = clock()
+        self._lock = threading.RLock()
+
+    def _load(self, name):
+        res = self.table.get_item(Key={'name': name}, ConsistentRead=True)
+        self.stats["reads"] += 1
+        item = res.get('Item')
+        if item is None:
+            return _Cursor(None, None)
+        return _Cursor(item.get('value'), int(item.get('version', 0)))
+
+    def _cursor(self, name):
+        if name not in self._cursors:
+            self._cursors[name] = self._load(name)
+        return self._cursors[name]
+
+    def get(self, name):
+        """Cursor value, None when it is not set."""
+        with self._lock:
+            value = self._cursor(name).value
+            return None if value is _DELETED else value
+
+    def set(self, name, value):
+        with self._lock:
+            cursor = self._cursor(name)
+            cursor.value = value
+            cursor.dirty = True
+            self._changed()
+
+    def delete(self, name):
+        with self._lock:
+            cursor = self._cursor(name)
+            if cursor.version is None:
+                # Never stored: nothing to delete
+                cursor.value = None
+                cursor.dirty = False
+                return
+            cursor.value = _DELETED
+            cursor.dirty = True
+            self._changed()
+
+    def _changed(self):
+        self._ops += 1
+        if self._ops >= self.flush_ops or self._clock() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _condition(self, cursor):
+        if cursor.version is None:
+            return {'ConditionExpression': 'attribute_not_exists(#n)', 'ExpressionAttributeNames': {'#n': 'name'}}
+        if cursor.version == 0:
+            # Written before cursors were versioned
+            return {'ConditionExpression': 'attribute_not_exists(version)'}
+        return {'ConditionExpression': 'version = :v', 'ExpressionAttributeValues': {':v': cursor.version}}
+
+    def _write(self, name, cursor):
+        if cursor.value is _DELETED:
+            self.table.delete_item(Key={'name': name}, **self._condition(cursor))
+            return _Cursor(None, None)
+        version = (cursor.version or 0) + 1
+        self.table.put_item(Item={'name': name, 'value': cursor.value, 'version': version},
+                            **self._condition(cursor))
+        return _Cursor(cursor.value, version)
+
+    def flush(self):
+        """Write changed cursors. Returns the names whose stored value won over ours."""
+        conflicts = []
+        with self._lock:
+            for name, cursor in list(self._cursors.items()):
+                if not cursor.dirty:
+                    continue
+                try:
+                    self._cursors[name] = self._write(name, cursor)
+                    self.stats["writes"] += 1
+                except self._conditional_failed:
+                    # Another replica saved this cursor since we read it
+                    self.stats["conflicts"] += 1
+                    self._cursors[name] = self._load(name)
+                    conflicts.append(name)
+            self._ops = 0
+            self._last_flush = self._clock()
+        if conflicts:
+            print("[cursors] Adopted cursors saved by another process:", conflicts)
+        return conflicts
+
+    def forget(self, names):
+        """Drop unchanged cursors from memory so the next get() reads them again."""
+        with self._lock:
+            for name in names:
+                cursor = self._cursors.get(name)
+                if cursor is not None and not cursor.dirty:
+                    del self._cursors[name]
+
+
+def cursors_from_env(table):
+    """
+    Flush budget from CURSOR_FLUSH_INTERVAL (seconds) and CURSOR_FLUSH_OPS.
+    On Lambda the process can be frozen at any time, so every change is written.
+    """
+    on_lambda = bool(os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+    return CursorManager(table,
+                         flush_interval=int(os.getenv("CURSOR_FLUSH_INTERVAL", "0" if on_lambda else "30")),
+                         flush_ops=int(os.getenv("CURSOR_FLUSH_OPS", "1" if on_lambda else "20")))
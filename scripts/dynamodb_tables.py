@@ -0,0 +1,63 @@
+"""
+DynamoDB Table objects that are safe to share between threads.
+
+boto3 resources are not thread-safe, and the functions use their tables
+from lookup threads, entity workers, write-behind flushes and the lease
+keep-alive thread. A TableProxy forwards every call to a Table of the
+calling thread's own resource. All resources come from one session,
+created under a lock, so they share its loaded models and exception
+classes: `except table.meta.client.exceptions.X` works from any thread.
+
+Copied next to main.py in the function images, like mysql_pool.py.
+"""
+
+import threading
+
+
+class ThreadLocalTables:
+    def __init__(self, region_name, endpoint_url=None, on_client=None, session=None):
+        """on_client(client) is called once for every client created (e.g. metrics.instrument_boto3)."""
+        self.region_name = region_name
+        self.endpoint_url = endpoint_url
+        self.on_client = on_client
+        self._session = session
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def resource(self):
+        """This thread's resource."""
+        resource = getattr(self._local, "resource", None)
+        if resource is None:
+            # Sessions are not thread-safe either: resources are created one at a time
+            with self._lock:
+                if self._session is None:
+                    import boto3
+                    self._session = boto3.session.Session()
+                resource = self._session.resource("dynamodb", region_name=self.region_name,
+                                                  endpoint_url=self.endpoint_url)
+            if self.on_client:
+                self.on_client(resource.meta.client)
+            self._local.resource = resource
+            self._local.tables = {}
+        return resource
+
+    def table(self, name):
+        return TableProxy(self, name)
+
+    def _thread_table(self, name):
+        resource = self.resource()
+        table = self._local.tables.get(name)
+        if table is None:
+            table = self._local.tables[name] = resource.Table(name)
+        return table
+
+
+class TableProxy:
+    """Stands for dynamodb.Table(name), resolved in the calling thread on every access."""
+
+    def __init__(self, tables, name):
+        self._tables = tables
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._tables._thread_table(self.name), attr)
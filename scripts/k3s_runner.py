@@ -14,18 +14,28 @@ Backs off only when needed:
   - Other error    → MIN_BACKOFF then retry
 
 handle() must return a dict with a "searched" key (>0 means work was done).
+With "requeue" set, the SQS message is made visible again instead of deleted
+(e.g. its entity belongs to another replica's shard, see leases.py).
+On exit (including SIGTERM), main.shutdown() runs if the function defines it.
 Lambda ignores the return value, so this is fully compatible.
+
+With METRICS_PORT set, Prometheus metrics are served on :METRICS_PORT/metrics
+(see metrics.py): iterations, handle() latency by path, backoff, SQS messages,
+plus the dependency calls and pending-work gauges fed by the function.
 """
 
 import importlib
 import json
 import os
+import signal
 import sys
 import time
 import traceback
 
 import boto3
 
+import metrics
+
 MIN_INTERVAL = int(os.getenv("MIN_INTERVAL", "1"))
 SHORT_IDLE = int(os.getenv("SHORT_IDLE", "5"))
 MIN_BACKOFF = int(os.getenv("MIN_BACKOFF", "5"))
@@ -35,7 +45,30 @@ SQS_POLL_WAIT = int(os.getenv("SQS_POLL_WAIT", "5"))
 
 RATE_LIMIT_MARKERS = ["rate limit", "429", "retry after", "too many requests"]
 
-sqs = boto3.client("sqs", region_name="eu-west-1") if SQS_QUEUE_URL else None
+sqs = metrics.instrument_boto3(boto3.client("sqs", region_name="eu-west-1")) if SQS_QUEUE_URL else None
+
+HANDLE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+iterations = metrics.counter("mirrorfm_runner_iterations_total",
+                             "Loop iterations by path (sqs, cursor, idle) and outcome.", ("path", "outcome"))
+handle_seconds = metrics.histogram("mirrorfm_runner_handle_seconds",
+                                   "handle() latency by path: sqs event, cursor work or idle (nothing searched).",
+                                   ("path",), buckets=HANDLE_BUCKETS)
+sleep_seconds = metrics.counter("mirrorfm_runner_sleep_seconds_total",
+                                "Time slept between iterations by reason (interval, idle, rate_limit, error).",
+                                ("reason",))
+backoff_gauge = metrics.gauge("mirrorfm_runner_backoff_seconds", "Current backoff after errors (0 when healthy).")
+sqs_messages = metrics.counter("mirrorfm_runner_sqs_messages_total",
+                               "SQS messages received, deleted, requeued and skipped.", ("action",))
+
+
+def sqs_queue_depth():
+    attributes = sqs.get_queue_attributes(
+        QueueUrl=SQS_QUEUE_URL,
+        AttributeNames=["ApproximateNumberOfMessages", "ApproximateNumberOfMessagesNotVisible"],
+    )["Attributes"]
+    return {("visible",): int(attributes["ApproximateNumberOfMessages"]),
+            ("in_flight",): int(attributes["ApproximateNumberOfMessagesNotVisible"])}
 
 
 def is_rate_limit(exc):
@@ -56,6 +89,7 @@ def poll_sqs():
     messages = resp.get("Messages", [])
     if not messages:
         return None, None
+    sqs_messages.inc(len(messages), action="received")
 
     msg = messages[0]
     receipt = msg["ReceiptHandle"]
@@ -75,28 +109,65 @@ def poll_sqs():
         return event, receipt
 
     print(f"[sqs] Unknown message format, skipping: {body}")
+    sqs_messages.inc(action="skipped")
     return None, receipt
 
 
+def pause(seconds, reason):
+    sleep_seconds.inc(seconds, reason=reason)
+    time.sleep(seconds)
+
+
+def stop(signum, frame):
+    # Leave the loop through SystemExit so shutdown hooks run
+    print(f"[runner] Received signal {signum}, stopping")
+    sys.exit(0)
+
+
 def run():
+    if metrics.serve_from_env() and sqs:
+        # Pending work of the queue, read at scrape time
+        metrics.gauge("mirrorfm_sqs_queue_messages", "Messages waiting in the function's SQS queue.",
+                      ("state",), fn=sqs_queue_depth)
     mod = importlib.import_module("main")
-    handle = mod.handle
+    try:
+        loop(mod.handle)
+    finally:
+        # Functions keep some state in memory (e.g. cursors) and save it here
+        shutdown = getattr(mod, "shutdown", None)
+        if shutdown:
+            shutdown()
+
 
+def loop(handle):
     backoff = 0
 
     while True:
+        path = "sqs"
         try:
             # Priority: check SQS for event-driven work
             event, receipt = poll_sqs()
             if event:
+                start = time.monotonic()
                 result = handle(event, {})
-                if receipt:
+                handle_seconds.observe(time.monotonic() - start, path=path)
+                if receipt and isinstance(result, dict) and result.get("requeue"):
+                    # Another replica's work: it receives the message on one of its polls
+                    sqs.change_message_visibility(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=receipt,
+                                                  VisibilityTimeout=0)
+                    sqs_messages.inc(action="requeued")
+                elif receipt:
                     sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=receipt)
+                    sqs_messages.inc(action="deleted")
+                iterations.inc(path=path, outcome="ok")
                 backoff = 0
-                time.sleep(MIN_INTERVAL)
+                backoff_gauge.set(0)
+                pause(MIN_INTERVAL, "interval")
                 continue
 
             # Fallback: cursor-based polling
+            path = "cursor"
+            start = time.monotonic()
             result = handle({}, {})
 
             searched = 0
@@ -104,23 +175,33 @@ def run():
                 searched = result.get("searched", 0)
 
             if searched > 0:
+                handle_seconds.observe(time.monotonic() - start, path=path)
+                iterations.inc(path=path, outcome="ok")
                 backoff = 0
-                time.sleep(MIN_INTERVAL)
+                backoff_gauge.set(0)
+                pause(MIN_INTERVAL, "interval")
             else:
                 # No work — idle briefly before checking next entity
-                time.sleep(SHORT_IDLE)
+                handle_seconds.observe(time.monotonic() - start, path="idle")
+                iterations.inc(path="idle", outcome="ok")
+                pause(SHORT_IDLE, "idle")
 
         except Exception as e:
             if is_rate_limit(e):
                 backoff = min(max(backoff * 2, MIN_BACKOFF), MAX_BACKOFF)
                 print(f"[runner] Rate limited, backing off {backoff}s: {e}")
+                reason = "rate_limit"
             else:
                 backoff = MIN_BACKOFF
                 print(f"[runner] Error, retrying in {backoff}s:")
                 traceback.print_exc()
+                reason = "error"
 
-            time.sleep(backoff)
+            iterations.inc(path=path, outcome=reason)
+            backoff_gauge.set(backoff)
+            pause(backoff, reason)
 
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, stop)
     run()
@@ -0,0 +1,244 @@
+"""
+Entity sharding between replicas through expiring leases.
+
+Entities are split into `shards` by id (id % shards). Each replica keeps
+its membership and the shards it owns alive in one `mirrorfm_cursors` item
+per group, with conditional writes: a shard is only claimed when it is free
+or its lease expired, and only renewed or released by its owner. Every
+replica aims at an equal share of the shards; a replica that joins gets
+shards released by the others, and the shards of one that dies are claimed
+once its leases expire.
+
+Entities are processed between start_work() and finish_work(): a shard to
+hand over stops taking new work and is only released once the entities in
+flight on it are done.
+
+Copied next to main.py in the function images, like mysql_pool.py.
+"""
+
+import math
+import os
+import socket
+import threading
+import time
+
+
+class LeaseManager:
+    def __init__(self, table, group, shards, owner=None, ttl=60, clock=time.time,
+                 on_acquire=None, on_release=None):
+        self.table = table
+        self.group = group
+        self.shards = shards
+        self.owner = owner or "%s-%d" % (socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.stats = {"claimed": 0, "released": 0, "lost": 0}
+        self._conditional_failed = table.meta.client.exceptions.ConditionalCheckFailedException
+        self._clock = clock
+        self._owned = {}
+        # Entities being processed per shard, and owned shards waiting for theirs to finish before release
+        self._in_flight = {}
+        self._draining = set()
+        self._stopped = None
+        self._next = 0
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+
+    def _key(self):
+        return {'name': 'lease_%s' % self.group}
+
+    def _create(self):
+        try:
+            self.table.put_item(Item={'name': self._key()['name'], 'members': {}, 'shards': {}},
+                                ConditionExpression='attribute_not_exists(#n)',
+                                ExpressionAttributeNames={'#n': 'name'})
+        except self._conditional_failed:
+            pass
+
+    def _heartbeat(self, expires_at):
+        """Renew our membership and return the group item."""
+        update = dict(Key=self._key(),
+                      UpdateExpression='SET members.#me = :exp',
+                      ConditionExpression='attribute_exists(members)',
+                      ExpressionAttributeNames={'#me': self.owner},
+                      ExpressionAttributeValues={':exp': expires_at},
+                      ReturnValues='ALL_NEW')
+        try:
+            return self.table.update_item(**update)['Attributes']
+        except self._conditional_failed:
+            self._create()
+            return self.table.update_item(**update)['Attributes']
+
+    def _forget_member(self, member, cutoff):
+        """Drop a replica that stopped heartbeating (no-op if it came back meanwhile)."""
+        try:
+            self.table.update_item(
+                Key=self._key(),
+                UpdateExpression='REMOVE members.#m',
+                ConditionExpression='members.#m <= :cutoff',
+                ExpressionAttributeNames={'#m': member},
+                ExpressionAttributeValues={':cutoff': int(cutoff)})
+        except self._conditional_failed:
+            pass
+
+    def _renew(self, shard, expires_at):
+        try:
+            self.table.update_item(
+                Key=self._key(),
+                UpdateExpression='SET shards.#s.expires_at = :exp',
+                ConditionExpression='shards.#s.#o = :me',
+                ExpressionAttributeNames={'#s': str(shard), '#o': 'owner'},
+                ExpressionAttributeValues={':exp': expires_at, ':me': self.owner})
+            return True
+        except self._conditional_failed:
+            return False
+
+    def _claim(self, shard, now, expires_at):
+        try:
+            self.table.update_item(
+                Key=self._key(),
+                UpdateExpression='SET shards.#s = :lease',
+                ConditionExpression='attribute_not_exists(shards.#s) OR shards.#s.expires_at < :now',
+                ExpressionAttributeNames={'#s': str(shard)},
+                ExpressionAttributeValues={':lease': {'owner': self.owner, 'expires_at': expires_at},
+                                           ':now': int(now)})
+            return True
+        except self._conditional_failed:
+            return False
+
+    def _release(self, shard):
+        if self.on_release:
+            self.on_release(shard)
+        self._owned.pop(shard, None)
+        self._draining.discard(shard)
+        try:
+            self.table.update_item(
+                Key=self._key(),
+                UpdateExpression='REMOVE shards.#s',
+                ConditionExpression='shards.#s.#o = :me',
+                ExpressionAttributeNames={'#s': str(shard), '#o': 'owner'},
+                ExpressionAttributeValues={':me': self.owner})
+        except self._conditional_failed:
+            pass
+        self.stats["released"] += 1
+
+    def refresh(self):
+        """Heartbeat, renew owned leases, then release or claim shards towards an equal share."""
+        with self._lock:
+            now = self._clock()
+            expires_at = int(now + self.ttl)
+            item = self._heartbeat(expires_at)
+            members = [m for m, exp in item.get('members', {}).items() if exp > now]
+            for member, exp in item.get('members', {}).items():
+                if exp <= now - self.ttl:
+                    self._forget_member(member, now - self.ttl)
+            target = int(math.ceil(self.shards / float(max(1, len(members)))))
+
+            for shard in list(self._owned):
+                if self._renew(shard, expires_at):
+                    self._owned[shard] = expires_at
+                else:
+                    # Expired and claimed by another replica meanwhile
+                    self._owned.pop(shard)
+                    self._draining.discard(shard)
+                    self.stats["lost"] += 1
+
+            # Extra shards take no new work, and are released once their entities in flight are done
+            active = [shard for shard in self._owned if shard not in self._draining]
+            self._draining.update(sorted(active, reverse=True)[:max(0, len(active) - target)])
+            for shard in list(self._draining):
+                if not self._in_flight.get(shard):
+                    self._release(shard)
+
+            leases = item.get('shards', {})
+            for shard in range(self.shards):
+                if len(self._owned) - len(self._draining) >= target:
+                    break
+                lease = leases.get(str(shard))
+                if shard in self._owned or (lease and lease['expires_at'] >= now):
+                    continue
+                if self._claim(shard, now, expires_at):
+                    self._owned[shard] = expires_at
+                    self.stats["claimed"] += 1
+                    if self.on_acquire:
+                        self.on_acquire(shard)
+
+    def start(self):
+        """Refresh now, then every third of the lease time in a daemon thread, so long runs keep their leases."""
+        if self._stopped is not None:
+            return
+        self.refresh()
+        self._stopped = threading.Event()
+
+        def keep_alive():
+            while not self._stopped.wait(self.ttl / 3.0):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print("[leases] Refresh failed: %s" % e)
+
+        threading.Thread(target=keep_alive, name="leases-%s" % self.group, daemon=True).start()
+
+    def owned(self):
+        """Shards whose lease is still valid, with a margin for the work started on them."""
+        with self._lock:
+            deadline = self._clock() + self.ttl / 3.0
+            return sorted(shard for shard, expires_at in self._owned.items()
+                          if expires_at > deadline and shard not in self._draining)
+
+    def start_work(self, shard):
+        """Before processing an entity of `shard`: False when this replica does not own it (anymore)."""
+        with self._lock:
+            if shard not in self.owned():
+                return False
+            self._in_flight[shard] = self._in_flight.get(shard, 0) + 1
+            return True
+
+    def finish_work(self, shard):
+        """After processing an entity started with start_work(): hands the shard over if it was waiting for it."""
+        with self._lock:
+            self._in_flight[shard] -= 1
+            if self._in_flight[shard] > 0:
+                return
+            del self._in_flight[shard]
+            self._idle.notify_all()
+            if shard in self._draining:
+                self._release(shard)
+
+    def next_shard(self):
+        """Owned shards in turn, None when this replica currently owns none."""
+        owned = self.owned()
+        if not owned:
+            return None
+        with self._lock:
+            self._next += 1
+            return owned[self._next % len(owned)]
+
+    def release_all(self, timeout=None):
+        """Leave the group, after the entities in flight are done (up to `timeout`, the lease time by default)."""
+        if self._stopped is not None:
+            self._stopped.set()
+        with self._lock:
+            self._draining.update(self._owned)
+            if not self._idle.wait_for(lambda: not self._in_flight, self.ttl if timeout is None else timeout):
+                print("[leases] Releasing with entities still in flight:", self._in_flight)
+            for shard in list(self._owned):
+                self._release(shard)
+            try:
+                self.table.update_item(Key=self._key(),
+                                       UpdateExpression='REMOVE members.#me',
+                                       ExpressionAttributeNames={'#me': self.owner})
+            except Exception as e:
+                print("[leases] Could not leave group %s: %s" % (self.group, e))
+
+
+def leases_from_env(table, group, **kwargs):
+    """LeaseManager when ENTITY_SHARDS is set (> 0), None to keep walking all entities."""
+    shards = int(os.getenv("ENTITY_SHARDS", "0"))
+    if shards <= 0:
+        return None
+    return LeaseManager(table, group, shards,
+                        owner=os.getenv("LEASE_OWNER") or None,
+                        ttl=int(os.getenv("LEASE_TTL", "60")),
+                        **kwargs)
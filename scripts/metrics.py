@@ -0,0 +1,292 @@
+"""
+Prometheus metrics of the Python functions, without extra dependencies.
+
+Counters, gauges and histograms live in one process-wide registry and are
+rendered in the Prometheus text format. k3s_runner serves them over HTTP
+when METRICS_PORT is set; otherwise (and on Lambda) recording them only
+costs a dict update. The functions feed the per-dependency call metrics
+through observe_call() / timed(), instrument_boto3() and
+timed_cursor_class(), and their pending work through gauge callbacks.
+
+Copied next to main.py in the function images, like mysql_pool.py.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CALL_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, _escape(v)) for k, v in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError("%s expects labels %s, got %s" % (self.name, self.label_names, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self):
+        with self._lock:
+            return [(key, self.name, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for key, name, value, *extra in self._samples():
+            lines.append("%s%s %s" % (name, _labels(self.label_names, key, extra[0] if extra else ()),
+                                      _number(value)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, fn):
+        """fn() returns the value, or {label values tuple: value} for a labelled gauge; read at scrape time."""
+        self.fn = fn
+
+    def _samples(self):
+        if self.fn is None:
+            return super()._samples()
+        try:
+            values = self.fn()
+        except Exception as e:
+            print("[metrics] %s: %s" % (self.name, e))
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(tuple(str(v) for v in key), self.name, value) for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=CALL_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+            counts[1] += value
+            counts[2] += 1
+
+    def count(self, **labels):
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return counts[2] if counts else 0
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (buckets, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, buckets):
+                    cumulative += n
+                    samples.append((key, self.name + "_bucket", cumulative, [("le", _number(bound))]))
+                samples.append((key, self.name + "_sum", total))
+                samples.append((key, self.name + "_count", count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        """Declaring a metric twice (runner and function) returns the first one."""
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("%s is already a %s" % (name, metric.kind))
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=(), fn=None):
+        gauge = self._get(Gauge, name, help, labels)
+        if fn is not None:
+            gauge.set_function(fn)
+        return gauge
+
+    def histogram(self, name, help, labels=(), buckets=CALL_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+dependency_calls = counter("mirrorfm_dependency_calls_total",
+                           "Calls to external dependencies.", ("dependency", "operation", "outcome"))
+dependency_seconds = histogram("mirrorfm_dependency_call_seconds",
+                               "Latency of calls to external dependencies.", ("dependency", "operation"))
+
+
+def observe_call(dependency, operation, seconds, error=False):
+    dependency_calls.inc(dependency=dependency, operation=operation, outcome="error" if error else "ok")
+    dependency_seconds.observe(seconds, dependency=dependency, operation=operation)
+
+
+@contextmanager
+def timed(dependency, operation):
+    """Record the block as one call to `dependency`."""
+    start = time.monotonic()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        observe_call(dependency, operation, time.monotonic() - start, error)
+
+
+def instrument_boto3(client, dependency=None):
+    """Record every API call of a boto3 client (resource.meta.client for a resource) by operation."""
+    events = client.meta.events
+    dependency = dependency or client.meta.service_model.service_name
+
+    def before(context, model, **kwargs):
+        context["metrics_call"] = (model.name, time.monotonic())
+
+    def after(context, parsed=None, exception=None, **kwargs):
+        call = context.pop("metrics_call", None)
+        if call is not None:
+            operation, start = call
+            error = exception is not None or bool(parsed and "Error" in parsed)
+            observe_call(dependency, operation, time.monotonic() - start, error)
+
+    # Emitted by botocore around every API call (after-call-error when it raised)
+    events.register("before-call", before, unique_id="metrics-before")
+    events.register("after-call", after, unique_id="metrics-after")
+    events.register("after-call-error", after, unique_id="metrics-after-error")
+    return client
+
+
+def timed_cursor_class(cls, dependency="mysql"):
+    """Subclass of a pymysql cursor class recording each statement by its verb (SELECT, UPDATE...)."""
+
+    def timed_method(method):
+        def call(self, query, *args, **kwargs):
+            with timed(dependency, query.lstrip().split(None, 1)[0].upper() if query.strip() else "?"):
+                return method(self, query, *args, **kwargs)
+        return call
+
+    return type("Timed" + cls.__name__, (cls,), {
+        "execute": timed_method(cls.execute),
+        "executemany": timed_method(cls.executemany),
+    })
+
+
+def register_pool(pool, name="mysql"):
+    """Connections of a mysql_pool.Pool by state, read at scrape time."""
+    def connections():
+        m = pool.metrics()
+        return {(name, "idle"): m["idle"], (name, "in_use"): m["in_use"]}
+    gauge("mirrorfm_pool_connections", "Pooled connections by state.", ("pool", "state"), fn=connections)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, addr="", registry=REGISTRY):
+    """Serve /metrics from a daemon thread. Returns the server (server_address has the bound port)."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print("[metrics] Serving on :%d/metrics" % server.server_address[1])
+    return server
+
+
+def serve_from_env():
+    """Start the endpoint when METRICS_PORT is set, None otherwise."""
+    port = os.getenv("METRICS_PORT", "")
+    if not port:
+        return None
+    return serve(int(port), os.getenv("METRICS_ADDR", ""))
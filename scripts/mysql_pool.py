@@ -0,0 +1,187 @@
+"""
+Small MySQL connection pool shared by the Python functions.
+
+Copied next to main.py in the function images, like k3s_runner.py.
+Connections run in autocommit mode: reads never see a stale snapshot
+from a previous borrower, and writes that must go together use
+transaction().
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class _Entry:
+    def __init__(self, conn, now):
+        self.conn = conn
+        self.created = now
+        self.last_used = now
+
+
+class Pool:
+    """
+    Keeps up to `size` connections. A connection idle for more than
+    `ping_interval` seconds is pinged before being handed out, and one older
+    than `max_lifetime` seconds is closed and replaced.
+    """
+
+    def __init__(self, size=4, max_lifetime=3600, ping_interval=30, checkout_timeout=30,
+                 connect=None, clock=time.monotonic, **connect_kwargs):
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self.checkout_timeout = checkout_timeout
+        self.connect_kwargs = connect_kwargs
+        self._connect = connect
+        self._clock = clock
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self.stats = {
+            "created": 0,
+            "reused": 0,
+            "recycled": 0,
+            "ping_failures": 0,
+            "discarded": 0,
+            "wait_seconds": 0.0,
+        }
+
+    def _new_entry(self):
+        connect = self._connect
+        if connect is None:
+            import pymysql
+            connect = pymysql.connect
+        conn = connect(autocommit=True, **self.connect_kwargs)
+        self.stats["created"] += 1
+        return _Entry(conn, self._clock())
+
+    def _close(self, entry):
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+
+    def _is_usable(self, entry):
+        now = self._clock()
+        if now - entry.created > self.max_lifetime:
+            self.stats["recycled"] += 1
+            return False
+        if now - entry.last_used > self.ping_interval:
+            try:
+                entry.conn.ping(reconnect=False)
+            except Exception:
+                self.stats["ping_failures"] += 1
+                return False
+        return True
+
+    def _checkout(self):
+        start = self._clock()
+        with self._cond:
+            while not self._idle and self._in_use >= self.size:
+                remaining = self.checkout_timeout - (self._clock() - start)
+                if remaining <= 0:
+                    raise PoolExhausted("No MySQL connection available after %ss" % self.checkout_timeout)
+                self._cond.wait(remaining)
+            self.stats["wait_seconds"] += self._clock() - start
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+        try:
+            # Liveness checks and connects happen outside the lock
+            while entry is not None and not self._is_usable(entry):
+                self._close(entry)
+                with self._cond:
+                    entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                entry = self._new_entry()
+            else:
+                self.stats["reused"] += 1
+            return entry
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def _checkin(self, entry, broken=False):
+        with self._cond:
+            self._in_use -= 1
+            if broken or not entry.conn.open:
+                self.stats["discarded"] += 1
+                self._close(entry)
+            else:
+                entry.last_used = self._clock()
+                self._idle.append(entry)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of the block."""
+        entry = self._checkout()
+        broken = False
+        try:
+            yield entry.conn
+        except Exception as e:
+            # Connection-level errors (lost connection, timeouts) make it unusable
+            broken = type(e).__name__ in ("OperationalError", "InterfaceError")
+            if not broken:
+                # Do not hand an open transaction to the next borrower
+                try:
+                    entry.conn.rollback()
+                except Exception:
+                    broken = True
+            raise
+        finally:
+            self._checkin(entry, broken)
+
+    @contextmanager
+    def cursor(self):
+        """Borrow a connection and yield a cursor on it (autocommit)."""
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    @contextmanager
+    def transaction(self):
+        """Yield a cursor inside BEGIN; commit on success, rollback on error."""
+        with self.connection() as conn:
+            conn.begin()
+            cur = conn.cursor()
+            try:
+                yield cur
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+
+    def metrics(self):
+        with self._cond:
+            return dict(self.stats, size=self.size, idle=len(self._idle), in_use=self._in_use)
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for entry in idle:
+            self._close(entry)
+
+
+def pool_from_env(**connect_kwargs):
+    """Pool for DB_HOST/DB_USERNAME/DB_PASSWORD/DB_NAME, sized by DB_POOL_* env vars."""
+    return Pool(size=int(os.getenv("DB_POOL_SIZE", "4")),
+                max_lifetime=int(os.getenv("DB_POOL_MAX_LIFETIME", "3600")),
+                ping_interval=int(os.getenv("DB_POOL_PING_INTERVAL", "30")),
+                host=os.getenv("DB_HOST"),
+                user=os.getenv("DB_USERNAME"),
+                passwd=os.getenv("DB_PASSWORD"),
+                db=os.getenv("DB_NAME"),
+                **connect_kwargs)
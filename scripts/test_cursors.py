@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Unit tests for cursors.py — in-memory cursors with conditional flushes."""
+
+import sys
+import os
+import types
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from cursors import CursorManager
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class FakeTable:
+    """mirrorfm_cursors stand-in understanding the conditions CursorManager sends."""
+
+    def __init__(self, items=None):
+        self.items = dict(items or {})
+        self.gets = 0
+        self.writes = 0
+        self.meta = types.SimpleNamespace(client=types.SimpleNamespace(
+            exceptions=types.SimpleNamespace(ConditionalCheckFailedException=ConditionalCheckFailedException)))
+
+    def _check(self, name, ConditionExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None):
+        item = self.items.get(name)
+        if ConditionExpression == 'attribute_not_exists(#n)':
+            ok = item is None
+        elif ConditionExpression == 'attribute_not_exists(version)':
+            ok = item is None or 'version' not in item
+        else:
+            ok = item is not None and item.get('version') == ExpressionAttributeValues[':v']
+        if not ok:
+            raise ConditionalCheckFailedException()
+
+    def get_item(self, Key, ConsistentRead=False):
+        self.gets += 1
+        item = self.items.get(Key['name'])
+        return {'Item': dict(item)} if item else {}
+
+    def put_item(self, Item, **condition):
+        self._check(Item['name'], **condition)
+        self.writes += 1
+        self.items[Item['name']] = dict(Item)
+
+    def delete_item(self, Key, **condition):
+        self._check(Key['name'], **condition)
+        self.writes += 1
+        self.items.pop(Key['name'], None)
+
+
+def test_reads_once_and_batches_writes():
+    table = FakeTable({'last_entity': {'name': 'last_entity', 'value': 3}})
+    clock = FakeClock()
+    cursors = CursorManager(table, flush_interval=30, flush_ops=3, clock=clock)
+    assert cursors.get('last_entity') == 3
+    cursors.set('last_entity', 4)
+    cursors.set('last_entity', 5)
+    assert cursors.get('last_entity') == 5
+    assert (table.gets, table.writes) == (1, 0)
+    # Third change reaches the operation budget
+    cursors.set('track_key', {'id': 'x'})
+    assert table.items['last_entity']['value'] == 5
+    assert table.items['track_key']['value'] == {'id': 'x'}
+    assert table.writes == 2
+
+    # Time budget
+    cursors.set('last_entity', 6)
+    clock.now = 31
+    cursors.set('last_entity', 7)
+    assert table.items['last_entity']['value'] == 7
+
+    print("  batched flush: PASS")
+
+
+def test_delete_is_deferred():
+    table = FakeTable({'track_key': {'name': 'track_key', 'value': {'id': 'x'}, 'version': 2}})
+    cursors = CursorManager(table, flush_interval=30, flush_ops=10, clock=FakeClock())
+    cursors.delete('track_key')
+    assert cursors.get('track_key') is None
+    assert 'track_key' in table.items
+    cursors.flush()
+    assert 'track_key' not in table.items
+    # Unknown cursors need no write
+    cursors.delete('never_set')
+    cursors.flush()
+    assert table.writes == 1
+
+    print("  deferred delete: PASS")
+
+
+def test_conflict_keeps_other_replica_progress():
+    table = FakeTable({'last_entity': {'name': 'last_entity', 'value': 3}})
+    a = CursorManager(table, flush_interval=30, flush_ops=10, clock=FakeClock())
+    b = CursorManager(table, flush_interval=30, flush_ops=10, clock=FakeClock())
+    assert a.get('last_entity') == b.get('last_entity') == 3
+    a.set('last_entity', 4)
+    assert a.flush() == []
+    b.set('last_entity', 9)
+    assert b.flush() == ['last_entity']
+    # b adopted what a saved instead of overwriting it
+    assert table.items['last_entity']['value'] == 4
+    assert b.get('last_entity') == 4
+    assert b.stats['conflicts'] == 1
+    # and can move it forward from there
+    b.set('last_entity', 5)
+    assert b.flush() == []
+    assert table.items['last_entity']['value'] == 5
+
+    print("  conflict: PASS")
+
+
+if __name__ == "__main__":
+    print("Running cursors tests...")
+    test_reads_once_and_batches_writes()
+    test_delete_is_deferred()
+    test_conflict_keeps_other_replica_progress()
+    print("\nALL TESTS PASSED")
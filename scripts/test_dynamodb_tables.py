@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Unit tests for dynamodb_tables.py — one boto3 resource per thread."""
+
+import sys
+import os
+import threading
+import types
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from dynamodb_tables import ThreadLocalTables
+
+
+class FakeTable:
+    def __init__(self, resource, name):
+        self.resource = resource
+        self.name = name
+
+    def get_item(self, Key):
+        return {"Item": {"table": self.name, "thread": threading.get_ident()}}
+
+
+class FakeResource:
+    def __init__(self):
+        self.meta = types.SimpleNamespace(client=object())
+
+    def Table(self, name):
+        return FakeTable(self, name)
+
+
+class FakeSession:
+    def __init__(self):
+        self.resources = []
+
+    def resource(self, service, region_name=None, endpoint_url=None):
+        assert service == "dynamodb" and region_name == "eu-west-1"
+        resource = FakeResource()
+        self.resources.append(resource)
+        return resource
+
+
+def test_one_resource_per_thread():
+    session = FakeSession()
+    instrumented = []
+    tables = ThreadLocalTables("eu-west-1", on_client=instrumented.append, session=session)
+    cursors = tables.table("mirrorfm_cursors")
+    assert cursors.name == "mirrorfm_cursors"
+
+    seen = {}
+    # Keep the threads alive together so their idents are not reused
+    barrier = threading.Barrier(3)
+
+    def use():
+        first = cursors._tables._thread_table("mirrorfm_cursors")
+        assert cursors._tables._thread_table("mirrorfm_cursors") is first
+        seen[threading.get_ident()] = (first, cursors.get_item(Key={})["Item"])
+
+    def use_together():
+        use()
+        barrier.wait()
+
+    use()
+    threads = [threading.Thread(target=use_together) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(seen) == 4
+    assert len(session.resources) == 4
+    assert len({id(table.resource) for table, _ in seen.values()}) == 4
+    # Calls run on the calling thread's table
+    assert all(item["thread"] == ident for ident, (_, item) in seen.items())
+    assert instrumented == [r.meta.client for r in session.resources]
+
+    print("  one resource per thread: PASS")
+
+
+def test_tables_share_the_thread_resource():
+    session = FakeSession()
+    tables = ThreadLocalTables("eu-west-1", session=session)
+    tracks = tables.table("mirrorfm_yt_tracks")
+    events = tables.table("mirrorfm_events")
+    assert tracks.get_item(Key={})["Item"]["table"] == "mirrorfm_yt_tracks"
+    assert events.get_item(Key={})["Item"]["table"] == "mirrorfm_events"
+    assert len(session.resources) == 1
+    assert tracks.resource is events.resource
+
+    print("  tables share the thread resource: PASS")
+
+
+if __name__ == "__main__":
+    print("Running dynamodb_tables tests...")
+    test_one_resource_per_thread()
+    test_tables_share_the_thread_resource()
+    print("\nALL TESTS PASSED")
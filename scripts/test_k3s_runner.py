@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Unit tests for k3s_runner.py — what happens to SQS messages after handle()."""
+
+import sys
+import os
+import json
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import k3s_runner
+
+
+class StopLoop(BaseException):
+    """Leaves the runner's loop (its `except Exception` doesn't catch it)."""
+
+
+class FakeSQS:
+    def __init__(self, bodies):
+        self.messages = [{"ReceiptHandle": "receipt-%d" % i, "Body": json.dumps(body)}
+                         for i, body in enumerate(bodies)]
+        self.deleted = []
+        self.visibility = []
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds):
+        return {"Messages": [self.messages.pop(0)]} if self.messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.deleted.append(ReceiptHandle)
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        self.visibility.append((ReceiptHandle, VisibilityTimeout))
+
+
+def run_messages(sqs, handle):
+    """One loop iteration per message, with k3s_runner's SQS queue swapped for `sqs`."""
+    saved = (k3s_runner.sqs, k3s_runner.SQS_QUEUE_URL, k3s_runner.pause)
+    remaining = [len(sqs.messages)]
+
+    def pause(seconds, reason):
+        remaining[0] -= 1
+        if remaining[0] <= 0:
+            raise StopLoop()
+
+    k3s_runner.sqs, k3s_runner.SQS_QUEUE_URL, k3s_runner.pause = sqs, "https://sqs/queue", pause
+    try:
+        k3s_runner.loop(handle)
+    except StopLoop:
+        pass
+    finally:
+        k3s_runner.sqs, k3s_runner.SQS_QUEUE_URL, k3s_runner.pause = saved
+
+
+def test_processed_message_deleted():
+    sqs = FakeSQS([{"host": "dg", "entity_id": "1"}])
+    events = []
+    run_messages(sqs, lambda event, context: events.append(event) or {"searched": 3, "added": 1})
+
+    assert events == [{"sqs_entity": {"host": "dg", "entity_id": "1"}}]
+    assert sqs.deleted == ["receipt-0"]
+    assert sqs.visibility == []
+
+    print("  processed message deleted: PASS")
+
+
+def test_other_replicas_message_requeued():
+    sqs = FakeSQS([{"host": "dg", "entity_id": "1"},
+                   {"Type": "Notification", "Message": "UC123"}])
+    run_messages(sqs, lambda event, context: {"searched": 0, "added": 0, "requeue": True})
+
+    # Visible again right away, for the replica holding the shard
+    assert sqs.deleted == []
+    assert sqs.visibility == [("receipt-0", 0), ("receipt-1", 0)]
+
+    print("  other replica's message requeued: PASS")
+
+
+if __name__ == "__main__":
+    print("Running k3s_runner tests...")
+    test_processed_message_deleted()
+    test_other_replicas_message_requeued()
+    print("\nALL TESTS PASSED")
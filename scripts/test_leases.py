@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Unit tests for leases.py — shard leases shared by replicas."""
+
+import sys
+import os
+import types
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from leases import LeaseManager
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class FakeTable:
+    """One lease item, understanding the expressions LeaseManager sends."""
+
+    def __init__(self):
+        self.item = None
+        self.meta = types.SimpleNamespace(client=types.SimpleNamespace(
+            exceptions=types.SimpleNamespace(ConditionalCheckFailedException=ConditionalCheckFailedException)))
+
+    def put_item(self, Item, ConditionExpression, ExpressionAttributeNames):
+        if self.item is not None:
+            raise ConditionalCheckFailedException()
+        self.item = {'name': Item['name'], 'members': {}, 'shards': {}}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None,
+                    ExpressionAttributeNames=None, ExpressionAttributeValues=None, ReturnValues=None):
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        if self.item is None:
+            raise ConditionalCheckFailedException()
+        members, shards = self.item['members'], self.item['shards']
+        shard = names.get('#s')
+        lease = shards.get(shard)
+
+        if ConditionExpression == 'shards.#s.#o = :me':
+            ok = lease is not None and lease['owner'] == values[':me']
+        elif ConditionExpression == 'attribute_not_exists(shards.#s) OR shards.#s.expires_at < :now':
+            ok = lease is None or lease['expires_at'] < values[':now']
+        elif ConditionExpression == 'members.#m <= :cutoff':
+            ok = members.get(names['#m'], float('inf')) <= values[':cutoff']
+        else:
+            ok = True
+        if not ok:
+            raise ConditionalCheckFailedException()
+
+        if UpdateExpression == 'SET members.#me = :exp':
+            members[names['#me']] = values[':exp']
+        elif UpdateExpression == 'REMOVE members.#me':
+            members.pop(names['#me'], None)
+        elif UpdateExpression == 'REMOVE members.#m':
+            members.pop(names['#m'], None)
+        elif UpdateExpression == 'SET shards.#s.expires_at = :exp':
+            lease['expires_at'] = values[':exp']
+        elif UpdateExpression == 'SET shards.#s = :lease':
+            shards[shard] = dict(values[':lease'])
+        elif UpdateExpression == 'REMOVE shards.#s':
+            shards.pop(shard, None)
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': {'members': dict(members), 'shards': dict(shards)}}
+        return {}
+
+
+def replica(table, clock, name, **kwargs):
+    return LeaseManager(table, 'test', 8, owner=name, ttl=60, clock=clock, **kwargs)
+
+
+def test_single_replica_owns_everything():
+    table, clock = FakeTable(), FakeClock()
+    a = replica(table, clock, 'a')
+    a.refresh()
+    assert a.owned() == list(range(8))
+    assert a.next_shard() != a.next_shard()
+
+    print("  single replica: PASS")
+
+
+def test_joining_replica_gets_half():
+    table, clock = FakeTable(), FakeClock()
+    released = []
+    a = replica(table, clock, 'a', on_release=released.append)
+    b = replica(table, clock, 'b')
+    a.refresh()
+    b.refresh()
+    # Nothing free yet: b waits for a to give shards up
+    assert b.owned() == []
+    a.refresh()
+    assert len(a.owned()) == 4
+    assert sorted(released) == [4, 5, 6, 7]
+    b.refresh()
+    assert b.owned() == [4, 5, 6, 7]
+    assert not set(a.owned()) & set(b.owned())
+
+    print("  rebalance on join: PASS")
+
+
+def test_dead_replica_shards_are_taken_over():
+    table, clock = FakeTable(), FakeClock()
+    a = replica(table, clock, 'a')
+    b = replica(table, clock, 'b')
+    a.refresh()
+    b.refresh()
+    a.refresh()
+    b.refresh()
+    # a stops heartbeating
+    clock.now += 61
+    b.refresh()
+    assert b.owned() == list(range(8))
+    # a comes back: its leases were lost, nothing is owned twice
+    a.refresh()
+    assert a.stats['lost'] == 4
+    assert not set(a.owned()) & set(b.owned())
+
+    print("  takeover: PASS")
+
+
+def test_shard_in_flight_is_released_when_done():
+    table, clock = FakeTable(), FakeClock()
+    released = []
+    a = replica(table, clock, 'a', on_release=released.append)
+    b = replica(table, clock, 'b')
+    a.refresh()
+    assert a.start_work(7)
+    b.refresh()
+    a.refresh()
+    # Shard 7 is handed over, but an entity of it is still being processed
+    assert sorted(released) == [4, 5, 6]
+    assert a.owned() == [0, 1, 2, 3]
+    assert not a.start_work(6) and not a.start_work(7)
+    b.refresh()
+    assert b.owned() == [4, 5, 6]
+    # Renewed meanwhile, released as soon as the entity is done
+    clock.now += 50
+    a.refresh()
+    a.finish_work(7)
+    assert sorted(released) == [4, 5, 6, 7]
+    b.refresh()
+    assert b.owned() == [4, 5, 6, 7]
+
+    print("  release after work in flight: PASS")
+
+
+def test_release_all_hands_over_immediately():
+    table, clock = FakeTable(), FakeClock()
+    a = replica(table, clock, 'a')
+    b = replica(table, clock, 'b')
+    a.refresh()
+    a.release_all()
+    b.refresh()
+    assert b.owned() == list(range(8))
+    assert 'a' not in table.item['members']
+
+    print("  release all: PASS")
+
+
+if __name__ == "__main__":
+    print("Running leases tests...")
+    test_single_replica_owns_everything()
+    test_joining_replica_gets_half()
+    test_dead_replica_shards_are_taken_over()
+    test_shard_in_flight_is_released_when_done()
+    test_release_all_hands_over_immediately()
+    print("\nALL TESTS PASSED")
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Unit tests for metrics.py — Prometheus metrics without dependencies."""
+
+import sys
+import os
+import types
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import metrics
+from metrics import Registry
+
+
+def test_render_text_format():
+    registry = Registry()
+    calls = registry.counter("test_calls_total", "Calls.", ("path",))
+    calls.inc(path="sqs")
+    calls.inc(2, path="cursor")
+    latency = registry.histogram("test_seconds", "Latency.", ("path",), buckets=(0.1, 1))
+    latency.observe(0.05, path="sqs")
+    latency.observe(0.5, path="sqs")
+    latency.observe(5, path="sqs")
+    registry.gauge("test_pending", "Pending.", ("host",), fn=lambda: {("yt",): 3})
+
+    text = registry.render()
+    assert '# TYPE test_calls_total counter' in text
+    assert 'test_calls_total{path="cursor"} 2' in text
+    assert 'test_seconds_bucket{path="sqs",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{path="sqs",le="1"} 2' in text
+    assert 'test_seconds_bucket{path="sqs",le="+Inf"} 3' in text
+    assert 'test_seconds_count{path="sqs"} 3' in text
+    assert 'test_seconds_sum{path="sqs"} 5.55' in text
+    assert 'test_pending{host="yt"} 3' in text
+    # Declared again (runner and function): same metric
+    assert registry.counter("test_calls_total", "Calls.", ("path",)) is calls
+
+    print("  text format: PASS")
+
+
+def test_timed_records_errors():
+    before = metrics.dependency_calls.value(dependency="test", operation="op", outcome="error")
+    try:
+        with metrics.timed("test", "op"):
+            raise RuntimeError("down")
+    except RuntimeError:
+        pass
+    with metrics.timed("test", "op"):
+        pass
+    assert metrics.dependency_calls.value(dependency="test", operation="op", outcome="error") == before + 1
+    assert metrics.dependency_calls.value(dependency="test", operation="op", outcome="ok") >= 1
+    assert metrics.dependency_seconds.count(dependency="test", operation="op") >= 2
+
+    print("  timed: PASS")
+
+
+class FakeEvents:
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, event, handler, unique_id=None):
+        self.handlers[event] = handler
+
+    def emit(self, event, **kwargs):
+        self.handlers[event](**kwargs)
+
+
+def test_boto3_calls_by_operation():
+    events = FakeEvents()
+    client = types.SimpleNamespace(meta=types.SimpleNamespace(
+        events=events, service_model=types.SimpleNamespace(service_name="dynamodb")))
+    metrics.instrument_boto3(client)
+    model = types.SimpleNamespace(name="TestQuery")
+    context = {}
+    events.emit("before-call", model=model, params={}, context=context)
+    events.emit("after-call", model=model, parsed={}, http_response=None, context=context)
+    events.emit("before-call", model=model, params={}, context=context)
+    events.emit("after-call-error", exception=Exception("timeout"), context=context)
+    assert metrics.dependency_calls.value(dependency="dynamodb", operation="TestQuery", outcome="ok") == 1
+    assert metrics.dependency_calls.value(dependency="dynamodb", operation="TestQuery", outcome="error") == 1
+
+    print("  boto3 events: PASS")
+
+
+def test_timed_cursor_by_verb():
+    class Cursor:
+        def execute(self, query, args=None):
+            return 1
+
+        def executemany(self, query, args):
+            return len(args)
+
+    cursor = metrics.timed_cursor_class(Cursor)()
+    assert cursor.execute("  select * from yt_channels where id = %s", [1]) == 1
+    assert cursor.executemany("UPDATE yt_playlists SET num = %s", [[1], [2]]) == 2
+    assert metrics.dependency_seconds.count(dependency="mysql", operation="SELECT") == 1
+    assert metrics.dependency_seconds.count(dependency="mysql", operation="UPDATE") == 1
+
+    print("  mysql cursor: PASS")
+
+
+def test_http_endpoint():
+    registry = Registry()
+    registry.counter("test_served_total", "Served.").inc()
+    server = metrics.serve(0, "127.0.0.1", registry=registry)
+    try:
+        url = "http://127.0.0.1:%d/metrics" % server.server_address[1]
+        with urllib.request.urlopen(url, timeout=5) as res:
+            assert res.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            assert "test_served_total 1" in res.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print("  http endpoint: PASS")
+
+
+if __name__ == "__main__":
+    print("Running metrics tests...")
+    test_render_text_format()
+    test_timed_records_errors()
+    test_boto3_calls_by_operation()
+    test_timed_cursor_by_verb()
+    test_http_endpoint()
+    print("\nALL TESTS PASSED")
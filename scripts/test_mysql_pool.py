@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Unit tests for mysql_pool.py — pooled MySQL connections."""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from mysql_pool import Pool, PoolExhausted
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class OperationalError(Exception):
+    pass
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, args=None):
+        self.conn.queries.append(query)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.open = True
+        self.alive = True
+        self.queries = []
+        self.commits = self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def ping(self, reconnect=False):
+        if not self.alive:
+            raise OperationalError("gone away")
+
+    def begin(self):
+        self.queries.append("BEGIN")
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.open = False
+
+
+def make_pool(clock, **kwargs):
+    return Pool(connect=FakeConnection, clock=clock, host="db", **kwargs)
+
+
+def test_reuse_and_autocommit():
+    pool = make_pool(FakeClock(), size=2)
+    with pool.cursor() as cur:
+        cur.execute("SELECT 1")
+        first = cur.conn
+    with pool.cursor() as cur:
+        assert cur.conn is first
+    assert first.kwargs == {"autocommit": True, "host": "db"}
+    assert pool.metrics()["created"] == 1 and pool.metrics()["reused"] == 1
+
+    print("  reuse: PASS")
+
+
+def test_ping_and_max_lifetime():
+    clock = FakeClock()
+    pool = make_pool(clock, ping_interval=30, max_lifetime=100)
+    with pool.connection() as conn:
+        first = conn
+    # Idle too long and dead: replaced
+    clock.now = 40
+    first.alive = False
+    with pool.connection() as conn:
+        assert conn is not first
+        second = conn
+    assert pool.metrics()["ping_failures"] == 1
+    # Too old: recycled even if alive
+    clock.now = 150
+    with pool.connection() as conn:
+        assert conn is not second
+    assert pool.metrics()["recycled"] == 1
+
+    print("  ping and lifetime: PASS")
+
+
+def test_transaction():
+    pool = make_pool(FakeClock())
+    with pool.transaction() as cur:
+        cur.execute("UPDATE t")
+    conn = cur.conn
+    assert conn.queries == ["BEGIN", "UPDATE t"] and conn.commits == 1
+
+    try:
+        with pool.transaction() as cur:
+            raise ValueError("boom")
+    except ValueError:
+        pass
+    assert conn.rollbacks >= 1 and conn.commits == 1
+    # Still healthy, back in the pool
+    assert pool.metrics()["idle"] == 1
+
+    print("  transaction: PASS")
+
+
+def test_broken_connection_discarded():
+    pool = make_pool(FakeClock())
+    try:
+        with pool.connection():
+            raise OperationalError("Lost connection")
+    except OperationalError:
+        pass
+    assert pool.metrics()["idle"] == 0 and pool.metrics()["discarded"] == 1
+
+    print("  broken connection: PASS")
+
+
+def test_exhausted():
+    pool = make_pool(FakeClock(), size=1, checkout_timeout=0)
+    with pool.connection():
+        try:
+            with pool.connection():
+                assert False, "expected PoolExhausted"
+        except PoolExhausted:
+            pass
+    assert pool.metrics()["in_use"] == 0
+
+    print("  exhausted: PASS")
+
+
+if __name__ == "__main__":
+    print("Running mysql_pool tests...")
+    test_reuse_and_autocommit()
+    test_ping_and_max_lifetime()
+    test_transaction()
+    test_broken_connection_discarded()
+    test_exhausted()
+    print("\nALL TESTS PASSED")
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Unit tests for track_parsing.py — stored title parses."""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import track_parsing
+from track_parsing import parser_version, record_title
+
+
+def test_current_parse_is_reused():
+    calls = []
+    original = track_parsing.parse_title
+    track_parsing.parse_title = lambda title: calls.append(title)
+    try:
+        record = {
+            'yt_track_name': 'Artist A & Artist B - Track (Official Video)',
+            'yt_parser_version': parser_version(),
+            'yt_parsed_artists': ['Artist A', 'Artist B'],
+            'yt_parsed_track': 'Track',
+        }
+        assert record_title(record, 'yt_track_name') == (['Artist A', 'Artist B'], 'Track')
+
+        # Parsed by the current version without artist/track split
+        unparsed = {'yt_track_name': 'Live stream', 'yt_parser_version': parser_version()}
+        assert record_title(unparsed, 'yt_track_name') is None
+        assert calls == []
+    finally:
+        track_parsing.parse_title = original
+
+    print("  stored parse: PASS")
+
+
+def test_other_version_is_parsed_again():
+    calls = []
+    original = track_parsing.parse_title
+    track_parsing.parse_title = lambda title: calls.append(title) or (['New'], 'Parse')
+    try:
+        record = {
+            'yt_track_name': 'Artist - Track',
+            'yt_parser_version': 'trackfilter-0.0.1',
+            'yt_parsed_artists': ['Old'],
+            'yt_parsed_track': 'Parse',
+        }
+        assert record_title(record, 'yt_track_name') == (['New'], 'Parse')
+        # Items ingested before titles were parsed
+        assert record_title({'yt_track_name': 'Artist - Track'}, 'yt_track_name') == (['New'], 'Parse')
+        assert calls == ['Artist - Track', 'Artist - Track']
+    finally:
+        track_parsing.parse_title = original
+
+    print("  version mismatch: PASS")
+
+
+if __name__ == "__main__":
+    print("Running track parsing tests...")
+    test_current_parse_is_reused()
+    test_other_version_is_parsed_again()
+    print("\nALL TESTS PASSED")
@@ -0,0 +1,55 @@
+"""
+YouTube title parsing shared by from-youtube and to-spotify.
+
+from-youtube stores the trackfilter split of each video title on the track
+item when it is ingested, tagged with the parser version. to-spotify uses
+the stored split and only parses again when the item was written by another
+parser version (or before titles were parsed at ingest).
+
+Copied next to main.py in the function images, like mysql_pool.py.
+"""
+
+from functools import lru_cache
+
+ARTISTS_FIELD = 'yt_parsed_artists'
+TRACK_FIELD = 'yt_parsed_track'
+VERSION_FIELD = 'yt_parser_version'
+
+
+@lru_cache(maxsize=1)
+def parser_version():
+    """Installed trackfilter release, stored with every parsed title."""
+    from importlib.metadata import PackageNotFoundError, version
+    try:
+        return 'trackfilter-' + version('trackfilter')
+    except PackageNotFoundError:
+        return 'trackfilter-unknown'
+
+
+def parse_title(title):
+    """([artists], track) from a video title, or None when trackfilter finds no artist/track split."""
+    from trackfilter.cli import split_artist_track
+
+    parsed = split_artist_track(title)
+    if not parsed or len(parsed) < 2:
+        return None
+    artists = parsed[0] if isinstance(parsed[0], list) else [parsed[0]]
+    return [str(artist).strip() for artist in artists], str(parsed[1]).strip()
+
+
+def title_fields(title):
+    """Item attributes holding the parse of `title`."""
+    fields = {VERSION_FIELD: parser_version()}
+    parsed = parse_title(title)
+    if parsed:
+        fields[ARTISTS_FIELD], fields[TRACK_FIELD] = parsed
+    return fields
+
+
+def record_title(record, title_field):
+    """Stored parse of a track item when it is current, otherwise parse its title now."""
+    if record.get(VERSION_FIELD) == parser_version():
+        if ARTISTS_FIELD not in record:
+            return None
+        return list(record[ARTISTS_FIELD]), record[TRACK_FIELD]
+    return parse_title(record[title_field])
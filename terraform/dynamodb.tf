@@ -45,3 +45,116 @@ resource "aws_dynamodb_table" "takedowns" {
 }
 
 # submissions and credit_txns are in MySQL (see schema.sql)
+
+# Spotify search results cached by normalized query (to-spotify).
+# Items expire through TTL on expires_at.
+
+resource "aws_dynamodb_table" "search_cache" {
+  name         = "mirrorfm_search_cache"
+  billing_mode = "PAY_PER_REQUEST"
+
+  hash_key = "query"
+
+  attribute {
+    name = "query"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
+
+# Track tables written by from-youtube / from-discogs and read by to-spotify.
+# Created outside TF (see imports.tf); managed here for the pending_match index.
+# pending_match exists only on unmatched tracks (the time they are due for a
+# search), so the index holds the matching backlog, not the whole catalog.
+# Backfill existing items with scripts/backfill_pending_match.py before
+# setting PENDING_MATCH_INDEX on to-spotify.
+#
+# billing_mode is ignored below, so the index is created in the live table's
+# mode. Its capacities are only used when that mode is PROVISIONED (ignored
+# on demand); keep the write capacity in line with the table's, as writes to
+# unmatched tracks also go to the index, and raise it during the backfill.
+
+locals {
+  pending_match_read_capacity  = 5
+  pending_match_write_capacity = 5
+}
+
+resource "aws_dynamodb_table" "yt_tracks" {
+  name         = "mirrorfm_yt_tracks"
+  billing_mode = "PAY_PER_REQUEST"
+
+  hash_key  = "yt_channel_id"
+  range_key = "yt_track_composite"
+
+  attribute {
+    name = "yt_channel_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "yt_track_composite"
+    type = "S"
+  }
+
+  attribute {
+    name = "pending_match"
+    type = "N"
+  }
+
+  global_secondary_index {
+    name            = "pending_match"
+    hash_key        = "yt_channel_id"
+    range_key       = "pending_match"
+    projection_type = "ALL"
+    read_capacity   = local.pending_match_read_capacity
+    write_capacity  = local.pending_match_write_capacity
+  }
+
+  lifecycle {
+    prevent_destroy = true
+    # Streams and capacity predate TF, keep them as configured
+    ignore_changes = [billing_mode, read_capacity, write_capacity, stream_enabled, stream_view_type]
+  }
+}
+
+resource "aws_dynamodb_table" "dg_tracks" {
+  name         = "mirrorfm_dg_tracks"
+  billing_mode = "PAY_PER_REQUEST"
+
+  hash_key  = "dg_label_id"
+  range_key = "dg_track_composite"
+
+  attribute {
+    name = "dg_label_id"
+    type = "N"
+  }
+
+  attribute {
+    name = "dg_track_composite"
+    type = "S"
+  }
+
+  attribute {
+    name = "pending_match"
+    type = "N"
+  }
+
+  global_secondary_index {
+    name            = "pending_match"
+    hash_key        = "dg_label_id"
+    range_key       = "pending_match"
+    projection_type = "ALL"
+    read_capacity   = local.pending_match_read_capacity
+    write_capacity  = local.pending_match_write_capacity
+  }
+
+  lifecycle {
+    prevent_destroy = true
+    # Streams and capacity predate TF, keep them as configured
+    ignore_changes = [billing_mode, read_capacity, write_capacity, stream_enabled, stream_view_type]
+  }
+}
@@ -102,3 +102,13 @@ import {
   to = aws_lambda_permission.api_gateway_from_github
   id = "mirror-fm_from-github/AllowAPIGateway"
 }
+
+# Track tables (created outside TF), now managed for the pending_match index
+import {
+  to = aws_dynamodb_table.yt_tracks
+  id = "mirrorfm_yt_tracks"
+}
+import {
+  to = aws_dynamodb_table.dg_tracks
+  id = "mirrorfm_dg_tracks"
+}
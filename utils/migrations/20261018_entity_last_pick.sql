@@ -0,0 +1,7 @@
+-- When to-spotify's scheduler last picked the entity for rediscovery, kept
+-- across restarts for entities without a playlist or with nothing due.
+alter table yt_channels
+    add column last_pick_datetime datetime null;
+
+alter table dg_labels
+    add column last_pick_datetime datetime null;
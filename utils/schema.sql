@@ -26,6 +26,7 @@ create table dg_labels
     label_releases        int        default 0 null,
     last_page             int        default 0 null,
     did_init              tinyint(1) default 0 null,
+    last_pick_datetime    datetime             null,
     constraint dg_labels_label_id_uindex
         unique (label_id)
 );
@@ -60,6 +61,7 @@ create table yt_channels
     thumbnail_default    varchar(256) not null,
     terminated_datetime  datetime     null,
     added_datetime       datetime     null,
+    last_pick_datetime   datetime     null,
     constraint yt_channels_channel_id_uindex
         unique (channel_id),
     constraint yt_channels_id_uindex